@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+""" bench_parallel.py
+
+Scaling of compute_EHF_parallel with the number of workers on a synthetic grid.
+
+usage: python benchmarks/bench_parallel.py [--nyears 20] [--nlat 100] [--nlon 100]
+                                           [--workers 1 2 4 8] [--tile 25] [--method PA13]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compute_EHFheatwaves import compute_EHF
+from compute_EHFtiles import compute_EHF_parallel
+from synthetic import make_tave
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[3])
+    parser.add_argument("--nyears", type=int, default=20)
+    parser.add_argument("--nlat", type=int, default=100)
+    parser.add_argument("--nlon", type=int, default=100)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--tile", type=int, default=25)
+    parser.add_argument("--method", default="PA13")
+    args = parser.parse_args()
+
+    tave, dates = make_tave(args.nyears, args.nlat, args.nlon)
+    kwargs = dict(
+        bsyear=dates[0].year,
+        beyear=dates[0].year + args.nyears // 2 - 1,
+        method=args.method,
+        EHFaccl=True,
+    )
+
+    t0 = time.perf_counter()
+    compute_EHF(tave, dates, **kwargs)
+    tserial = time.perf_counter() - t0
+
+    print("grid: %s days x %s x %s" % tave.shape)
+    print("%10s %10s %10s" % ("workers", "time (s)", "speedup"))
+    print("%10s %10.2f %10.2f" % ("serial", tserial, 1.0))
+    for n_workers in args.workers:
+        t0 = time.perf_counter()
+        compute_EHF_parallel(
+            tave, dates, n_workers=n_workers, tile_size=args.tile, **kwargs
+        )
+        tparallel = time.perf_counter() - t0
+        print("%10d %10.2f %10.2f" % (n_workers, tparallel, tserial / tparallel))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+""" bench_stages.py
+
+Time and peak memory of each stage of compute_EHF on a synthetic grid.
+
+usage: python benchmarks/bench_stages.py [--nyears 20] [--nlat 50] [--nlon 50] [--repeat 3]
+                                         [--dtype float32] [--output results.json]
+                                         [--compare previous.json]
+
+Stages are timed separately (best of --repeat runs) and their peak memory is measured
+with tracemalloc in an extra run, counting only the arrays allocated by the stage.
+Results can be written to a json file with --output and compared with the results of
+another commit with --compare, to track speedups and regressions.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from compute_EHFheatwaves import (
+    compute_EHF,
+    calc_percentile,
+    calc_rolling_mean,
+    calc_EHF,
+    calc_spell_segments,
+    calc_spell_stats,
+    calc_yearly_metrics,
+)
+from synthetic import make_tave
+
+
+def get_stages(tave, dates, nbyears):
+
+    """Function to get the stages of compute_EHF (EHFaccl, PA13) as functions without arguments
+    tave, dates: synthetic temperature and dates, without leap days
+    nbyears: number of years of the base period
+    ---
+    output: list of (name, function). Inputs of each stage are calculated beforehand.
+    """
+    years = np.asarray(dates.year)
+    nyears = years[-1] - years[0] + 1
+    tave_base = tave[years < years[0] + nbyears]
+
+    pct = calc_percentile(tave_base, nbyears, method="PA13")
+    tave_3days = calc_rolling_mean(tave, 3, out_dtype=tave.dtype)
+    tave_30days = calc_rolling_mean(tave, 30, nlag=3, out_dtype=tave.dtype)
+    EHF = calc_EHF(tave_3days, pct, "PA13", tave_30days.copy())
+    spells = calc_spell_segments(EHF > 0)
+    stats = calc_spell_stats(EHF, *spells) + calc_spell_stats(tave_3days, *spells)
+
+    return [
+        ("percentile NF13", lambda: calc_percentile(tave_base, nbyears, method="NF13")),
+        ("percentile PA13", lambda: calc_percentile(tave_base, nbyears, method="PA13")),
+        (
+            "rolling means",
+            lambda: (
+                calc_rolling_mean(tave, 3, out_dtype=tave.dtype),
+                calc_rolling_mean(tave, 30, nlag=3, out_dtype=tave.dtype),
+            ),
+        ),
+        ("EHI/EHF", lambda: calc_EHF(tave_3days, pct, "PA13", tave_30days.copy())),
+        ("spell detection", lambda: calc_spell_segments(EHF > 0)),
+        (
+            "spell stats",
+            lambda: (
+                calc_spell_stats(EHF, *spells),
+                calc_spell_stats(tave_3days, *spells),
+            ),
+        ),
+        (
+            "yearly metrics",
+            lambda: calc_yearly_metrics(
+                *spells, *stats, years, years[0], nyears, tave.shape[1:]
+            ),
+        ),
+        (
+            "compute_EHF",
+            lambda: compute_EHF(
+                tave,
+                dates,
+                bsyear=years[0],
+                beyear=years[0] + nbyears - 1,
+                method="PA13",
+                EHFaccl=True,
+            ),
+        ),
+    ]
+
+
+def run_stage(func, repeat):
+
+    """Function to measure a stage
+    func: function without arguments
+    repeat: number of timed runs
+    ---
+    output: best time (s) and peak memory (MB) allocated by func
+    """
+    times = []
+    for k in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak / 1e6
+
+
+def get_commit():
+    """get the current git commit, None if not available"""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[3])
+    parser.add_argument("--nyears", type=int, default=20)
+    parser.add_argument("--nlat", type=int, default=50)
+    parser.add_argument("--nlon", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--output", help="json file where results are written")
+    parser.add_argument("--compare", help="json file with results to compare with")
+    args = parser.parse_args()
+
+    tave, dates = make_tave(args.nyears, args.nlat, args.nlon, dtype=args.dtype)
+    noleap = ~((dates.month == 2) & (dates.day == 29))
+    tave, dates = tave[noleap], dates[noleap]
+
+    results = dict(
+        commit=get_commit(),
+        grid=list(tave.shape),
+        dtype=args.dtype,
+        stages={},
+    )
+    for name, func in get_stages(tave, dates, args.nyears // 2):
+        tstage, peak = run_stage(func, args.repeat)
+        results["stages"][name] = dict(time=tstage, peak_mb=peak)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as fcompare:
+            previous = json.load(fcompare)["stages"]
+
+    print("grid: %s days x %s x %s (%s)" % (tuple(tave.shape) + (args.dtype,)))
+    header = "%-16s %10s %12s" % ("stage", "time (s)", "peak (MB)")
+    if previous is not None:
+        header += " %10s %10s" % ("speedup", "mem ratio")
+    print(header)
+    for name, stage in results["stages"].items():
+        line = "%-16s %10.3f %12.1f" % (name, stage["time"], stage["peak_mb"])
+        if previous is not None and name in previous:
+            line += " %10.2f %10.2f" % (
+                previous[name]["time"] / stage["time"],
+                stage["peak_mb"] / max(previous[name]["peak_mb"], 1e-6),
+            )
+        print(line)
+
+    if args.output is not None:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+""" synthetic.py
+
+Synthetic daily mean temperature used by the benchmarks.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def make_tave(nyears=20, nlat=50, nlon=50, syear=1981, seed=0, dtype=np.float32):
+
+    """Function to generate a daily mean temperature cube with a seasonal cycle and noise
+    nyears: number of years
+    nlat, nlon: size of the grid
+    syear: first year
+    seed: seed of the random generator
+    dtype: type of the temperature array
+    ---
+    output: tave (time,lat,lon) in K, dates (pandas DatetimeIndex)
+    """
+    dates = pd.date_range(
+        "%s-01-01" % (syear), "%s-12-31" % (syear + nyears - 1), freq="D"
+    )
+    rng = np.random.default_rng(seed)
+    seasonal = 288.0 + 10.0 * np.sin(2 * np.pi * (dates.dayofyear.values - 100) / 365.25)
+    tave = seasonal[:, None, None] + rng.normal(0, 3, (len(dates), nlat, nlon))
+    return tave.astype(dtype), dates
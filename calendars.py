@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+""" calendars.py
+
+Vectorized handling of the dates of daily series for compute_EHF.
+
+get_ymd extracts the year, month and day of all dates at once from numpy datetime64
+arrays, pandas DatetimeIndex and lists of datetime objects, instead of creating one
+Timestamp per date. The year, month and day of cftime dates (e.g. the xarray CFTimeIndex
+of a model output) are read from the attributes of each object, which is not vectorized
+but is faster than converting them to numbers. Model calendars are supported natively:
+
+| Calendar | Days per year | Leap days removed in PA13 | Calendar days of PA13 thresholds |
+|-----|-----|-----|-----|
+| standard, gregorian, proleptic_gregorian, julian | 365 or 366 | Feb 29 | 365 |
+| noleap, 365_day | 365 | none | 365 |
+| all_leap, 366_day | 366 | Feb 29 | 365 |
+| 360_day | 360 | none | 360 |
+"""
+
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+
+# Calendars where PA13 thresholds are calculated for 360 calendar days instead of 365
+calendars_360 = ["360_day"]
+
+
+def get_calendar(dates):
+
+    """Function to get the calendar of a series of dates
+    dates: datetime64 array, pandas DatetimeIndex, list of datetime or cftime dates
+    ---
+    output: name of the calendar (CF conventions), standard for numpy, pandas and datetime dates
+    """
+    calendar = getattr(dates, "calendar", None)
+    if calendar is None and len(dates) > 0:
+        calendar = getattr(dates[0], "calendar", None)
+    if not calendar:
+        return "standard"
+    return calendar
+
+
+def get_ymd(dates):
+
+    """Function to get the year, month and day of each date
+    dates: datetime64 array, pandas DatetimeIndex, list of datetime or cftime dates
+    ---
+    output: years, months, days (int arrays)
+    """
+    if isinstance(dates, pd.DatetimeIndex):
+        return (
+            np.array(dates.year, dtype=int),
+            np.array(dates.month, dtype=int),
+            np.array(dates.day, dtype=int),
+        )
+
+    values = np.asarray(dates)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return calc_ymd_datetime64(values)
+    if len(values) == 0:
+        return tuple(np.zeros((0,), dtype=int) for k in range(3))
+
+    if isinstance(values[0], (dt.date, np.datetime64)):
+        return get_ymd(pd.DatetimeIndex(values))
+
+    # cftime dates (any calendar) are read attribute by attribute, one list per field. It is
+    # not vectorized, but it is faster than converting them to numbers (cftime.date2num) or
+    # than building (year,month,day) tuples in a single loop
+    return (
+        np.asarray([date.year for date in values], dtype=int),
+        np.asarray([date.month for date in values], dtype=int),
+        np.asarray([date.day for date in values], dtype=int),
+    )
+
+
+def calc_ymd_datetime64(values):
+    """get years, months and days of a datetime64 array"""
+    years = values.astype("datetime64[Y]")
+    months = values.astype("datetime64[M]")
+    days = values.astype("datetime64[D]")
+    return (
+        years.astype(int) + 1970,
+        (months - years).astype(int) + 1,
+        (days - months).astype(int) + 1,
+    )
+
+
+def calc_leap_days(months, days, calendar="standard"):
+
+    """Function to find the days removed in PA13 method, so that every year has the same days
+    months, days: month and day of each date (see get_ymd)
+    calendar: calendar of the dates
+    ---
+    output: boolean array, True for Feb 29 (no days are removed in 360_day calendars)
+    """
+    if calendar in calendars_360:
+        return np.zeros(months.shape, dtype=bool)
+    return (months == 2) & (days == 29)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+""" compute_EHFcatalog.py
+
+Catalog of EHF heatwaves: one row per heatwave instead of (time,lat,lon) arrays.
+
+Heatwave days are a small fraction of all days, so a table with the gridpoint, start,
+length and the mean and peak EHF and 3-day temperature of each heatwave takes much less
+memory and disk than the daily EHF index and spells. The yearly metrics of compute_EHF
+are aggregated from the table by calc_catalog_metrics, with the same results.
+
+Catalogs are structured numpy arrays (see event_dtype). They can be written as .npy,
+Parquet (pandas with pyarrow or fastparquet) or netCDF files. In netCDF files events are
+stored as a contiguous ragged array (CF conventions) with the events of each gridpoint
+one after another.
+"""
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+from compute_EHFheatwaves import calc_heatwaves, calc_metrics_from_events
+
+
+event_dtype = np.dtype(
+    [
+        ("ilat", np.int32),
+        ("ilon", np.int32),
+        ("start", np.int64),
+        ("start_year", np.int32),
+        ("start_month", np.int8),
+        ("start_day", np.int8),
+        ("year", np.int32),
+        ("year_day", np.int32),
+        ("length", np.int32),
+        ("EHF_avg", float),
+        ("EHF_peak", float),
+        ("TMP3D_ave", float),
+        ("TMP3D_peak", float),
+    ]
+)
+
+year_dtype = np.dtype([("year", np.int32), ("ndays", np.int32)])
+
+event_info = dict(
+    ilat=("", "Index of the gridpoint along latitude"),
+    ilon=("", "Index of the gridpoint along longitude"),
+    start=("", "Index of the first day (without leap days in PA13)"),
+    start_year=("", "Year of the first day"),
+    start_month=("", "Month of the first day"),
+    start_day=("", "Day of the month of the first day"),
+    year=("", "Year the heatwave belongs to (see month_starty)"),
+    year_day=("day", "First heatwave day from the start of its year"),
+    length=("days", "Duration of the heatwave"),
+    EHF_avg=("K2", "Average EHF of the heatwave"),
+    EHF_peak=("K2", "Peak EHF of the heatwave"),
+    TMP3D_ave=("K", "Average 3-day mean temperature of the heatwave"),
+    TMP3D_peak=("K", "Peak 3-day mean temperature of the heatwave"),
+)
+
+
+def compute_EHF_catalog(tave, dates=None, **kwargs):
+
+    """Function to calculate the catalog of EHF heatwaves of tave
+    tave, dates: same as compute_EHF
+    kwargs: any other argument of compute_EHF (bsyear, beyear, method, EHFaccl, season...)
+    ---
+    output: catalog, years, pct
+            catalog: structured array with one row per heatwave (event_dtype), sorted by gridpoint and then time
+            years: structured array with each year and its number of days (year_dtype), used by calc_catalog_metrics
+            pct: thresholds, as in compute_EHF
+
+    The daily EHF index is calculated and freed, and spell_all is not calculated.
+    """
+    hw = calc_heatwaves(tave, dates, spells=False, **kwargs)
+
+    new_years = hw["new_years"]
+    years = np.zeros((hw["nyears"],), dtype=year_dtype)
+    years["year"] = np.arange(hw["syear"], hw["syear"] + hw["nyears"])
+    ystart = np.searchsorted(new_years, years["year"], side="left")
+    years["ndays"] = np.searchsorted(new_years, years["year"], side="right") - ystart
+
+    tstart = hw["tstart"]
+    catalog = np.zeros((len(tstart),), dtype=event_dtype)
+    catalog["ilat"] = hw["ilat"]
+    catalog["ilon"] = hw["ilon"]
+    catalog["start"] = tstart
+    catalog["start_year"] = hw["years"][tstart]
+    catalog["start_month"] = hw["months"][tstart]
+    catalog["start_day"] = hw["days"][tstart]
+    catalog["year"] = new_years[tstart]
+    year = new_years[tstart] - hw["syear"]
+    catalog["year_day"] = tstart - ystart[np.maximum(year, 0)]
+    for name in ("length", "EHF_avg", "EHF_peak", "TMP3D_ave", "TMP3D_peak"):
+        catalog[name] = hw[name]
+
+    return catalog, years, hw["pct"]
+
+
+def calc_catalog_metrics(catalog, years, shape):
+
+    """Function to calculate the yearly heatwave metrics from a catalog
+    catalog: heatwaves, as returned by compute_EHF_catalog
+    years: years and their number of days, as returned by compute_EHF_catalog
+    shape: (lat,lon) shape of the grid
+    ---
+    output: HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL (year,lat,lon), the same as compute_EHF
+    """
+    return calc_metrics_from_events(
+        catalog["year"] - years["year"][0],
+        catalog["year_day"],
+        catalog["ilat"],
+        catalog["ilon"],
+        catalog["length"],
+        catalog["EHF_avg"],
+        catalog["EHF_peak"],
+        catalog["TMP3D_ave"],
+        catalog["TMP3D_peak"],
+        years["ndays"],
+        shape,
+    )
+
+
+def write_catalog(filename, catalog, years=None):
+
+    """Function to write a catalog of heatwaves
+    filename: output file, .npy, .parquet or .nc
+    catalog: heatwaves, as returned by compute_EHF_catalog
+    years: [OPTIONAL] years and their number of days, written to netCDF files
+    ---
+    output: None
+    """
+    filename = str(filename)
+    if filename.endswith(".npy"):
+        np.save(filename, catalog)
+    elif filename.endswith(".parquet"):
+        pd.DataFrame(catalog).to_parquet(filename)
+    elif filename.endswith(".nc"):
+        write_catalog_nc(filename, catalog, years)
+    else:
+        raise ValueError("Catalog format not supported: use .npy, .parquet or .nc")
+
+
+def write_catalog_nc(filename, catalog, years=None):
+
+    """Function to write a catalog of heatwaves as a netCDF contiguous ragged array
+    filename: netCDF file
+    catalog: heatwaves, e.g. as returned by compute_EHF_catalog. Catalogs that are not sorted by
+             gridpoint (e.g. concatenated or filtered) are sorted first, keeping the order of the
+             heatwaves of each gridpoint
+    years: [OPTIONAL] years and their number of days
+    ---
+    output: None
+    """
+    # The heatwaves of each gridpoint must be contiguous and in the order of cells
+    dlat, dlon = np.diff(catalog["ilat"]), np.diff(catalog["ilon"])
+    if np.any((dlat < 0) | ((dlat == 0) & (dlon < 0))):
+        catalog = catalog[np.lexsort((catalog["ilon"], catalog["ilat"]))]
+
+    # Gridpoints with heatwaves and the number of heatwaves of each of them
+    cells, count = np.unique(
+        np.stack((catalog["ilat"], catalog["ilon"]), axis=1),
+        axis=0,
+        return_counts=True,
+    )
+
+    fout = nc.Dataset(filename, "w")
+    fout.featureType = "timeSeries"
+    fout.createDimension("cell", len(cells))
+    fout.createDimension("event", len(catalog))
+
+    for k, name in enumerate(("cell_ilat", "cell_ilon")):
+        var = fout.createVariable(name, "i4", ("cell",))
+        var.long_name = "Index of the gridpoint along %s" % ("latitude", "longitude")[k]
+        var[:] = cells[:, k]
+    var = fout.createVariable("event_count", "i4", ("cell",))
+    var.long_name = "Number of heatwaves of each gridpoint"
+    var.sample_dimension = "event"
+    var[:] = count
+
+    for name in catalog.dtype.names:
+        if name in ("ilat", "ilon"):
+            continue
+        var = fout.createVariable(name, catalog.dtype[name], ("event",))
+        var.units, var.long_name = event_info[name]
+        var[:] = catalog[name]
+
+    if years is not None:
+        fout.createDimension("years", len(years))
+        var = fout.createVariable("years", "i4", ("years",))
+        var[:] = years["year"]
+        var = fout.createVariable("ndays_year", "i4", ("years",))
+        var.long_name = "Number of days of each year (without leap days in PA13)"
+        var[:] = years["ndays"]
+    fout.close()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+""" compute_EHFensemble.py
+
+EHF heatwaves of the members of an ensemble that share a grid and a base period.
+
+The thresholds are calculated once for the whole ensemble: either pooled over the base
+period of all members (the same thresholds for every member) or separately for each
+member. Members are then processed in batches. The members of a batch are placed side by
+side along the longitude axis, so each batch takes a single compute_EHF call. The years, months
+and days of the dates are calculated once for the whole ensemble and passed to every call. All
+steps of compute_EHF are independent for each gridpoint, so the results are the same as running
+compute_EHF on each member.
+"""
+
+import numpy as np
+import xarray as xr
+from compute_EHFheatwaves import compute_EHF, calc_percentile
+from calendars import get_ymd, get_calendar, calc_leap_days
+
+
+def get_member(tave, member, varname="tas"):
+
+    """Function to get the (time,lat,lon) temperature of one member
+    tave: (member,time,lat,lon) array or list of netCDF files, one per member
+    member: index of the member
+    varname: name of the temperature variable in the files
+    ---
+    output: (time,lat,lon) array
+    """
+    if isinstance(tave, (list, tuple)):
+        with xr.open_dataset(tave[member]) as fin:
+            return fin[varname].values
+    return tave[member]
+
+
+def calc_base_index(dates, bsyear, beyear, method="NF13", ymd=None):
+
+    """Function to get the days of the base period, without leap days in PA13 method
+    dates: dates of each day (see calendars.py)
+    bsyear, beyear: first and last year of the base period
+    method: NF13 or PA13
+    ymd: [OPTIONAL] years, months and days of all dates, as returned by get_ymd
+    ---
+    output: indexes of the days of the base period
+    """
+    if ymd is None:
+        ymd = get_ymd(dates)
+    years, months, days = ymd
+    base = (years >= bsyear) & (years <= beyear)
+    if method == "PA13":
+        base &= ~calc_leap_days(months, days, get_calendar(dates))
+    return np.nonzero(base)[0]
+
+
+def calc_pooled_percentile(
+    tave, dates, bsyear, beyear, method="NF13", nwindow=15, varname="tas", ymd=None
+):
+
+    """Function to calculate the thresholds of the base period of all members together
+    tave: (member,time,lat,lon) array or list of netCDF files, one per member
+    dates: dates of each day
+    bsyear, beyear: first and last year of the base period
+    method, nwindow: same as calc_percentile
+    varname: name of the temperature variable in the files
+    ymd: [OPTIONAL] years, months and days of all dates, as returned by get_ymd
+    ---
+    output: pct, (lat,lon) for NF13 or (ndoy,lat,lon) for PA13
+
+    The base period of each member is taken as further years of the same sample, so PA13
+    windows wrap around within each year of each member. Arrays are read by index, without
+    copying the base period of all members (see tindex in calc_percentile).
+    """
+    base_index = calc_base_index(dates, bsyear, beyear, method, ymd)
+    nbyears = beyear - bsyear + 1
+
+    if isinstance(tave, (list, tuple)):
+        nmembers = len(tave)
+        tave_base = np.concatenate(
+            [get_member(tave, k, varname)[base_index] for k in range(nmembers)]
+        )
+        tindex = None
+    else:
+        nmembers, ndays = tave.shape[:2]
+        tave_base = tave.reshape((nmembers * ndays,) + tave.shape[2:])
+        tindex = (np.arange(nmembers)[:, None] * ndays + base_index).ravel()
+
+    return calc_percentile(
+        tave_base, nbyears * nmembers, method=method, nwindow=nwindow, tindex=tindex
+    )
+
+
+def compute_EHF_ensemble(
+    tave,
+    dates=None,
+    bsyear=None,
+    beyear=None,
+    pooled=True,
+    batch_size=10,
+    daily=False,
+    varname="tas",
+    mask=None,
+    thres_file=None,
+    **kwargs
+):
+
+    """Function to calculate EHF heatwaves of the members of an ensemble
+    tave: (member,time,lat,lon) array (e.g. memory-mapped, see read_EHFinput.py) or list of netCDF files,
+          one per member
+    dates: dates of each day. Default: read from the first file
+    bsyear, beyear: first and last year of the base period
+    pooled: if True, thresholds are calculated once from the base period of all members and used for
+            all of them. Otherwise, each member uses the thresholds of its own base period
+    batch_size: number of members processed in each compute_EHF call
+    daily: if True, the daily EHF index and spells of each member are also returned (None otherwise)
+    varname: name of the temperature variable in the files
+    mask: [OPTIONAL] (lat,lon) array with mask where EHF wont be calculated (see compute_EHF)
+    thres_file: [OPTIONAL] file that contains previously calculated percentiles, used for all members
+    kwargs: any other argument of compute_EHF (method, EHFaccl, season, nwindow, dtype, ymd...)
+    ---
+    output: same as compute_EHF, with a first member dimension (member,year,lat,lon).
+            pct has no member dimension when thresholds are shared (pooled or thres_file)
+
+    Grids of a single gridpoint are processed one member at a time: numpy sums the days of a single
+    gridpoint pairwise, so batches would not give exactly the same results (see get_tiles).
+    """
+    method = kwargs.get("method", "NF13")
+    nwindow = kwargs.get("nwindow", 15)
+
+    if isinstance(tave, (list, tuple)):
+        nmembers = len(tave)
+        with xr.open_dataset(tave[0]) as fin:
+            shape = fin[varname].shape
+            if dates is None:
+                dates = fin.indexes[fin[varname].dims[0]]
+    else:
+        nmembers = tave.shape[0]
+        shape = tave.shape[1:]
+    if shape[1] * shape[2] == 1:
+        batch_size = 1
+
+    # Dates are converted once for all batches
+    ymd = kwargs.pop("ymd", None)
+    if ymd is None:
+        ymd = get_ymd(dates)
+
+    if thres_file is not None:
+        pct = calc_percentile(None, None, thres_file, method=method)
+    elif pooled:
+        pct = calc_pooled_percentile(
+            tave, dates, bsyear, beyear, method, nwindow, varname, ymd
+        )
+    else:
+        pct = None
+    shared_pct = pct is not None
+
+    output = None
+    for bstart in range(0, nmembers, batch_size):
+        members = [
+            get_member(tave, k, varname)
+            for k in range(bstart, min(bstart + batch_size, nmembers))
+        ]
+        nbatch = len(members)
+        nlon = shape[2]
+
+        # Members of the batch side by side along longitude
+        batch = np.concatenate(members, axis=2)
+        del members
+        batch_kwargs = dict(kwargs, ymd=ymd)
+        if mask is not None:
+            batch_kwargs["mask"] = np.concatenate([mask] * nbatch, axis=1)
+        if shared_pct:
+            batch_kwargs["pct"] = np.concatenate([pct] * nbatch, axis=-1)
+        else:
+            batch_kwargs.update(bsyear=bsyear, beyear=beyear)
+
+        result = list(compute_EHF(batch, dates, **batch_kwargs))
+        del batch
+        if not daily:
+            result[7] = result[10] = None
+
+        if output is None:
+            output = [
+                None
+                if var is None
+                else np.zeros((nmembers,) + var.shape[:-1] + (nlon,), dtype=var.dtype)
+                for var in result
+            ]
+        for ivar, var in enumerate(result):
+            if var is None or (ivar == 6 and shared_pct):
+                continue
+            # Spells of other batches may need a wider type (see dtype in compute_EHF)
+            if not np.can_cast(var.dtype, output[ivar].dtype):
+                output[ivar] = output[ivar].astype(
+                    np.promote_types(output[ivar].dtype, var.dtype)
+                )
+            for k in range(nbatch):
+                output[ivar][bstart + k] = np.ma.getdata(
+                    var[..., k * nlon : (k + 1) * nlon]
+                )
+
+    if shared_pct:
+        output[6] = pct
+    output[5] = np.ma.masked_equal(output[5], 0.0)
+    return tuple(output)
@@ -35,14 +35,97 @@ Modified: 2018-07-25 12:34 - Added NH and SH summer options
 import netCDF4 as nc
 import numpy as np
 from constants import const
+from calendars import get_ymd, get_calendar, calc_leap_days
 import glob as glob
 from itertools import groupby
 import datetime as dt
+import sys
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager, nullcontext
 
 import pdb
 
+logger = logging.getLogger(__name__)
 
-def calc_percentile(tave, nyears, thres_file=None, method="NF13", nwindow=15):
+# Yearly heatwave metrics, in the order they are written out
+metric_names = ["HWA", "HWM", "HWF", "HWN", "HWD", "HWT", "HWL", "HWAt", "HWMt"]
+
+# Default memory budget (bytes) of each chunk of gridpoints in calc_percentile_doy
+percentile_chunk_bytes = 64 * 2**20
+
+
+class StageProfile(object):
+
+    """Instrumentation of the stages of compute_EHF and calc_percentile
+    memory: if True, memory allocated by each stage is measured with tracemalloc (slower)
+    callback: [OPTIONAL] function called as callback(name, info) at the end of each stage
+    ---
+    stages: dictionary with the info of each stage, in order of execution:
+            time: wall time (s)
+            calls: number of times the stage was run (time and memory are added up)
+            shape, nbytes: shape and size in bytes of the input array of the stage
+            allocated: bytes still allocated at the end of the stage (only if memory is True)
+            peak: peak of bytes allocated during the stage (only if memory is True)
+
+    Each stage is also logged at DEBUG level. Without a profile (profile=None) stages are not timed.
+    """
+
+    def __init__(self, memory=False, callback=None):
+        self.memory = memory
+        self.callback = callback
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, var=None):
+        """time the code run within the context as stage name, var is the input array"""
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            mem0 = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+
+        yield
+
+        info = dict(time=time.perf_counter() - t0, calls=1)
+        if var is not None:
+            info["shape"] = tuple(var.shape)
+            info["nbytes"] = var.nbytes
+        if self.memory:
+            mem, peak = tracemalloc.get_traced_memory()
+            info["allocated"] = mem - mem0
+            info["peak"] = peak - mem0
+
+        if name in self.stages:
+            for key in ("time", "calls", "allocated", "peak"):
+                if key in info:
+                    info[key] += self.stages[name][key]
+        self.stages[name] = info
+
+        logger.debug("stage %s: %s", name, info)
+        if self.callback is not None:
+            self.callback(name, info)
+
+
+def profile_stage(profile, name, var=None):
+    """get the context that times stage name if there is a profile, a context doing nothing otherwise"""
+    if profile is None:
+        return nullcontext()
+    return profile.stage(name, var)
+
+
+def calc_percentile(
+    tave,
+    nyears,
+    thres_file=None,
+    method="NF13",
+    nwindow=15,
+    chunk_size=None,
+    profile=None,
+    tindex=None,
+):
 
     """Function to calculate the percentile that indentifies hot days
     tave: mean daily temperature calcualted from tmax and tmin
@@ -50,30 +133,38 @@ def calc_percentile(tave, nyears, thres_file=None, method="NF13", nwindow=15):
     thres_file: file that contains previously calculated percentiles
     method: now two methods are supported depending on how the percentiles are calculated 'NF13' and 'PA13'
     nwindow: number of days for the window used to calculate percentiles in PA13 method
+    chunk_size: [OPTIONAL] number of gridpoints processed at once in PA13 method to limit memory.
+                Default: as many as fit in percentile_chunk_bytes (see calc_percentile_doy)
+    profile: [OPTIONAL] StageProfile where the time of the calculation is recorded
+    tindex: [OPTIONAL] days of tave in the base period (e.g. without leap days). In PA13 method only these
+            days are read, one chunk at a time, so that tave (e.g. memory-mapped) is never copied whole
     ---
     output: pct_calc
     """
+    if tindex is not None and (
+        method == "NF13" or isinstance(tave, np.ma.core.MaskedArray)
+    ):
+        tave, tindex = tave[tindex], None
+
     if method == "NF13":
 
         if thres_file == None:
             print("No thresholds file provided, we will calculate them")
 
-            if not isinstance(tave, np.ma.core.MaskedArray):
-                pct_calc = np.nanpercentile(tave, 95, axis=0)
+            with profile_stage(profile, "percentile NF13", tave):
+                if not isinstance(tave, np.ma.core.MaskedArray):
+                    pct_calc = np.nanpercentile(tave, 95, axis=0)
 
-            else:
-                pct_calc = np.ones(tave.shape[1:], float) * const.missingval
-                for i in range(tave.shape[1]):
-                    for j in range(tave.shape[2]):
-                        aux = tave[:, i, j]
-                        if len(aux[~aux.mask].data) != 0:
-                            pct_calc[i, j] = np.nanpercentile(
-                                aux[~aux.mask].data, 95, axis=0
-                            )
+                else:
+                    # Masked values are turned into NaN once and left out of the percentile
+                    pct_calc = calc_nanpercentile(masked_to_nan(tave), 95, axis=0)
+                    pct_calc = pct_calc.astype(float)
+                    pct_calc[np.isnan(pct_calc)] = const.missingval
         else:
             print("Percentiles are retrieved from the thfile provided")
-            pct_file = nc.Dataset(thres_file, "r")
-            pct_calc = pct_file.variables["PRCTILE95"][:].astype("float")
+            with profile_stage(profile, "read thresholds"):
+                pct_file = nc.Dataset(thres_file, "r")
+                pct_calc = pct_file.variables["PRCTILE95"][:].astype("float")
 
     elif method == "PA13":
 
@@ -85,32 +176,35 @@ def calc_percentile(tave, nyears, thres_file=None, method="NF13", nwindow=15):
             windowrange[-int(np.floor(nwindow / 2)) :] = True
             if np.sum(windowrange) != nwindow:
                 raise SystemExit(0)
-            windowrange = np.tile(windowrange, nyears)
-            pct_calc = np.ones((365,) + tave.shape[1:], float) * const.missingval
 
-            if not isinstance(tave, np.ma.core.MaskedArray):
-                for d in range(365):
-                    pct_calc[d, :, :] = np.percentile(
-                        tave[windowrange == True, :, :], 90, axis=0
+            with profile_stage(profile, "percentile PA13", tave):
+                if not isinstance(tave, np.ma.core.MaskedArray):
+                    pct_calc = calc_percentile_doy(
+                        tave,
+                        nyears,
+                        90,
+                        nwindow=nwindow,
+                        chunk_size=chunk_size,
+                        tindex=tindex,
                     )
-                    windowrange = np.roll(windowrange, 1)
 
-            else:
-                for i in range(tave.shape[1]):
-                    for j in range(tave.shape[2]):
-                        for d in range(365):
-                            aux = tave[windowrange == True, :, :]
-                            if len(aux[~aux.mask].data) != 0:
-                                pct_calc[d, :, :] = np.percentile(
-                                    aux[~aux.mask].data, 90, axis=0
-                                )
-                            windowrange = np.roll(windowrange, 1)
+                else:
+                    # Masked values are turned into NaN once and left out of the percentiles
+                    pct_calc = calc_percentile_doy(
+                        masked_to_nan(tave),
+                        nyears,
+                        90,
+                        nwindow=nwindow,
+                        chunk_size=chunk_size,
+                        skipna=True,
+                    )
 
         else:
             print("Percentiles are retrieved from the thfile provided")
             # A percentile file is provided and it contains a PRCTILE90 variable
-            pct_file = nc.Dataset(thres_file, "r")
-            pct_calc = pct_file.variables["PRCTILE90"][:].astype("float")
+            with profile_stage(profile, "read thresholds"):
+                pct_file = nc.Dataset(thres_file, "r")
+                pct_calc = pct_file.variables["PRCTILE90"][:].astype("float")
 
     else:
         raise ValueError("Method not supported: Choose between NF13 or PA13")
@@ -118,6 +212,131 @@ def calc_percentile(tave, nyears, thres_file=None, method="NF13", nwindow=15):
     return pct_calc
 
 
+def calc_percentile_doy(
+    tave, nyears, percentile, nwindow=15, chunk_size=None, skipna=False, tindex=None
+):
+
+    """Function to calculate calendar day percentiles over a window centred on each day
+    tave: mean daily temperature over the base period without leap days (ndoy*nyears,lat,lon), where
+          ndoy is the number of calendar days per year (365, or 360 in 360_day calendars)
+    nyears: number of years in the base period
+    percentile: percentile to calculate (e.g. 90 in PA13 method)
+    nwindow: number of days in the window. The window of day d spans d-floor(nwindow/2) to d+ceil(nwindow/2)-1
+             and wraps around within each year
+    chunk_size: [OPTIONAL] number of gridpoints processed at once.
+                Default: as many as fit in percentile_chunk_bytes (64 MB), at least one
+    skipna: if True, NaN values are left out of the percentiles and calendar days without any valid
+            value are set to const.missingval
+    tindex: [OPTIONAL] days of tave in the base period (ndoy*nyears). Only the days and gridpoints of
+            each chunk are copied from tave. Default: all days of tave
+    ---
+    output: pct_calc (ndoy,lat,lon)
+
+    The base period is reshaped to (nyears,ndoy,gridpoints) and the windows of all calendar days are
+    taken as a strided view, so all thresholds of a chunk are obtained with a single np.percentile call.
+    np.percentile copies the windows and moves their axes, so the peak memory of each call is about
+    2*nwindow+2 times the size of the chunk (32 times for nwindow=15). Results do not depend on chunk_size.
+    """
+    nback = int(np.floor(nwindow / 2))
+    nahead = int(np.ceil(nwindow / 2))
+
+    if tindex is None:
+        ndoy = tave.shape[0] // nyears
+        tave_doy = tave.reshape((nyears, ndoy, -1))
+    else:
+        ndoy = len(tindex) // nyears
+        tave_days = tave.reshape((tave.shape[0], -1))
+    ngrid = int(np.prod(tave.shape[1:]))
+    if chunk_size is None:
+        point_bytes = (2 * nwindow + 2) * nyears * ndoy * tave.dtype.itemsize
+        chunk_size = max(1, percentile_chunk_bytes // point_bytes)
+
+    pct_calc = np.ones((ndoy, ngrid), float) * const.missingval
+
+    for gstart in range(0, ngrid, chunk_size):
+        if tindex is None:
+            aux = tave_doy[:, :, gstart : gstart + chunk_size]
+        else:
+            aux = tave_days[tindex, gstart : gstart + chunk_size]
+            aux = aux.reshape((nyears, ndoy, -1))
+        aux = np.concatenate(
+            (aux[:, ndoy - nback :, :], aux, aux[:, : nahead - 1, :]), axis=1
+        )
+        windows = np.lib.stride_tricks.sliding_window_view(aux, nwindow, axis=1)
+
+        if skipna:
+            windows = np.moveaxis(windows, 0, 2).reshape((ndoy, aux.shape[2], -1))
+            pct_chunk = calc_nanpercentile(windows, percentile, axis=2).astype(float)
+            pct_chunk[np.isnan(pct_chunk)] = const.missingval
+        else:
+            pct_chunk = np.percentile(windows, percentile, axis=(0, 3))
+
+        pct_calc[:, gstart : gstart + chunk_size] = pct_chunk
+
+    return pct_calc.reshape((ndoy,) + tave.shape[1:])
+
+
+def calc_nanpercentile(aux, percentile, axis=0):
+
+    """Function to calculate percentiles ignoring NaN along one axis without looping over gridpoints
+    aux: float array with NaN where data is missing
+    percentile: percentile to calculate
+    axis: axis along which the percentile is calculated
+    ---
+    output: pct_calc, NaN where there are no valid values
+
+    Same result as np.nanpercentile (linear interpolation) applied to each series,
+    which np.nanpercentile does one series at a time when there are NaN.
+    """
+    aux = np.sort(np.moveaxis(aux, axis, -1), axis=-1)
+    nvalid = np.sum(~np.isnan(aux), axis=-1)
+    return interpolate_percentile(aux, percentile, nvalid)
+
+
+def interpolate_percentile(aux, percentile, nvalid, offset=0):
+
+    """Function to interpolate the percentile of sorted series as np.percentile does (linear)
+    aux: series sorted along the last axis, with the valid values first
+    percentile: percentile to calculate
+    nvalid: number of valid values of each series
+    offset: [OPTIONAL] rank of the first value of aux in each series, when aux only keeps the
+            largest values of each series (e.g. threshold_builder.py)
+    ---
+    output: pct_calc, NaN where there are no valid values
+    """
+    index = (nvalid - 1) * (percentile / 100.0)
+    previous = np.floor(index).astype(int)
+    following = np.minimum(previous + 1, nvalid - 1)
+    gamma = index - previous
+
+    nkeep = aux.shape[-1]
+    previous = np.clip(previous - offset, 0, nkeep - 1)
+    following = np.clip(following - offset, 0, nkeep - 1)
+    lower = np.take_along_axis(aux, previous[..., None], axis=-1)[..., 0]
+    upper = np.take_along_axis(aux, following[..., None], axis=-1)[..., 0]
+    diff = upper - lower
+
+    pct_calc = lower + diff * gamma.astype(aux.dtype)
+    np.subtract(
+        upper, diff * (1 - gamma).astype(aux.dtype), out=pct_calc, where=gamma >= 0.5
+    )
+    pct_calc[nvalid == 0] = np.nan
+
+    return pct_calc
+
+
+def masked_to_nan(tave):
+
+    """Function to turn the masked values of a masked array into NaN
+    tave: masked array
+    ---
+    output: ndarray with NaN where tave was masked (float type)
+    """
+    if tave.dtype.kind != "f":
+        tave = tave.astype(float)
+    return np.ma.filled(tave, np.nan)
+
+
 def calc_spell(series):
 
     if isinstance(series, np.ma.core.MaskedArray):
@@ -150,6 +369,420 @@ def calc_spell(series):
     return spell_hw
 
 
+def calc_spell_segments(exceed, mask=None, min_length=3):
+
+    """Function to find all the spells in a (time,lat,lon) array at once
+    exceed: array with 1 where the day is above the threshold (e.g. EHF_exceed)
+    mask: [OPTIONAL] (lat,lon) array, spells are only searched where mask is 1
+    min_length: shortest spell that is retained (3 days for heatwaves)
+    ---
+    output: tstart, ilat, ilon, length of each spell, sorted by gridpoint and then time
+
+    Masked values interrupt spells, as in calc_spell.
+    """
+    if isinstance(exceed, np.ma.core.MaskedArray):
+        hot = np.ma.filled(exceed, 0) == 1
+    else:
+        hot = np.asarray(exceed) == 1
+
+    if mask is not None:
+        hot = hot & (np.asarray(mask) == 1)
+
+    # Time is moved to the last axis so that nonzero returns the starts and
+    # ends of each gridpoint sorted in time and they can be paired directly.
+    # Padding is int8 too, a plain 0 would turn edges into an int64 array
+    edges = np.diff(
+        np.moveaxis(hot, 0, -1).astype(np.int8),
+        axis=-1,
+        prepend=np.int8(0),
+        append=np.int8(0),
+    )
+    ilat, ilon, tstart = np.nonzero(edges == 1)
+    tend = np.nonzero(edges == -1)[-1]
+    length = tend - tstart
+
+    keep = length >= min_length
+    return tstart[keep], ilat[keep], ilon[keep], length[keep]
+
+
+def calc_spell_all(exceed, mask=None):
+
+    """Function to calculate the spells of a (time,lat,lon) array without looping over gridpoints
+    exceed: array with 1 where the day is above the threshold (e.g. EHF_exceed)
+    mask: [OPTIONAL] (lat,lon) array, spells are only calculated where mask is 1
+    ---
+    output: spell_all, length of the spell at its starting day and 0 elsewhere (same as calc_spell)
+    """
+    tstart, ilat, ilon, length = calc_spell_segments(exceed, mask)
+    spell_all = np.zeros(exceed.shape, dtype=int)
+    spell_all[tstart, ilat, ilon] = length
+    return spell_all
+
+
+def calc_spell_stats(var, tstart, ilat, ilon, length):
+
+    """Function to calculate the mean and maximum of a variable over each spell
+    var: (time,lat,lon) array (e.g. EHF or tave_3days)
+    tstart, ilat, ilon, length: spells as returned by calc_spell_segments
+    ---
+    output: spell_mean, spell_max (one value per spell)
+
+    Spells with the same length are gathered into a (nspells,length) block and
+    reduced together, so there is one call per distinct length instead of one per spell.
+    The block rows are reduced exactly as np.mean/np.max on each slice would do.
+    """
+    spell_mean = np.ones(length.shape, dtype=float) * const.missingval
+    spell_max = np.ones(length.shape, dtype=float) * const.missingval
+
+    for nlen in np.unique(length):
+        sel = np.nonzero(length == nlen)[0]
+        block = var[
+            tstart[sel, None] + np.arange(nlen),
+            ilat[sel, None],
+            ilon[sel, None],
+        ]
+        spell_mean[sel] = np.mean(block, axis=1)
+        spell_max[sel] = np.max(block, axis=1)
+
+    return spell_mean, spell_max
+
+
+def calc_rolling_mean(
+    var, nwindow, nlag=0, dtype=None, cumsum=False, out_dtype=float, tindex=None
+):
+
+    """Function to calculate the running mean of a (time,lat,lon) array in a single vectorized pass
+    var: (time,...) array (e.g. tave)
+    nwindow: number of days in the window
+    nlag: number of most recent days left out of the window
+          The mean at day t is calculated over var[t-nlag-nwindow+1 : t-nlag+1]
+    dtype: [OPTIONAL] type used to accumulate the window sums (e.g. np.float64). Default: type of var (native byte order)
+    cumsum: if True, window sums are obtained as differences of a cumulative sum, which costs the same
+            for any nwindow. Use a float64 dtype with this option to avoid drifting along long series.
+            Default is to add the nwindow shifted slabs, which gives the same values as np.mean over each window:
+            np.mean adds the days of a window one after another when there are several gridpoints.
+            For a single gridpoint, np.mean sums the window pairwise, so the windows are summed as
+            contiguous rows in that case to give the same values too.
+    out_dtype: type of the output. Default: float64
+    tindex: [OPTIONAL] days of var used as the time series (e.g. without leap days). They are read one
+            year at a time, so that var (e.g. memory-mapped) is never copied whole. Default: all days
+    ---
+    output: var_mean, (time,...) array of out_dtype. The first nwindow+nlag-1 days are zero.
+
+    Masked values are left out of the mean, as in np.ma.mean.
+    """
+    nfirst = nwindow + nlag - 1
+
+    if tindex is not None and not cumsum:
+        # Each year is calculated with the nfirst days before it, which gives the same sums
+        var_mean = np.zeros((len(tindex),) + var.shape[1:], dtype=out_dtype)
+        for bstart in range(nfirst, len(tindex), 365):
+            bend = min(bstart + 365, len(tindex))
+            block = calc_rolling_mean(
+                var[tindex[bstart - nfirst : bend]],
+                nwindow,
+                nlag,
+                dtype=dtype,
+                out_dtype=out_dtype,
+            )
+            var_mean[bstart:bend] = block[nfirst:]
+        return var_mean
+    elif tindex is not None:
+        var = var[tindex]
+
+    ndays = var.shape[0]
+    var_mean = np.zeros(var.shape, dtype=out_dtype)
+
+    if ndays <= nfirst:
+        return var_mean
+
+    # Non-native values (e.g. big-endian netCDF3) are summed in the native type
+    if dtype is None:
+        dtype = var.dtype.newbyteorder("=")
+
+    if isinstance(var, np.ma.core.MaskedArray):
+        valid = ~np.ma.getmaskarray(var)
+        var = np.ma.filled(var, 0)
+    else:
+        valid = None
+
+    if cumsum:
+        var_sum = np.cumsum(var, axis=0, dtype=dtype)
+        acc = var_sum[nfirst - nlag : ndays - nlag].copy()
+        acc[1:] -= var_sum[: ndays - nfirst - 1]
+        if valid is not None:
+            valid_sum = np.cumsum(valid, axis=0)
+            count = valid_sum[nfirst - nlag : ndays - nlag].copy()
+            count[1:] -= valid_sum[: ndays - nfirst - 1]
+    elif (
+        valid is None
+        and var[0].size == 1
+        and np.dtype(dtype) == var.dtype.newbyteorder("=")
+    ):
+        var = var.astype(dtype, copy=False)
+        windows = np.lib.stride_tricks.sliding_window_view(var, nwindow, axis=0)
+        acc = np.sum(windows[: ndays - nfirst], axis=-1)
+    else:
+        # Window sums are accumulated in the output if it has the type of the sums
+        if valid is None and np.dtype(dtype) == var_mean.dtype:
+            acc = var_mean[nfirst:]
+            acc[:] = var[: ndays - nfirst]
+        else:
+            acc = var[: ndays - nfirst].astype(dtype)
+        for k in range(1, nwindow):
+            acc += var[k : ndays - nfirst + k]
+        if valid is not None:
+            count = valid[: ndays - nfirst].astype(int)
+            for k in range(1, nwindow):
+                count += valid[k : ndays - nfirst + k]
+
+    if valid is None:
+        np.divide(acc, nwindow, out=var_mean[nfirst:])
+    else:
+        np.divide(acc, count, out=var_mean[nfirst:], where=count > 0)
+
+    return var_mean
+
+
+def calc_EHF(tave_3days, pct, method="NF13", tave_30days=None):
+
+    """Function to calculate the daily EHF index
+    tave_3days: (time,lat,lon) 3-day mean temperature
+    pct: thresholds, (lat,lon) for NF13 or (ndoy,lat,lon) for PA13, where ndoy is the number of
+         calendar days per year (365, or 360 in 360_day calendars)
+    method: NF13 or PA13
+    tave_30days: [OPTIONAL] (time,lat,lon) mean temperature of the previous 30 days (t-32 to t-3).
+                 If provided, EHF includes the acclimatisation term (EHFaccl).
+                 It is overwritten to avoid allocating another array.
+    ---
+    output: EHF (time,lat,lon), with negative values set to 0
+    """
+    ndays = tave_3days.shape[0]
+
+    if tave_30days is not None:
+        # EHF is calculated in place of tave_30days and EHIsig one year at a time,
+        # so no other (time,lat,lon) array is allocated
+        EHIaccl = np.subtract(tave_3days, tave_30days, out=tave_30days)
+        EHF = np.maximum(1, EHIaccl, out=EHIaccl)
+        for tstart in range(0, ndays, 365):
+            days = slice(tstart, min(tstart + 365, ndays))
+            if method == "PA13":
+                EHIsig = tave_3days[days] - pct[np.arange(days.start, days.stop) % len(pct)]
+            else:
+                EHIsig = tave_3days[days] - pct
+            EHF[days] *= EHIsig
+
+    ### CALCULATING EHIsig
+    elif method == "PA13":
+        EHF = np.zeros(tave_3days.shape, dtype=tave_3days.dtype)
+        for t in range(ndays):
+            EHF[t, :, :] = tave_3days[t, :, :] - pct[(t) % len(pct), :, :]
+    else:
+        EHF = tave_3days - pct
+    EHF[EHF < 0] = 0
+
+    return EHF
+
+
+def calc_yearly_metrics(
+    tstart,
+    ilat,
+    ilon,
+    length,
+    EHF_avg,
+    EHF_peak,
+    TMP3D_ave,
+    TMP3D_peak,
+    new_years,
+    syear,
+    nyears,
+    shape,
+):
+
+    """Function to calculate the yearly heatwave metrics from the heatwaves found by calc_spell_segments
+    tstart, ilat, ilon, length: heatwaves as returned by calc_spell_segments (sorted by gridpoint and then time)
+    EHF_avg, EHF_peak: mean and peak EHF of each heatwave (see calc_spell_stats)
+    TMP3D_ave, TMP3D_peak: mean and peak 3-day temperature of each heatwave
+    new_years: year each day belongs to (sorted, see month_starty in compute_EHF)
+    syear, nyears: first year and number of years
+    shape: (lat,lon) shape of the grid
+    ---
+    output: HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL (year,lat,lon)
+
+    Each heatwave is assigned to its starting year and the metrics are aggregated by calc_metrics_from_events.
+    """
+    year_list = np.arange(syear, syear + nyears)
+    ystart = np.searchsorted(new_years, year_list, side="left")
+    yend = np.searchsorted(new_years, year_list, side="right")
+
+    # Heatwaves starting before the first year (e.g. when month_starty > 1) are left out
+    year = new_years[tstart] - syear
+    year_day = tstart - ystart[np.maximum(year, 0)]
+
+    return calc_metrics_from_events(
+        year,
+        year_day,
+        ilat,
+        ilon,
+        length,
+        EHF_avg,
+        EHF_peak,
+        TMP3D_ave,
+        TMP3D_peak,
+        yend - ystart,
+        shape,
+    )
+
+
+def calc_metrics_from_events(
+    year,
+    year_day,
+    ilat,
+    ilon,
+    length,
+    EHF_avg,
+    EHF_peak,
+    TMP3D_ave,
+    TMP3D_peak,
+    ndays_year,
+    shape,
+):
+
+    """Function to calculate the yearly heatwave metrics from a list of heatwaves
+    year: year of each heatwave, counted from the first year (heatwaves with year < 0 are left out)
+    year_day: day of the year when each heatwave starts, counted from 0
+    ilat, ilon, length: gridpoint and length of each heatwave (sorted by gridpoint and then time)
+    EHF_avg, EHF_peak: mean and peak EHF of each heatwave (see calc_spell_stats)
+    TMP3D_ave, TMP3D_peak: mean and peak 3-day temperature of each heatwave
+    ndays_year: number of days of each year
+    shape: (lat,lon) shape of the grid
+    ---
+    output: HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL (year,lat,lon)
+
+    The statistics of each heatwave are accumulated into its year with ufunc.at, so no
+    (time,lat,lon) array is needed. The heatwaves of a gridpoint are added in order of occurrence,
+    which gives the same sums as adding the daily values of each year along time (numpy adds them
+    pairwise instead when there is a single gridpoint, which is reproduced separately).
+    The metrics are then derived from these yearly sums by calc_metrics_from_sums.
+    """
+    nyears = len(ndays_year)
+    keep = year >= 0
+    index = (year[keep], ilat[keep], ilon[keep])
+    shape = (nyears,) + tuple(shape)
+
+    def yearly_max(var):
+        var_max = np.full(shape, -np.inf)
+        np.maximum.at(var_max, index, var[keep])
+        return var_max
+
+    def yearly_sum(var):
+        var_sum = np.zeros(shape, dtype=float)
+        if shape[1:] == (1, 1):
+            # A single gridpoint is summed pairwise by np.sum over the days of each year
+            # (zero where no heatwave starts), as in previous versions
+            for yr in range(nyears):
+                var_daily = np.zeros((ndays_year[yr],), dtype=float)
+                var_daily[year_day[keep][index[0] == yr]] = var[keep][index[0] == yr]
+                var_sum[yr, 0, 0] = np.sum(var_daily)
+        else:
+            np.add.at(var_sum, index, var[keep])
+        return var_sum
+
+    nheatwaves = np.zeros(shape, dtype=int)
+    np.add.at(nheatwaves, index, 1)
+    nheatwave_days = np.zeros(shape, dtype=int)
+    np.add.at(nheatwave_days, index, length[keep])
+    longest = np.zeros(shape, dtype=int)
+    np.maximum.at(longest, index, length[keep])
+
+    # First heatwave day of each year, 0 if there is none
+    first = np.full(shape, np.iinfo(int).max)
+    np.minimum.at(first, index, year_day[keep])
+    first[nheatwaves == 0] = 0
+
+    return calc_metrics_from_sums(
+        yearly_max(EHF_peak),
+        yearly_max(TMP3D_peak),
+        yearly_sum(EHF_avg),
+        yearly_sum(TMP3D_ave),
+        nheatwaves,
+        nheatwave_days,
+        longest,
+        first,
+        np.asarray(ndays_year, dtype=float)[:, None, None],
+    )
+
+
+def calc_metrics_from_sums(
+    EHF_peak_max,
+    TMP3D_peak_max,
+    EHF_avg_sum,
+    TMP3D_ave_sum,
+    nheatwaves,
+    nheatwave_days,
+    longest,
+    first,
+    ndays_year,
+):
+
+    """Function to calculate the yearly heatwave metrics from yearly accumulated heatwave statistics
+    EHF_peak_max, TMP3D_peak_max: maximum of the peak EHF and 3-day temperature of the heatwaves (-inf if none)
+    EHF_avg_sum, TMP3D_ave_sum: sum of the mean EHF and 3-day temperature of the heatwaves, in order of occurrence
+    nheatwaves: number of heatwaves
+    nheatwave_days: number of heatwave days
+    longest: length of the longest heatwave
+    first: day of the year when the first heatwave starts (0 if none)
+    ndays_year: number of days in the year
+    ---
+    output: HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL
+    """
+    missing = nheatwaves == 0
+
+    HWA = EHF_peak_max.copy()
+    HWA[missing] = const.missingval
+
+    HWAt = TMP3D_peak_max - const.tkelvin
+    HWAt[missing] = const.missingval
+
+    # Years without heatwaves are set to 0 here and to const.missingval below
+    with np.errstate(invalid="ignore", divide="ignore"):
+        HWM = EHF_avg_sum * 1.0 / nheatwaves
+        HWMt = TMP3D_ave_sum * 1.0 / nheatwaves - const.tkelvin
+    HWM[missing] = 0.0
+    HWMt[missing] = 0.0
+
+    HWF = nheatwave_days * 100.0 / ndays_year
+    HWN = nheatwaves.astype(float)
+    HWD = longest.astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        HWL = nheatwave_days / HWN
+    HWT = first.astype(float)
+
+    HWT = np.ma.masked_equal(HWT, 0.0)
+    HWMt[HWMt == 0] = const.missingval
+    HWM[HWM == 0] = const.missingval
+    HWL[HWN == 0] = const.missingval
+    HWA[HWA == 0] = const.missingval
+    HWAt[HWAt == 0] = const.missingval
+
+    return HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL
+
+
+def scatter_cells(var, cells, shape, fill):
+
+    """Function to scatter the gridpoints gathered by compute_EHF (compress) back to the grid
+    var: (...,1,ngridpoints) array
+    cells: (ilat, ilon) of the gathered gridpoints
+    shape: (lat,lon) shape of the grid
+    fill: value of the gridpoints that were not gathered
+    ---
+    output: (...,lat,lon) array
+    """
+    var_grid = np.full(var.shape[:-2] + tuple(shape), fill, dtype=var.dtype)
+    var_grid[..., cells[0], cells[1]] = var[..., 0, :]
+    return var_grid
+
+
 def compute_EHF(
     tave,
     dates=None,
@@ -162,103 +795,329 @@ def compute_EHF(
     nwindow=15,
     EHFaccl=False,
     season="yearly",
+    pct=None,
+    thres_cache=None,
+    dtype=None,
+    profile=None,
+    pct_chunk_size=None,
+    compress=False,
+    ymd=None,
 ):
-    """Function to calculate Excess Heat Factor (EHF) heatwaves from tave calcualted as (tmax+tmin)/2."""
-    if mask == None:
-        mask = np.ones(tave.shape[1:], int)
-
-    # PERFORM SOME CHECKS
-    ## This is explicitly checked to preserve compatibility across versions
-    if (bsyear == None) or (beyear == None):
-        sys.exit(
-            "ERROR: you didn't provide base period years to compute_EHF function, please revise"
+    """Function to calculate Excess Heat Factor (EHF) heatwaves from tave calcualted as (tmax+tmin)/2.
+    pct: [OPTIONAL] previously calculated thresholds, as returned by calc_percentile. If provided,
+         neither thres_file nor the base period are used.
+    thres_cache: [OPTIONAL] threshold_cache.ThresholdCache where thresholds are reused from or stored,
+                 when no thres_file is provided
+    dtype: [OPTIONAL] floating type of the daily (time,lat,lon) arrays, e.g. np.float32 to reduce memory.
+           spell_all is then stored in the smallest integer type that holds the longest spell.
+           tave of another type is converted first (a copy), but not tave that only differs in
+           byte order (e.g. a big-endian netCDF3 memory map, see read_EHFinput.open_tave).
+           Default: float64, as in previous versions
+    profile: [OPTIONAL] StageProfile where the wall time, input size and memory of each stage are recorded
+    pct_chunk_size: [OPTIONAL] number of gridpoints of each chunk in the PA13 percentile calculation
+                    (chunk_size in calc_percentile). Default: bounded by percentile_chunk_bytes
+
+    compress: if True, only the gridpoints where mask is 1 are calculated: they are gathered into a
+              (time,1,ngridpoints) array that goes through all the steps and results are scattered back
+              to (lat,lon). Metrics are the same, pct and EHF are const.missingval where mask is 0.
+    ymd: [OPTIONAL] years, months and days of all dates, as returned by get_ymd, if they are already
+         known (e.g. when the same dates are used in several calls)
+
+    Leap days (PA13) and the base period are selected with indices or slices, so tave is not copied
+    and it can be memory-mapped (see read_EHFinput.py). It is only copied whole when dtype differs
+    from its type other than in byte order.
+    """
+    # A single gridpoint is summed pairwise by numpy (see get_tiles), so at least two are gathered
+    cells = None
+    if compress and mask is not None:
+        cells = np.nonzero(np.asarray(mask) == 1)
+        if len(cells[0]) < 2:
+            cells = None
+
+    kwargs = dict(
+        bsyear=bsyear,
+        beyear=beyear,
+        month_starty=month_starty,
+        method=method,
+        nwindow=nwindow,
+        EHFaccl=EHFaccl,
+        season=season,
+        thres_cache=thres_cache,
+        dtype=dtype,
+        profile=profile,
+        pct_chunk_size=pct_chunk_size,
+        ymd=ymd,
+    )
+    if cells is None:
+        hw = calc_heatwaves(
+            tave, dates, thres_file=thres_file, mask=mask, pct=pct, **kwargs
         )
+        ilat, ilon = hw["ilat"], hw["ilon"]
+    else:
+        if pct is None and thres_file is not None:
+            pct = calc_percentile(None, None, thres_file, method=method, profile=profile)
+        if pct is not None:
+            pct = np.asarray(pct)[..., cells[0], cells[1]][..., None, :]
+        hw = calc_heatwaves(
+            tave[:, cells[0], cells[1]][:, None, :], dates, pct=pct, **kwargs
+        )
+        # Heatwaves of each gathered gridpoint, which are still sorted by gridpoint
+        ilat, ilon = cells[0][hw["ilon"]], cells[1][hw["ilon"]]
+        for name, fill in (
+            ("pct", const.missingval),
+            ("EHF", const.missingval),
+            ("spell_all", 0),
+        ):
+            hw[name] = scatter_cells(hw[name], cells, tave.shape[1:], fill)
 
-    years_all = np.asarray([dates[i].year for i in range(len(dates))])
-    months_all = np.asarray([dates[i].month for i in range(len(dates))])
-    days_all = np.asarray([dates[i].day for i in range(len(dates))])
+    ### PULLING OUT HW CHARACTERISTICS
 
-    # If using PA13, leap days need to be removed
+    with profile_stage(profile, "yearly metrics", hw["length"]):
+        HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL = calc_yearly_metrics(
+            hw["tstart"],
+            ilat,
+            ilon,
+            hw["length"],
+            hw["EHF_avg"],
+            hw["EHF_peak"],
+            hw["TMP3D_ave"],
+            hw["TMP3D_peak"],
+            hw["new_years"],
+            hw["syear"],
+            hw["nyears"],
+            tave.shape[1:],
+        )
 
-    if method == "PA13":
+    return (
+        HWA,
+        HWM,
+        HWF,
+        HWN,
+        HWD,
+        HWT,
+        hw["pct"],
+        hw["EHF"],
+        HWMt,
+        HWAt,
+        hw["spell_all"],
+        HWL,
+    )
 
-        dates = dates[((months_all == 2) & (days_all == 29)) == False]
-        years = np.asarray([dates[i].year for i in range(len(dates))])
-        months = np.asarray([dates[i].month for i in range(len(dates))])
-        days = np.asarray([dates[i].day for i in range(len(dates))])
 
-        tave = tave[((months_all == 2) & (days_all == 29)) == False, :, :]
+def calc_dates(dates, method="NF13", month_starty=1, ymd=None):
 
+    """Function to get the dates of the days used by compute_EHF
+    dates: dates of each day (see calendars.py)
+    method: NF13 or PA13
+    month_starty: first month of each year
+    ymd: [OPTIONAL] years, months and days of all dates, as returned by get_ymd, if they are already known
+    ---
+    output: years, months, days, new_years, tindex
+            years, months, days: date of each day (without leap days in PA13)
+            new_years: year each day belongs to (see month_starty)
+            tindex: days of dates that are used, None if all of them
+    """
+    if ymd is None:
+        ymd = get_ymd(dates)
     else:
+        # Dates that are already known are copied, years are changed outside the season
+        ymd = tuple(np.array(var) for var in ymd)
+    years, months, days = ymd
 
-        years = np.asarray([dates[i].year for i in range(len(dates))])
-        months = np.asarray([dates[i].month for i in range(len(dates))])
-        days = np.asarray([dates[i].day for i in range(len(dates))])
+    # If using PA13, leap days need to be removed (Feb 29, see calendars.py)
+    tindex = None
+    if method == "PA13":
+        leap = calc_leap_days(months, days, get_calendar(dates))
+        if np.any(leap):
+            tindex = np.nonzero(~leap)[0]
+            years, months, days = years[tindex], months[tindex], days[tindex]
 
     # Specify when the year start
     # It is important to define seasons (e.g. Souther Hemisphere, month_starty should be in winter)
     new_years = years.copy()
     new_years[months < month_starty] -= 1
 
+    return years, months, days, new_years, tindex
+
+
+def calc_base_percentile(
+    tave,
+    years,
+    bsyear,
+    beyear,
+    thres_file=None,
+    method="NF13",
+    nwindow=15,
+    tindex=None,
+    thres_cache=None,
+    chunk_size=None,
+    profile=None,
+):
+
+    """Function to calculate the thresholds of the base period of tave
+    tave: (time,lat,lon) array
+    years: year of each day used (see calc_dates)
+    bsyear, beyear: first and last year of the base period
+    thres_file, method, nwindow, chunk_size, profile: same as calc_percentile
+    tindex: [OPTIONAL] days of tave that are used (see calc_dates)
+    thres_cache: [OPTIONAL] threshold_cache.ThresholdCache, when no thres_file is provided
+    ---
+    output: pct, same as calc_percentile
+    """
+    nbyears = beyear - bsyear + 1
+    base_index = np.nonzero((years >= bsyear) & (years <= beyear))[0]
+    if tindex is not None:
+        base_index = tindex[base_index]
+
+    # A contiguous base period is taken as a view, otherwise its days are read by index
+    if len(base_index) > 0 and np.all(np.diff(base_index) == 1):
+        tave_base = tave[base_index[0] : base_index[-1] + 1]
+        base_index = None
+    else:
+        tave_base = tave
+
+    pct = None
+    if thres_cache is not None and thres_file == None:
+        with profile_stage(profile, "threshold cache", tave_base):
+            key = thres_cache.get_key(
+                tave_base, bsyear, beyear, method, nwindow, tindex=base_index
+            )
+            pct = thres_cache.get(key)
+
+    if pct is None:
+        pct = calc_percentile(
+            tave_base,
+            nbyears,
+            thres_file,
+            method=method,
+            nwindow=nwindow,
+            chunk_size=chunk_size,
+            profile=profile,
+            tindex=base_index,
+        )
+        if thres_cache is not None and thres_file == None:
+            with profile_stage(profile, "threshold cache", tave_base):
+                thres_cache.put(key, pct, bsyear, beyear, method, nwindow)
+
+    return pct
+
+
+def calc_heatwaves(
+    tave,
+    dates=None,
+    thres_file=None,
+    bsyear=None,
+    beyear=None,
+    month_starty=1,
+    mask=None,
+    method="NF13",
+    nwindow=15,
+    EHFaccl=False,
+    season="yearly",
+    pct=None,
+    thres_cache=None,
+    dtype=None,
+    profile=None,
+    pct_chunk_size=None,
+    spells=True,
+    ymd=None,
+    tave_3days=None,
+    tave_30days=None,
+):
+    """Function to calculate the daily EHF index and the heatwaves of tave (all steps of compute_EHF
+    but the yearly metrics)
+    tave, dates...: same as compute_EHF
+    spells: if True, spell_all is also calculated
+    ymd: [OPTIONAL] years, months and days of all dates, as returned by get_ymd
+    tave_3days, tave_30days: [OPTIONAL] rolling means of tave (without leap days in PA13, see calc_rolling_mean)
+                             if they are already calculated. tave_30days is overwritten
+    ---
+    output: dictionary with
+            pct, EHF, spell_all: as in compute_EHF (spell_all is None if spells is False)
+            tstart, ilat, ilon, length: heatwaves, as returned by calc_spell_segments
+            EHF_avg, EHF_peak, TMP3D_ave, TMP3D_peak: statistics of each heatwave (see calc_spell_stats)
+            years, months, days: date of each day (without leap days in PA13)
+            new_years: year each day belongs to (see month_starty)
+            syear, nyears: first year and number of years
+    """
+    if mask is None:
+        mask = np.ones(tave.shape[1:], int)
+
+    # PERFORM SOME CHECKS
+    ## This is explicitly checked to preserve compatibility across versions
+    if pct is None and ((bsyear == None) or (beyear == None)):
+        sys.exit(
+            "ERROR: you didn't provide base period years to compute_EHF function, please revise"
+        )
+
+    # In the low memory mode all steps, percentiles included, work on tave of the given type.
+    # Values that only differ in byte order (e.g. big-endian netCDF3 memory maps) are not copied
+    # whole: percentiles and rolling means convert them chunk by chunk
+    lowmem = dtype is not None
+    if lowmem and tave.dtype.newbyteorder("=") != np.dtype(dtype):
+        tave = tave.astype(dtype)
+
+    with profile_stage(profile, "dates", tave):
+        years, months, days, new_years, tindex = calc_dates(
+            dates, method, month_starty, ymd
+        )
+    start_years = years.copy()
+
     syear = np.min(years)
     eyear = np.max(years)
     nyears = eyear - syear + 1
-    nbyears = beyear - bsyear + 1
 
     shift_pct = np.argmax(new_years == syear)
 
-    ndays = tave.shape[0]
-    nlat = tave.shape[1]
-    nlon = tave.shape[2]
+    ndays = len(years)
+    shape = (ndays,) + tave.shape[1:]
 
     # Calculate percentiles over the base period
-    pct = calc_percentile(
-        tave[(years >= bsyear) & (years <= beyear), :, :],
-        nbyears,
-        thres_file,
-        method=method,
-        nwindow=15,
-    )
+    if pct is None:
+        # In the low memory mode, percentiles of a chunk take at most the size of tave_base
+        if lowmem and pct_chunk_size is None:
+            pct_chunk_size = max(1, tave[0].size // (2 * nwindow + 2))
+
+        pct = calc_base_percentile(
+            tave,
+            years,
+            bsyear,
+            beyear,
+            thres_file,
+            method=method,
+            nwindow=nwindow,
+            tindex=tindex,
+            thres_cache=thres_cache,
+            chunk_size=pct_chunk_size,
+            profile=profile,
+        )
 
-    tave_3days = np.zeros(tave.shape, dtype=float)
+    if not lowmem:
+        dtype = float
+    else:
+        pct = np.asarray(pct).astype(dtype)
 
-    for t in range(2, ndays):
-        tave_3days[t, :, :] = np.mean(tave[t - 2 : t + 1, :, :], axis=0)
+    with profile_stage(profile, "rolling means", tave):
+        if tave_3days is None:
+            tave_3days = calc_rolling_mean(tave, 3, out_dtype=dtype, tindex=tindex)
 
-    if EHFaccl == True:
-        tave_30days = np.zeros(tave.shape, dtype=float)
-        for t in range(32, ndays):
-            tave_30days[t, :, :] = np.mean(tave[t - 32 : t - 2, :, :], axis=0)
+        if EHFaccl == True and tave_30days is None:
+            tave_30days = calc_rolling_mean(
+                tave, 30, nlag=3, out_dtype=dtype, tindex=tindex
+            )
 
             ###############################################
             ###############################################
-            ### CALCULATING EHIsig and EHIaccl (if required)
-
-    if method == "PA13":
-        EHIsig = np.zeros(tave.shape, dtype=float)
-        for t in range(ndays):
-            EHIsig[t, :, :] = tave_3days[t, :, :] - pct[(t) % 365, :, :]
-    else:
-        EHIsig = tave_3days - pct
-
-    if EHFaccl == True:
-        EHIaccl = tave_3days - tave_30days
+            ### CALCULATING EHF and EHF_Exceed
 
-    ###############################################
-    ###############################################
-    ## CALCULATING EHF and EHF_Exceed
-
-    if EHFaccl == True:
-        EHF = np.maximum(1, EHIaccl) * EHIsig
-    else:
-        EHF = EHIsig
-    EHF[EHF < 0] = 0
-
-    EHF_exceed = np.zeros(EHF.shape, dtype=int)
-    EHF_exceed[EHF > 0] = 1
+    with profile_stage(profile, "EHF", tave_3days):
+        if EHFaccl == True:
+            EHF = calc_EHF(tave_3days, pct, method, tave_30days)
+            del tave_30days
+        else:
+            EHF = calc_EHF(tave_3days, pct, method)
 
-    if EHFaccl == True:
-        del tave_30days, EHIaccl, EHIsig
+    EHF_exceed = EHF > 0
 
     ###### ZEROING DAYS NOT BELONGING TO SUMMER (SH: NOV,DEC,JAN,FEB,MAR; NH: MAY,JUN,JUL,AUG,SEP)
     ###### Originally used only in PA13 method
@@ -283,87 +1142,43 @@ def compute_EHF(
             "Season not supported: Choose between summer_sh, summer_nh or yearly"
         )
 
-        # Defining variables for heat wave and spell calculation
-    heatwave_EHF_avg = np.ones(tave.shape, dtype=float) * const.missingval
-    heatwave_EHF_peak = np.ones(tave.shape, dtype=float) * const.missingval
-    heatwave_TMP3D_peak = np.ones(tave.shape, dtype=float) * const.missingval 
-    heatwave_TMP3D_ave = np.ones(tave.shape, dtype=float) * const.missingval 
-    heatwave_EHF = np.zeros(tave.shape, dtype=bool)
-    spell_all = np.zeros(tave.shape, dtype=int)
-
-    for ilat in range(nlat):
-        for ilon in range(nlon):
-            if mask[ilat, ilon] == 1:
-                spell = calc_spell(EHF_exceed[:, ilat, ilon])
-
-                for t in range(ndays):
-                    if spell[t] != 0:
-                        heatwave_EHF_avg[t, ilat, ilon] = np.mean(
-                            EHF[t : t + spell[t], ilat, ilon]
-                        )
-                        heatwave_EHF_peak[t, ilat, ilon] = np.max(
-                            EHF[t : t + spell[t], ilat, ilon]
-                        )
-                        heatwave_TMP3D_peak[t, ilat, ilon] = np.max(
-                            tave_3days[t : t + spell[t], ilat, ilon]
-                        )                                               
-                        heatwave_TMP3D_ave[t, ilat, ilon] = np.mean(
-                            tave_3days[t : t + spell[t], ilat, ilon]
-                        )                                               
-                        heatwave_EHF[t : t + spell[t], ilat, ilon] = EHF_exceed[
-                            t : t + spell[t], ilat, ilon
-                        ]
-                        
-                
-                spell_all[:, ilat, ilon] = spell
-
-    ### PULLING OUT HW CHARACTERISTICS
+    # Heatwaves and their statistics are kept per heatwave, not as (time,lat,lon) arrays
+    with profile_stage(profile, "spell detection", EHF_exceed):
+        tstart, ilat, ilon, length = calc_spell_segments(EHF_exceed, mask)
+        del EHF_exceed
 
-    heatwave_EHF_avg = np.ma.masked_equal(heatwave_EHF_avg, const.missingval)
-    heatwave_EHF_peak = np.ma.masked_equal(heatwave_EHF_peak, const.missingval)
-
-    tave_peak_masked = np.ma.masked_equal(heatwave_TMP3D_peak, const.missingval) 
-    tave_avg_masked  = np.ma.masked_equal(heatwave_TMP3D_ave, const.missingval)  
-
-
-    HWA = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWM = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWN = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWF = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWD = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWT = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWMt = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWAt = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-    HWL = np.ones((nyears,) + tave.shape[1:], float) * const.missingval
-
-    for yr in range(nyears):
-        year = yr + syear
-        HWA[yr, :, :] = np.ma.max(heatwave_EHF_peak[new_years == year, :, :], axis=0)
-        HWM[yr, :, :] = np.ma.mean(heatwave_EHF_avg[new_years == year, :, :], axis=0)
-        HWF[yr, :, :] = (
-            np.sum(spell_all[new_years == year, :, :], axis=0)
-            * 100.0
-            / float(np.sum(new_years == year))
-        )
-        HWN[yr, :, :] = np.sum(spell_all[new_years == year, :, :] != 0, axis=0)
-        HWD[yr, :, :] = np.max(spell_all[new_years == year, :, :], axis=0)
-        HWL[yr, :, :] = (
-            np.ma.sum(spell_all[new_years == year, :, :], axis=0) / HWN[yr, :, :]
-        )
-        HWT[yr, :, :] = np.argmax(spell_all[new_years == year, :, :] != 0, axis=0)
-
-        HWAt[yr, :, :] = (
-            np.ma.max(tave_peak_masked[new_years == year, :, :], axis=0) - const.tkelvin
-        )
-        HWMt[yr, :, :] = (
-            np.ma.mean(tave_avg_masked[new_years == year, :, :], axis=0) - const.tkelvin
+        # Spell lengths are stored in the smallest integer type in the low memory mode
+        spell_all = None
+        if spells:
+            if not lowmem:
+                spell_dtype = int
+            else:
+                spell_dtype = np.min_scalar_type(np.max(length, initial=0))
+            spell_all = np.zeros(shape, dtype=spell_dtype)
+            spell_all[tstart, ilat, ilon] = length
+
+    with profile_stage(profile, "spell stats", length):
+        EHF_avg, EHF_peak = calc_spell_stats(EHF, tstart, ilat, ilon, length)
+        TMP3D_ave, TMP3D_peak = calc_spell_stats(
+            tave_3days, tstart, ilat, ilon, length
         )
 
-    HWT = np.ma.masked_equal(HWT, 0.0)
-    HWMt[HWMt == 0] = const.missingval
-    HWM[HWM == 0] = const.missingval
-    HWL[HWN == 0] = const.missingval
-    HWA[HWA == 0] = const.missingval
-    HWAt[HWAt == 0] = const.missingval
-
-    return HWA, HWM, HWF, HWN, HWD, HWT, pct, EHF, HWMt, HWAt, spell_all, HWL
+    return dict(
+        pct=pct,
+        EHF=EHF,
+        spell_all=spell_all,
+        tstart=tstart,
+        ilat=ilat,
+        ilon=ilon,
+        length=length,
+        EHF_avg=EHF_avg,
+        EHF_peak=EHF_peak,
+        TMP3D_ave=TMP3D_ave,
+        TMP3D_peak=TMP3D_peak,
+        years=start_years,
+        months=months,
+        days=days,
+        new_years=new_years,
+        syear=syear,
+        nyears=nyears,
+    )
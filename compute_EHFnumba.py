@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+""" compute_EHFnumba.py
+
+Compiled (numba) backend of compute_EHF that walks the time series of each gridpoint once.
+
+compute_EHF makes one pass over the (time,lat,lon) arrays for each step (rolling means,
+EHF, exceedances, spells, spell statistics...), and each step allocates a new daily array.
+compute_EHF_numba fuses all the steps after the thresholds: each block of neighbouring
+gridpoints (block_size) is read once, the 3-day and 30-day means and EHF of each day are
+calculated for the whole block, and then the heatwaves of each gridpoint are followed
+and added to the yearly accumulators as they end. Blocks are processed in parallel (numba
+prange, see NUMBA_NUM_THREADS), and the daily EHF index and spells are only stored with
+daily=True, so memory does not grow with the size of the grid.
+
+Sums are made in the same order as numpy does in compute_EHF (pairwise over the days of
+a heatwave, see pairwise_sum), so the results are the same as compute_EHF for float64 input.
+compute_EHF remains the reference implementation.
+"""
+
+import sys
+
+import numpy as np
+from numba import njit, prange
+from compute_EHFheatwaves import (
+    calc_dates,
+    calc_base_percentile,
+    calc_metrics_from_sums,
+)
+
+
+@njit
+def pairwise_sum(var, start, n):
+    """sum var[start:start+n] in the same order as numpy (pairwise summation in blocks of 8)"""
+    if n < 8:
+        res = var[start]
+        for k in range(1, n):
+            res += var[start + k]
+        return res
+    elif n <= 128:
+        r0 = var[start]
+        r1 = var[start + 1]
+        r2 = var[start + 2]
+        r3 = var[start + 3]
+        r4 = var[start + 4]
+        r5 = var[start + 5]
+        r6 = var[start + 6]
+        r7 = var[start + 7]
+        k = 8
+        while k < n - (n % 8):
+            r0 += var[start + k]
+            r1 += var[start + k + 1]
+            r2 += var[start + k + 2]
+            r3 += var[start + k + 3]
+            r4 += var[start + k + 4]
+            r5 += var[start + k + 5]
+            r6 += var[start + k + 6]
+            r7 += var[start + k + 7]
+            k += 8
+        res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        while k < n:
+            res += var[start + k]
+            k += 1
+        return res
+    n2 = n // 2
+    n2 -= n2 % 8
+    return pairwise_sum(var, start, n2) + pairwise_sum(var, start + n2, n - n2)
+
+
+# Number of neighbouring gridpoints (along longitude) calculated together by calc_EHF_kernel
+block_size = 16
+
+
+@njit
+def calc_window_sum(series, window_sum, tend, nwindow, single):
+    """sum the nwindow days ending at day tend of each gridpoint of series (day,gridpoint),
+    in the same order as calc_rolling_mean"""
+    if single:
+        # A single gridpoint is summed pairwise by calc_rolling_mean
+        window_sum[0] = pairwise_sum(series[:, 0], tend - nwindow + 1, nwindow)
+        return
+    ngrid = series.shape[1]
+    for k in range(ngrid):
+        window_sum[k] = series[tend - nwindow + 1, k]
+    for t in range(tend - nwindow + 2, tend + 1):
+        for k in range(ngrid):
+            window_sum[k] += series[t, k]
+
+
+@njit(parallel=True)
+def calc_EHF_kernel(
+    tave,
+    tindex,
+    pct,
+    in_season,
+    year,
+    ystart,
+    yend,
+    mask,
+    EHFaccl,
+    ndiv3,
+    ndiv30,
+    daily,
+    EHF,
+    spell_all,
+    EHF_peak_max,
+    TMP3D_peak_max,
+    EHF_avg_sum,
+    TMP3D_ave_sum,
+    nheatwaves,
+    nheatwave_days,
+    longest,
+    first,
+):
+    """calculate EHF, the heatwaves and their yearly accumulators of each block of gridpoints in a single pass"""
+    ndays = len(tindex)
+    nlat, nlon = tave.shape[1], tave.shape[2]
+    npct = pct.shape[0]
+    nyears = len(ystart)
+    single = nlat * nlon == 1
+
+    # Each block of neighbouring gridpoints is read day by day and calculated together,
+    # adding the days of each window in the same order as calc_rolling_mean
+    nblocks = (nlon + block_size - 1) // block_size
+    for block in prange(nlat * nblocks):
+        ilat = block // nblocks
+        lon0 = (block % nblocks) * block_size
+        ngrid = min(block_size, nlon - lon0)
+        if not daily and np.all(mask[ilat, lon0 : lon0 + ngrid] != 1):
+            continue
+
+        series = np.empty((ndays, ngrid), dtype=tave.dtype)
+        for t in range(ndays):
+            for k in range(ngrid):
+                series[t, k] = tave[tindex[t], ilat, lon0 + k]
+
+        window_sum = np.empty((ngrid,), dtype=tave.dtype)
+        block_3days = np.zeros((ndays, ngrid), dtype=np.float64)
+        block_EHF = np.zeros((ndays, ngrid), dtype=np.float64)
+        for t in range(ndays):
+            ipct = t % npct
+            if t >= 2:
+                calc_window_sum(series, window_sum, t, 3, single)
+                for k in range(ngrid):
+                    block_3days[t, k] = window_sum[k] / ndiv3
+            if EHFaccl:
+                if t >= 32:
+                    calc_window_sum(series, window_sum, t - 3, 30, single)
+                for k in range(ngrid):
+                    tave_30days = 0.0
+                    if t >= 32:
+                        tave_30days = np.float64(window_sum[k] / ndiv30)
+                    EHIaccl = block_3days[t, k] - tave_30days
+                    if EHIaccl < 1.0:
+                        EHIaccl = 1.0
+                    block_EHF[t, k] = EHIaccl * (
+                        block_3days[t, k] - pct[ipct, ilat, lon0 + k]
+                    )
+            else:
+                for k in range(ngrid):
+                    block_EHF[t, k] = block_3days[t, k] - pct[ipct, ilat, lon0 + k]
+            for k in range(ngrid):
+                if block_EHF[t, k] < 0:
+                    block_EHF[t, k] = 0.0
+                if daily:
+                    EHF[t, ilat, lon0 + k] = block_EHF[t, k]
+
+        # Heatwaves of each gridpoint, added to the year they start in as they end
+        for k in range(ngrid):
+            ilon = lon0 + k
+            if mask[ilat, ilon] != 1:
+                continue
+            EHF_day = block_EHF[:, k]
+            tave_3days = block_3days[:, k]
+            EHF_avg_day = np.zeros((ndays if single else 0,), dtype=np.float64)
+            TMP3D_ave_day = np.zeros((ndays if single else 0,), dtype=np.float64)
+
+            run_start = 0
+            run_length = 0
+            for t in range(ndays + 1):
+                if t < ndays and EHF_day[t] > 0 and in_season[t]:
+                    if run_length == 0:
+                        run_start = t
+                    run_length += 1
+                    continue
+                if run_length < 3:
+                    run_length = 0
+                    continue
+
+                if daily:
+                    spell_all[run_start, ilat, ilon] = run_length
+                yr = year[run_start]
+                if yr >= 0:
+                    run_end = run_start + run_length
+                    EHF_avg = pairwise_sum(EHF_day, run_start, run_length) / run_length
+                    TMP3D_ave = (
+                        pairwise_sum(tave_3days, run_start, run_length) / run_length
+                    )
+                    EHF_peak = np.max(EHF_day[run_start:run_end])
+                    TMP3D_peak = np.max(tave_3days[run_start:run_end])
+
+                    if nheatwaves[yr, ilat, ilon] == 0:
+                        first[yr, ilat, ilon] = run_start - ystart[yr]
+                    nheatwaves[yr, ilat, ilon] += 1
+                    nheatwave_days[yr, ilat, ilon] += run_length
+                    longest[yr, ilat, ilon] = max(longest[yr, ilat, ilon], run_length)
+                    EHF_peak_max[yr, ilat, ilon] = max(
+                        EHF_peak_max[yr, ilat, ilon], EHF_peak
+                    )
+                    TMP3D_peak_max[yr, ilat, ilon] = max(
+                        TMP3D_peak_max[yr, ilat, ilon], TMP3D_peak
+                    )
+                    if single:
+                        EHF_avg_day[run_start] = EHF_avg
+                        TMP3D_ave_day[run_start] = TMP3D_ave
+                    else:
+                        EHF_avg_sum[yr, ilat, ilon] += EHF_avg
+                        TMP3D_ave_sum[yr, ilat, ilon] += TMP3D_ave
+                run_length = 0
+
+            # A single gridpoint is summed pairwise over the days of each year (see calc_metrics_from_events)
+            if single:
+                for yr in range(nyears):
+                    if yend[yr] > ystart[yr]:
+                        EHF_avg_sum[yr, ilat, ilon] = pairwise_sum(
+                            EHF_avg_day, ystart[yr], yend[yr] - ystart[yr]
+                        )
+                        TMP3D_ave_sum[yr, ilat, ilon] = pairwise_sum(
+                            TMP3D_ave_day, ystart[yr], yend[yr] - ystart[yr]
+                        )
+
+
+def compute_EHF_numba(
+    tave,
+    dates=None,
+    thres_file=None,
+    bsyear=None,
+    beyear=None,
+    month_starty=1,
+    mask=None,
+    method="NF13",
+    nwindow=15,
+    EHFaccl=False,
+    season="yearly",
+    pct=None,
+    thres_cache=None,
+    daily=True,
+):
+
+    """Function to calculate Excess Heat Factor (EHF) heatwaves with the compiled backend
+    tave, dates, thres_file, bsyear, beyear, month_starty, mask, method, nwindow, EHFaccl, season, pct,
+    thres_cache: same as compute_EHF
+    daily: if True, the daily EHF index and spells are returned. Otherwise they are not stored and
+           EHF and spell_all are None
+    ---
+    output: same as compute_EHF
+
+    Thresholds are calculated as in compute_EHF (calc_percentile). tave must not have masked values, and
+    it is copied if it is not stored in the native byte order (e.g. memory-mapped netCDF3 files).
+    """
+    if mask is None:
+        mask = np.ones(tave.shape[1:], int)
+
+    ## This is explicitly checked to preserve compatibility across versions
+    if pct is None and ((bsyear == None) or (beyear == None)):
+        sys.exit(
+            "ERROR: you didn't provide base period years to compute_EHF function, please revise"
+        )
+    if np.ma.is_masked(tave):
+        raise ValueError("compute_EHF_numba does not support masked values: use compute_EHF")
+    tave = np.ma.getdata(tave)
+    if not tave.dtype.isnative:
+        tave = tave.astype(tave.dtype.newbyteorder("="))
+
+    years, months, days, new_years, tindex = calc_dates(dates, method, month_starty)
+    if tindex is None:
+        tindex = np.arange(len(years))
+    syear = np.min(years)
+    nyears = np.max(years) - syear + 1
+
+    if pct is None:
+        pct = calc_base_percentile(
+            tave,
+            years,
+            bsyear,
+            beyear,
+            thres_file,
+            method=method,
+            nwindow=nwindow,
+            tindex=tindex,
+            thres_cache=thres_cache,
+        )
+
+    if season == "summer_sh":
+        in_season = ~((months >= 4) & (months <= 10))
+    elif season == "summer_nh":
+        in_season = ~((months >= 10) | (months <= 4))
+    elif season == "yearly":
+        in_season = np.ones(months.shape, dtype=bool)
+    else:
+        raise ValueError(
+            "Season not supported: Choose between summer_sh, summer_nh or yearly"
+        )
+
+    year_list = np.arange(syear, syear + nyears)
+    ystart = np.searchsorted(new_years, year_list, side="left")
+    yend = np.searchsorted(new_years, year_list, side="right")
+
+    ndays = len(tindex)
+    shape = (nyears,) + tave.shape[1:]
+    if daily:
+        EHF = np.zeros((ndays,) + tave.shape[1:], dtype=float)
+        spell_all = np.zeros((ndays,) + tave.shape[1:], dtype=int)
+    else:
+        EHF = np.zeros((1, 1, 1), dtype=float)
+        spell_all = np.zeros((1, 1, 1), dtype=int)
+    EHF_peak_max = np.full(shape, -np.inf)
+    TMP3D_peak_max = np.full(shape, -np.inf)
+    EHF_avg_sum = np.zeros(shape, dtype=float)
+    TMP3D_ave_sum = np.zeros(shape, dtype=float)
+    nheatwaves = np.zeros(shape, dtype=int)
+    nheatwave_days = np.zeros(shape, dtype=int)
+    longest = np.zeros(shape, dtype=int)
+    first = np.zeros(shape, dtype=int)
+
+    calc_EHF_kernel(
+        tave,
+        tindex,
+        np.asarray(pct, dtype=float).reshape((-1,) + tave.shape[1:]),
+        in_season,
+        new_years - syear,
+        ystart,
+        yend,
+        np.asarray(mask),
+        bool(EHFaccl),
+        tave.dtype.type(3),
+        tave.dtype.type(30),
+        bool(daily),
+        EHF,
+        spell_all,
+        EHF_peak_max,
+        TMP3D_peak_max,
+        EHF_avg_sum,
+        TMP3D_ave_sum,
+        nheatwaves,
+        nheatwave_days,
+        longest,
+        first,
+    )
+
+    HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL = calc_metrics_from_sums(
+        EHF_peak_max,
+        TMP3D_peak_max,
+        EHF_avg_sum,
+        TMP3D_ave_sum,
+        nheatwaves,
+        nheatwave_days,
+        longest,
+        first,
+        np.asarray(yend - ystart, dtype=float)[:, None, None],
+    )
+
+    if not daily:
+        EHF = spell_all = None
+
+    return HWA, HWM, HWF, HWN, HWD, HWT, pct, EHF, HWMt, HWAt, spell_all, HWL
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+""" compute_EHFstations.py
+
+EHF heatwaves of station (or city point) time series given as a (time,station) array.
+
+Stations are placed along the longitude axis of a (time,1,station) array, so the
+percentiles, rolling means, EHF, heatwaves and yearly metrics of all the stations of a
+batch are calculated at once by the vectorized steps of compute_EHF.
+
+Each station can have its own valid period and missing days (NaN or masked values):
+missing days are left out of the percentiles, while the 3-day (and 30-day) means of the
+windows that include a missing day are NaN, so those days are never heatwave days and a
+missing day ends a heatwave instead of being bridged. Stations with too few
+valid days in the base period get no thresholds, and years with too few valid days get
+missing metrics (see min_valid). Metrics are returned as a table with one row per station
+and year.
+"""
+
+import numpy as np
+import pandas as pd
+from constants import const
+from compute_EHFheatwaves import (
+    calc_dates,
+    calc_rolling_mean,
+    calc_heatwaves,
+    calc_yearly_metrics,
+    metric_names,
+)
+from compute_EHFtiles import get_tiles
+
+
+def calc_valid_fraction(valid, new_years, syear, nyears):
+
+    """Function to calculate the fraction of valid days of each year
+    valid: (time,station) boolean array, True where the day is valid
+    new_years: year each day belongs to (see calc_dates)
+    syear, nyears: first year and number of years
+    ---
+    output: (year,station) array, NaN for years without any day
+    """
+    year_list = np.arange(syear, syear + nyears)
+    ystart = np.searchsorted(new_years, year_list, side="left")
+    yend = np.searchsorted(new_years, year_list, side="right")
+
+    # Cumulative count of valid days, so each year is a difference of two rows
+    count = np.zeros((valid.shape[0] + 1, valid.shape[1]), dtype=int)
+    np.cumsum(valid, axis=0, out=count[1:])
+    ndays = (yend - ystart)[:, None]
+    with np.errstate(invalid="ignore"):
+        return (count[yend] - count[ystart]) / np.where(ndays > 0, ndays, np.nan)
+
+
+def compute_EHF_stations(
+    tave,
+    dates,
+    bsyear=None,
+    beyear=None,
+    stations=None,
+    min_valid=0.8,
+    batch_size=5000,
+    pct=None,
+    **kwargs
+):
+
+    """Function to calculate EHF heatwave metrics of station time series
+    tave: (time,station) array with daily mean temperature, NaN (or masked) where missing
+    dates: dates of each day
+    bsyear, beyear: first and last year of the base period
+    stations: [OPTIONAL] names of the stations. Default: index of each station
+    min_valid: minimum fraction of valid days of the base period for thresholds to be calculated, and
+               of each year for its metrics to be calculated (NaN otherwise)
+    batch_size: number of stations calculated at once
+    pct: [OPTIONAL] previously calculated thresholds, (station,) for NF13 or (ndoy,station) for PA13
+    kwargs: any other argument of compute_EHF (method, EHFaccl, season, month_starty, nwindow, dtype...)
+    ---
+    output: metrics, pct
+            metrics: pd.DataFrame indexed by station and year, with HWA, HWM, HWF, HWN, HWD, HWT, HWL, HWAt,
+                     HWMt (NaN where missing) and the fraction of valid days of each year (valid)
+            pct: thresholds, (station,) for NF13 or (ndoy,station) for PA13, NaN where missing
+
+    Stations without missing days get the same results as compute_EHF over a (time,1,station) array.
+    compute_EHF leaves masked days out of the rolling means instead. A batch of a single station is
+    avoided (see get_tiles).
+    """
+    method = kwargs.get("method", "NF13")
+    nstations = tave.shape[1]
+    if stations is None:
+        stations = np.arange(nstations)
+
+    # Missing days are NaN, so the rolling means of the windows that include them are NaN
+    valid = ~np.ma.getmaskarray(tave)
+    values = np.ma.getdata(tave)
+    if values.dtype.kind != "f":
+        values = values.astype(float)
+    valid &= ~np.isnan(values)
+    values = np.where(valid, values, np.nan)
+
+    years, months, days, new_years, tindex = calc_dates(
+        dates, method, kwargs.get("month_starty", 1)
+    )
+    if tindex is not None:
+        valid = valid[tindex]
+    syear = np.min(years)
+    nyears = np.max(years) - syear + 1
+    valid_year = calc_valid_fraction(valid, new_years, syear, nyears)
+
+    if pct is None:
+        base = (years >= bsyear) & (years <= beyear)
+        base_ok = np.mean(valid[base], axis=0) >= min_valid
+    else:
+        pct = np.ma.filled(np.ma.masked_invalid(pct).astype(float), const.missingval)
+        base_ok = np.all(pct != const.missingval, axis=0)
+
+    metrics = dict((vname, np.zeros((nyears, nstations))) for vname in metric_names)
+    pct_out = None
+    for tlat, batch in get_tiles(1, nstations, (1, batch_size)):
+        mask = base_ok[None, batch].astype(int)
+        batch_values = values[:, None, batch]
+        batch_kwargs = dict(kwargs)
+        if pct is not None:
+            batch_kwargs["pct"] = pct[..., None, batch]
+
+        # Rolling means of the unmasked values, where NaN is not left out of the windows
+        out_dtype = kwargs.get("dtype") or float
+        batch_kwargs["tave_3days"] = calc_rolling_mean(
+            batch_values, 3, out_dtype=out_dtype, tindex=tindex
+        )
+        if kwargs.get("EHFaccl", False):
+            batch_kwargs["tave_30days"] = calc_rolling_mean(
+                batch_values, 30, nlag=3, out_dtype=out_dtype, tindex=tindex
+            )
+
+        hw = calc_heatwaves(
+            np.ma.masked_invalid(batch_values),
+            dates,
+            bsyear=bsyear,
+            beyear=beyear,
+            mask=mask,
+            spells=False,
+            **batch_kwargs
+        )
+        HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL = calc_yearly_metrics(
+            hw["tstart"],
+            hw["ilat"],
+            hw["ilon"],
+            hw["length"],
+            hw["EHF_avg"],
+            hw["EHF_peak"],
+            hw["TMP3D_ave"],
+            hw["TMP3D_peak"],
+            hw["new_years"],
+            hw["syear"],
+            hw["nyears"],
+            mask.shape,
+        )
+        result = dict(
+            HWA=HWA,
+            HWM=HWM,
+            HWF=HWF,
+            HWN=HWN,
+            HWD=HWD,
+            HWT=np.ma.masked_equal(np.ma.getdata(HWT), 0.0),
+            HWL=HWL,
+            HWAt=HWAt,
+            HWMt=HWMt,
+        )
+        for vname in metric_names:
+            var = np.ma.masked_equal(result[vname], const.missingval)
+            metrics[vname][:, batch] = np.ma.filled(var.astype(float), np.nan)[:, 0]
+
+        batch_pct = np.asarray(hw["pct"], dtype=float)[..., 0, :]
+        if pct_out is None:
+            pct_out = np.zeros(batch_pct.shape[:-1] + (nstations,))
+        pct_out[..., batch] = batch_pct
+        del hw
+
+    # Stations without thresholds and years with too few valid days are missing
+    pct_out[..., ~base_ok] = np.nan
+    pct_out[pct_out == const.missingval] = np.nan
+    missing = (valid_year < min_valid) | np.isnan(valid_year) | ~base_ok
+    for vname in metric_names:
+        metrics[vname][missing] = np.nan
+
+    index = pd.MultiIndex.from_product(
+        [stations, np.arange(syear, syear + nyears)], names=["station", "year"]
+    )
+    table = pd.DataFrame(
+        dict((vname, metrics[vname].T.ravel()) for vname in metric_names), index=index
+    )
+    table["valid"] = valid_year.T.ravel()
+    return table, pct_out
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+
+""" compute_EHFstream.py
+
+Incremental calculation of EHF heatwaves for operational (daily) updates.
+
+EHFStream keeps a small state for each gridpoint: the last 33 days of temperature
+(enough for the 3-day and 30-day means), the heatwave that is still going on (its start,
+length and daily EHF and 3-day temperature) and the accumulated statistics of each year
+(peaks, sums of the heatwave means, number and length of heatwaves...). New days are
+added with update(), which costs O(new days x gridpoints) instead of recalculating the
+whole record, and the state can be saved and restored between runs.
+
+Thresholds must be calculated beforehand (e.g. with calc_percentile over the base period).
+The outputs are the same as compute_EHF over the whole record received so far, called
+with the same thresholds (pct argument).
+"""
+
+import numpy as np
+from constants import const
+from compute_EHFheatwaves import calc_metrics_from_sums, calc_metrics_from_events
+from calendars import get_ymd, get_calendar, calc_leap_days
+
+
+accumulator_names = [
+    "EHF_peak_max",
+    "TMP3D_peak_max",
+    "EHF_avg_sum",
+    "TMP3D_ave_sum",
+    "nheatwaves",
+    "nheatwave_days",
+    "longest",
+    "first",
+]
+
+# Columns of the heatwaves kept on single gridpoint grids (see EHFStream)
+event_names = [
+    "year",
+    "year_day",
+    "length",
+    "EHF_avg",
+    "EHF_peak",
+    "TMP3D_ave",
+    "TMP3D_peak",
+]
+
+
+def calc_season_days(months, season):
+
+    """Function to find the days within the season where heatwaves are calculated (see compute_EHF)
+    months: month of each day
+    season: yearly, summer_sh or summer_nh
+    ---
+    output: boolean array, True for days within the season
+    """
+    if season == "summer_sh":
+        return ~((months >= 4) & (months <= 10))
+    elif season == "summer_nh":
+        return ~((months >= 10) | (months <= 4))
+    elif season == "yearly":
+        return np.ones(months.shape, dtype=bool)
+    else:
+        raise ValueError(
+            "Season not supported: Choose between summer_sh, summer_nh or yearly"
+        )
+
+
+class EHFStream(object):
+
+    """Incremental EHF heatwaves calculation
+    pct: thresholds as returned by calc_percentile, (lat,lon) for NF13 or (ndoy,lat,lon) for PA13
+    method, EHFaccl, season, month_starty, mask: same as compute_EHF
+
+    tave passed to update must be a plain (not masked) array and dates must follow the
+    previous update without gaps.
+
+    The daily EHF and 3-day temperature of the heatwaves going on are kept (run_EHF and
+    run_TMP3D, (days,lat,lon) float64) instead of a running sum and maximum: numpy averages
+    spells of 8 days or more pairwise, in an order that depends on their final length, so a
+    running sum would not give the same heatwave means as compute_EHF. The buffers grow by
+    doubling and cost 16 bytes per gridpoint and day of the longest heatwave going on (e.g.
+    about 0.5 GB on a 1000x1000 grid during a 30-day heatwave). They are shrunk back when the
+    heatwaves end and only the days in use are saved to the state file.
+
+    On a single gridpoint numpy sums the heatwave means of each year pairwise (see
+    calc_metrics_from_events), so the heatwaves are also kept (events, a few per year) and
+    the metrics are calculated from them by calc_metrics_from_events instead.
+    """
+
+    # Days of temperature kept: the 30-day window of day t spans t-32 to t-3
+    nhistory = 33
+
+    def __init__(
+        self,
+        pct,
+        method="NF13",
+        EHFaccl=False,
+        season="yearly",
+        month_starty=1,
+        mask=None,
+    ):
+        self.pct = np.asarray(pct, dtype=float)
+        self.method = method
+        self.EHFaccl = EHFaccl
+        self.season = season
+        self.month_starty = month_starty
+
+        shape = self.pct.shape[-2:]
+        if mask is None:
+            mask = np.ones(shape, int)
+        self.mask = np.asarray(mask) == 1
+
+        # Number of days received (without leap days in PA13) and years covered
+        self.ndays = 0
+        self.syear = -1
+        self.eyear = -1
+
+        self.history = np.zeros((self.nhistory,) + shape, dtype=float)
+
+        # Heatwave (or shorter spell) still going on at each gridpoint
+        self.run_length = np.zeros(shape, dtype=int)
+        self.run_start = np.zeros(shape, dtype=int)
+        self.run_year = np.zeros(shape, dtype=int)
+        self.run_EHF = np.zeros((8,) + shape, dtype=float)
+        self.run_TMP3D = np.zeros((8,) + shape, dtype=float)
+
+        # Yearly accumulators, one element per year from syear to eyear
+        self.ystart = np.zeros((0,), dtype=int)
+        self.ndays_year = np.zeros((0,), dtype=int)
+        self.acc = self.new_accumulators(0)
+        self.events = np.zeros((0, len(event_names)), dtype=float)
+
+    def new_accumulators(self, nyears):
+        """get empty yearly accumulators for nyears"""
+        shape = (nyears,) + self.pct.shape[-2:]
+        return dict(
+            EHF_peak_max=np.full(shape, -np.inf),
+            TMP3D_peak_max=np.full(shape, -np.inf),
+            EHF_avg_sum=np.zeros(shape, dtype=float),
+            TMP3D_ave_sum=np.zeros(shape, dtype=float),
+            nheatwaves=np.zeros(shape, dtype=int),
+            nheatwave_days=np.zeros(shape, dtype=int),
+            longest=np.zeros(shape, dtype=int),
+            first=np.zeros(shape, dtype=int),
+        )
+
+    def add_years(self, eyear):
+        """extend the yearly accumulators up to eyear"""
+        nnew = eyear - self.eyear
+        if nnew <= 0:
+            return
+        new = self.new_accumulators(nnew)
+        for name in accumulator_names:
+            self.acc[name] = np.concatenate((self.acc[name], new[name]), axis=0)
+        self.ystart = np.concatenate((self.ystart, -np.ones((nnew,), dtype=int)))
+        self.ndays_year = np.concatenate((self.ndays_year, np.zeros((nnew,), dtype=int)))
+        self.eyear = eyear
+
+    def resize_runs(self):
+        """resize the run buffers to the smallest power of two (8 days at least) that holds the runs going on"""
+        maxlen = np.max(self.run_length, initial=0)
+        nbuf = 8
+        while nbuf <= maxlen:
+            nbuf *= 2
+        for name in ("run_EHF", "run_TMP3D"):
+            var = getattr(self, name)
+            if var.shape[0] > nbuf:
+                setattr(self, name, var[:nbuf].copy())
+            elif var.shape[0] < nbuf:
+                pad = np.zeros((nbuf - var.shape[0],) + var.shape[1:], dtype=var.dtype)
+                setattr(self, name, np.concatenate((var, pad)))
+
+    def calc_day(self, tave):
+        """calculate EHF and the 3-day mean temperature of a new day (self.ndays)"""
+        t = self.ndays
+        self.history[t % self.nhistory] = tave
+
+        # Same operations as calc_rolling_mean, so that results are identical
+        tave_3days = np.zeros(tave.shape, dtype=float)
+        if t >= 2:
+            acc = self.history[(t - 2) % self.nhistory].copy()
+            for k in (t - 1, t):
+                acc += self.history[k % self.nhistory]
+            tave_3days[:] = acc / 3
+
+        if self.method == "PA13":
+            EHIsig = tave_3days - self.pct[t % len(self.pct), :, :]
+        else:
+            EHIsig = tave_3days - self.pct
+
+        if self.EHFaccl == True:
+            tave_30days = np.zeros(tave.shape, dtype=float)
+            if t >= 32:
+                # Summed along the first axis like the 30 days of a window in calc_rolling_mean
+                window = self.history[np.arange(t - 32, t - 2) % self.nhistory]
+                tave_30days[:] = np.sum(window, axis=0) / 30
+            EHF = np.maximum(1, tave_3days - tave_30days) * EHIsig
+        else:
+            EHF = EHIsig
+        EHF[EHF < 0] = 0
+
+        return EHF, tave_3days
+
+    def calc_run_stats(self, ilat, ilon):
+        """calculate mean and peak EHF and 3-day temperature of the runs going on at (ilat,ilon)"""
+        length = self.run_length[ilat, ilon]
+        stats = [np.zeros(length.shape, dtype=float) for k in range(4)]
+
+        # Runs of the same length are reduced together, as in calc_spell_stats
+        for nlen in np.unique(length):
+            sel = np.nonzero(length == nlen)[0]
+            for var, vmean, vmax in (
+                (self.run_EHF, stats[0], stats[1]),
+                (self.run_TMP3D, stats[2], stats[3]),
+            ):
+                block = np.ascontiguousarray(var[:nlen, ilat[sel], ilon[sel]].T)
+                vmean[sel] = np.mean(block, axis=1)
+                vmax[sel] = np.max(block, axis=1)
+
+        return stats
+
+    def accumulate_runs(self, acc, ilat, ilon):
+        """add the runs going on at (ilat,ilon) to the yearly accumulators acc if they are heatwaves
+        ---
+        output: (heatwaves,len(event_names)) array with the heatwaves added
+        """
+        length = self.run_length[ilat, ilon]
+        year = self.run_year[ilat, ilon]
+        keep = (length >= 3) & (year >= self.syear)
+        ilat, ilon, length = ilat[keep], ilon[keep], length[keep]
+        yr = year[keep] - self.syear
+
+        EHF_avg, EHF_peak, TMP3D_ave, TMP3D_peak = self.calc_run_stats(ilat, ilon)
+
+        acc["EHF_peak_max"][yr, ilat, ilon] = np.maximum(
+            acc["EHF_peak_max"][yr, ilat, ilon], EHF_peak
+        )
+        acc["TMP3D_peak_max"][yr, ilat, ilon] = np.maximum(
+            acc["TMP3D_peak_max"][yr, ilat, ilon], TMP3D_peak
+        )
+        acc["EHF_avg_sum"][yr, ilat, ilon] += EHF_avg
+        acc["TMP3D_ave_sum"][yr, ilat, ilon] += TMP3D_ave
+
+        first = acc["nheatwaves"][yr, ilat, ilon] == 0
+        acc["first"][yr[first], ilat[first], ilon[first]] = (
+            self.run_start[ilat[first], ilon[first]] - self.ystart[yr[first]]
+        )
+        acc["nheatwaves"][yr, ilat, ilon] += 1
+        acc["nheatwave_days"][yr, ilat, ilon] += length
+        acc["longest"][yr, ilat, ilon] = np.maximum(
+            acc["longest"][yr, ilat, ilon], length
+        )
+
+        year_day = self.run_start[ilat, ilon] - self.ystart[yr]
+        return np.stack(
+            (yr, year_day, length, EHF_avg, EHF_peak, TMP3D_ave, TMP3D_peak), axis=1
+        ).astype(float)
+
+    def report_runs(self, ilat, ilon, t0, spell, spell_prev):
+        """write the length of the runs going on at (ilat,ilon) at their starting day"""
+        length = self.run_length[ilat, ilon]
+        length = np.where(length >= 3, length, 0)
+        start = self.run_start[ilat, ilon]
+
+        new = start >= t0
+        spell[start[new] - t0, ilat[new], ilon[new]] = length[new]
+        spell_prev[ilat[~new], ilon[~new]] = length[~new]
+
+    def update(self, tave, dates):
+
+        """Function to add new days
+        tave: daily mean temperature of the new days (time,lat,lon)
+        dates: dates of the new days
+        ---
+        output: dictionary with
+                EHF: daily EHF index of the new days (without leap days in PA13)
+                spell: spell_all of the new days. Heatwaves still going on are given their length so far
+                spell_prev_start: day (counted from the first update) when the heatwave going on at the start
+                                  of this update started, -1 if none. Its length may have changed and
+                                  spell_all of previous updates must be corrected at that day
+                spell_prev_length: length of that heatwave (0 if shorter than 3 days)
+        """
+        years, months, days = get_ymd(dates)
+
+        # If using PA13, leap days need to be removed (Feb 29, see calendars.py)
+        if self.method == "PA13":
+            keep = ~calc_leap_days(months, days, get_calendar(dates))
+            tave, years, months = tave[keep, :, :], years[keep], months[keep]
+
+        if self.syear < 0:
+            self.syear = np.min(years)
+            self.eyear = self.syear - 1
+            self.history = self.history.astype(tave.dtype)
+        self.add_years(np.max(years))
+
+        new_years = years.copy()
+        new_years[months < self.month_starty] -= 1
+        season_days = calc_season_days(months, self.season)
+
+        t0 = self.ndays
+        ndays = tave.shape[0]
+        EHF_new = np.zeros(tave.shape, dtype=float)
+        spell = np.zeros(tave.shape, dtype=int)
+        spell_prev = np.zeros(self.mask.shape, dtype=int)
+        spell_prev_start = np.where(self.run_length > 0, self.run_start, -1)
+
+        for i in range(ndays):
+            t = self.ndays
+            EHF, tave_3days = self.calc_day(tave[i])
+            EHF_new[i] = EHF
+
+            yr = new_years[i] - self.syear
+            if yr >= 0:
+                if self.ystart[yr] < 0:
+                    self.ystart[yr] = t
+                self.ndays_year[yr] += 1
+
+            exceed = (EHF > 0) & self.mask & season_days[i]
+
+            # Runs that end today
+            ilat, ilon = np.nonzero(~exceed & (self.run_length > 0))
+            if len(ilat) > 0:
+                self.report_runs(ilat, ilon, t0, spell, spell_prev)
+                events = self.accumulate_runs(self.acc, ilat, ilon)
+                if self.mask.shape == (1, 1):
+                    self.events = np.concatenate((self.events, events))
+                self.run_length[ilat, ilon] = 0
+
+            # Runs that start or continue today
+            starting = exceed & (self.run_length == 0)
+            self.run_start[starting] = t
+            self.run_year[starting] = new_years[i]
+
+            if np.max(self.run_length) >= self.run_EHF.shape[0]:
+                self.run_EHF = np.concatenate((self.run_EHF, np.zeros_like(self.run_EHF)))
+                self.run_TMP3D = np.concatenate(
+                    (self.run_TMP3D, np.zeros_like(self.run_TMP3D))
+                )
+            ilat, ilon = np.nonzero(exceed)
+            length = self.run_length[ilat, ilon]
+            self.run_EHF[length, ilat, ilon] = EHF[ilat, ilon]
+            self.run_TMP3D[length, ilat, ilon] = tave_3days[ilat, ilon]
+            self.run_length[ilat, ilon] += 1
+
+            self.ndays += 1
+
+        # Runs still going on are reported with their length so far
+        ilat, ilon = np.nonzero(self.run_length > 0)
+        self.report_runs(ilat, ilon, t0, spell, spell_prev)
+        self.resize_runs()
+
+        return dict(
+            EHF=EHF_new,
+            spell=spell,
+            spell_prev_start=spell_prev_start,
+            spell_prev_length=spell_prev,
+        )
+
+    def get_metrics(self):
+
+        """Function to get the yearly metrics of all the days received so far
+        ---
+        output: HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL (year,lat,lon), as in compute_EHF.
+                Heatwaves still going on are included with their length so far.
+        """
+        acc = {name: var.copy() for name, var in self.acc.items()}
+        ilat, ilon = np.nonzero(self.run_length > 0)
+        events = self.accumulate_runs(acc, ilat, ilon)
+
+        if self.mask.shape == (1, 1):
+            events = np.concatenate((self.events, events))
+            index = np.zeros((len(events),), dtype=int)
+            return calc_metrics_from_events(
+                events[:, 0].astype(int),
+                events[:, 1].astype(int),
+                index,
+                index,
+                events[:, 2].astype(int),
+                events[:, 3],
+                events[:, 4],
+                events[:, 5],
+                events[:, 6],
+                self.ndays_year,
+                self.mask.shape,
+            )
+
+        return calc_metrics_from_sums(
+            acc["EHF_peak_max"],
+            acc["TMP3D_peak_max"],
+            acc["EHF_avg_sum"],
+            acc["TMP3D_ave_sum"],
+            acc["nheatwaves"],
+            acc["nheatwave_days"],
+            acc["longest"],
+            acc["first"],
+            self.ndays_year.astype(float)[:, None, None],
+        )
+
+    def save(self, filename):
+        """save the state to a .npz file"""
+        state = dict(
+            pct=self.pct,
+            method=self.method,
+            EHFaccl=self.EHFaccl,
+            season=self.season,
+            month_starty=self.month_starty,
+            mask=self.mask,
+            ndays=self.ndays,
+            syear=self.syear,
+            eyear=self.eyear,
+            history=self.history,
+            run_length=self.run_length,
+            run_start=self.run_start,
+            run_year=self.run_year,
+            run_EHF=self.run_EHF[: np.max(self.run_length, initial=0)],
+            run_TMP3D=self.run_TMP3D[: np.max(self.run_length, initial=0)],
+            ystart=self.ystart,
+            ndays_year=self.ndays_year,
+            events=self.events,
+        )
+        for name in accumulator_names:
+            state["acc_" + name] = self.acc[name]
+        np.savez(filename, **state)
+
+    @classmethod
+    def load(cls, filename):
+        """restore a state saved with save"""
+        state = np.load(filename)
+        stream = cls(
+            state["pct"],
+            method=str(state["method"]),
+            EHFaccl=bool(state["EHFaccl"]),
+            season=str(state["season"]),
+            month_starty=int(state["month_starty"]),
+            mask=state["mask"].astype(int),
+        )
+        for name in ("ndays", "syear", "eyear"):
+            setattr(stream, name, int(state[name]))
+        for name in (
+            "history",
+            "run_length",
+            "run_start",
+            "run_year",
+            "run_EHF",
+            "run_TMP3D",
+            "ystart",
+            "ndays_year",
+            "events",
+        ):
+            setattr(stream, name, state[name])
+        stream.acc = {name: state["acc_" + name] for name in accumulator_names}
+        stream.resize_runs()
+        return stream
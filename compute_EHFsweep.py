@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+""" compute_EHFsweep.py
+
+EHF heatwave metrics of several configurations (method, nwindow, EHFaccl, season and
+month_starty) of the same temperature in a single run, for sensitivity studies.
+
+Running compute_EHF once per configuration decomposes the dates and calculates the
+rolling means and thresholds again in each run. compute_EHF_sweep calculates them once
+and shares them: the dates are decomposed once, the 3-day and 30-day means once per
+method (leap days are removed in PA13) and the thresholds once per method and nwindow.
+Only the EHF index, heatwaves and metrics are calculated for each configuration, with
+the same results as compute_EHF.
+"""
+
+import numpy as np
+import xarray as xr
+from constants import const
+import HWvariables_info as hwv
+from calendars import get_ymd
+from compute_EHFheatwaves import (
+    calc_dates,
+    calc_base_percentile,
+    calc_rolling_mean,
+    calc_heatwaves,
+    calc_yearly_metrics,
+    metric_names,
+)
+
+
+# Options that can change between configurations and their default values in compute_EHF
+config_defaults = dict(
+    method="NF13", nwindow=15, EHFaccl=False, season="yearly", month_starty=1
+)
+
+
+def get_configs(configs):
+
+    """Function to complete the configurations of a sweep with the default options
+    configs: list of dictionaries with some of the options of config_defaults
+    ---
+    output: list of dictionaries with all the options of config_defaults
+    """
+    output = []
+    for config in configs:
+        unknown = set(config) - set(config_defaults)
+        if unknown:
+            raise ValueError(
+                "Options not supported in a sweep: %s. Choose between %s"
+                % (", ".join(sorted(unknown)), ", ".join(config_defaults))
+            )
+        output.append(dict(config_defaults, **config))
+    return output
+
+
+def compute_EHF_sweep(
+    tave,
+    dates,
+    configs,
+    bsyear,
+    beyear,
+    mask=None,
+    thres_cache=None,
+    dims=("lat", "lon"),
+):
+
+    """Function to calculate EHF heatwave metrics of several configurations
+    tave: (time,lat,lon) array with daily mean temperature
+    dates: dates of each day
+    configs: list of dictionaries with the options of each configuration (method, nwindow, EHFaccl, season,
+             month_starty). Options that are not given take the default value of compute_EHF
+    bsyear, beyear: first and last year of the base period
+    mask: [OPTIONAL] (lat,lon) array with mask where EHF wont be calculated (see compute_EHF)
+    thres_cache: [OPTIONAL] threshold_cache.ThresholdCache where thresholds are reused from or stored
+    dims: names of the spatial dimensions of the output
+    ---
+    output: xr.Dataset with HWA, HWM, HWF, HWN, HWD, HWT, HWL, HWAt and HWMt (config,year,lat,lon),
+            NaN where missing. The options of each configuration are stored as coordinates along config
+
+    The rolling means of one method are kept in memory while its configurations are calculated
+    (two (time,lat,lon) arrays with EHFaccl).
+    """
+    configs = get_configs(configs)
+    ymd = get_ymd(dates)
+    year = np.arange(np.min(ymd[0]), np.max(ymd[0]) + 1)
+
+    shape = (len(configs), len(year)) + tave.shape[1:]
+    metrics = dict((vname, np.zeros(shape, dtype=float)) for vname in metric_names)
+
+    for method in dict.fromkeys(config["method"] for config in configs):
+        method_configs = [k for k, config in enumerate(configs) if config["method"] == method]
+        years, months, days, new_years, tindex = calc_dates(dates, method, ymd=ymd)
+
+        tave_3days = calc_rolling_mean(tave, 3, tindex=tindex)
+        tave_30days = None
+        if any(configs[k]["EHFaccl"] for k in method_configs):
+            tave_30days = calc_rolling_mean(tave, 30, nlag=3, tindex=tindex)
+
+        pcts = {}
+        for k in method_configs:
+            config = configs[k]
+            if config["nwindow"] not in pcts:
+                pcts[config["nwindow"]] = calc_base_percentile(
+                    tave,
+                    years,
+                    bsyear,
+                    beyear,
+                    method=method,
+                    nwindow=config["nwindow"],
+                    tindex=tindex,
+                    thres_cache=thres_cache,
+                )
+
+            # tave_30days is overwritten by calc_EHF, so each configuration takes a copy
+            hw = calc_heatwaves(
+                tave,
+                dates,
+                mask=mask,
+                pct=pcts[config["nwindow"]],
+                spells=False,
+                ymd=ymd,
+                tave_3days=tave_3days,
+                tave_30days=tave_30days.copy() if config["EHFaccl"] else None,
+                **config
+            )
+            HWA, HWM, HWF, HWN, HWD, HWT, HWMt, HWAt, HWL = calc_yearly_metrics(
+                hw["tstart"],
+                hw["ilat"],
+                hw["ilon"],
+                hw["length"],
+                hw["EHF_avg"],
+                hw["EHF_peak"],
+                hw["TMP3D_ave"],
+                hw["TMP3D_peak"],
+                hw["new_years"],
+                hw["syear"],
+                hw["nyears"],
+                tave.shape[1:],
+            )
+            del hw
+
+            result = dict(
+                HWA=HWA,
+                HWM=HWM,
+                HWF=HWF,
+                HWN=HWN,
+                HWD=HWD,
+                HWT=HWT,
+                HWL=HWL,
+                HWAt=HWAt,
+                HWMt=HWMt,
+            )
+            for vname in metric_names:
+                var = np.ma.masked_equal(result[vname], const.missingval)
+                metrics[vname][k] = np.ma.filled(var, np.nan)
+
+        del tave_3days, tave_30days
+
+    varinfo = hwv.VariablesInfo()
+    fout = xr.Dataset(coords={"config": np.arange(len(configs)), "year": year})
+    for name in config_defaults:
+        fout.coords[name] = ("config", [config[name] for config in configs])
+    for vname in metric_names:
+        fout[vname] = (("config", "year") + tuple(dims), metrics[vname])
+        fout[vname].attrs = {
+            "long_name": varinfo.get_varatt(vname, "Longname"),
+            "units": varinfo.get_varatt(vname, "units"),
+            "description": varinfo.get_varatt(vname, "description"),
+        }
+        fout[vname].encoding["_FillValue"] = const.missingval
+
+    return fout
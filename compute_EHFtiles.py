@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+""" compute_EHFtiles.py
+
+Tiled driver for compute_EHF on domains that do not fit in memory.
+
+All the steps of compute_EHF (percentiles, EHF, spells and yearly metrics) are
+independent for each gridpoint. The domain is thus split in spatial tiles that are
+read one at a time from the input netCDF file, processed with compute_EHF and
+written straight into the output file by write_EHFoutput.EHFWriter (compressed and
+chunked, see output_options), so that the peak memory depends on the tile size and
+not on the size of the domain.
+
+Tiles can be calculated by a pool of processes (n_workers). compute_EHF_parallel does the
+same for an array already in memory, which is shared with the workers through shared memory.
+
+Output variables are the yearly metrics (HWA, HWM, HWF, HWN, HWD, HWT, HWL, HWAt, HWMt),
+the thresholds (PRCTILE95 for NF13, PRCTILE90 for PA13, so the output can be used as
+thres_file in later runs) and, optionally, the daily EHF index and spells.
+"""
+
+import netCDF4 as nc
+import numpy as np
+import concurrent.futures
+from multiprocessing import shared_memory
+import os
+from compute_EHFheatwaves import compute_EHF
+from write_EHFoutput import EHFWriter
+
+
+# State of the process calculating tiles (see init_tile_worker)
+tile_worker = {}
+
+
+def get_tiles(nlat, nlon, tile_size):
+
+    """Function to split a (lat,lon) domain in tiles
+    nlat, nlon: size of the domain
+    tile_size: number of gridpoints in each direction of the tile. Either an integer or (ny,nx)
+    ---
+    output: list of (lat slice, lon slice)
+
+    Tiles of a single gridpoint are avoided (unless the domain is a single gridpoint): numpy sums
+    the days of a single gridpoint pairwise (see calc_rolling_mean), so such a tile would not give
+    exactly the same results as the whole domain. A remainder of one gridpoint in both directions
+    is thus added to the previous tile.
+    """
+    if np.isscalar(tile_size):
+        tile_size = (tile_size, tile_size)
+    # Tiles are cut to the domain, e.g. (1,3) tiles of a (3,1) domain are single gridpoints
+    ny, nx = min(tile_size[0], nlat), min(tile_size[1], nlon)
+    if ny == 1 and nx == 1:
+        if nlon > 1:
+            nx = 2
+        else:
+            ny = 2
+
+    lat_slices = get_tile_slices(nlat, ny)
+    lon_slices = get_tile_slices(nlon, nx)
+    if nlat * nlon > 1 and lat_slices[-1].stop - lat_slices[-1].start == 1:
+        if lon_slices[-1].stop - lon_slices[-1].start == 1:
+            if len(lon_slices) > 1 and nx > 1:
+                lon_slices[-2:] = [slice(lon_slices[-2].start, nlon)]
+            else:
+                lat_slices[-2:] = [slice(lat_slices[-2].start, nlat)]
+
+    tiles = []
+    for slat in lat_slices:
+        for slon in lon_slices:
+            tiles.append((slat, slon))
+    return tiles
+
+
+def get_tile_slices(npoints, size):
+
+    """Function to split one dimension in slices of a given size"""
+    starts = list(range(0, npoints, size))
+    ends = starts[1:] + [npoints]
+    return [slice(start, end) for start, end in zip(starts, ends)]
+
+
+def read_dates(fin, timename="time"):
+
+    """Function to read the dates of a netCDF file as datetime or cftime objects"""
+    time = fin.variables[timename]
+    calendar = getattr(time, "calendar", "standard")
+    dates = nc.num2date(
+        time[:], time.units, calendar=calendar, only_use_cftime_datetimes=False
+    )
+    return np.asarray(dates), time.units, calendar
+
+
+def create_output(
+    outfile, fin, varname, dates, units, calendar, method, daily, **kwargs
+):
+
+    """Function to create the output file with all variables preallocated (see write_EHFoutput.EHFWriter)
+    outfile: output file
+    fin: input netCDF4 Dataset (spatial coordinates, e.g. lat and lon, are copied from it)
+    varname: name of the temperature variable
+    dates, units, calendar: dates of each day of the input and units and calendar of its time coordinate
+    method: NF13 or PA13
+    daily: if True, the daily EHF index and spells are also written out
+    kwargs: any other argument of EHFWriter (compression, complevel, layout, chunk_bytes, pack...)
+    ---
+    output: EHFWriter open for writing
+    """
+    tas = fin.variables[varname]
+    ydim, xdim = tas.dimensions[1:]
+
+    # Copy the spatial coordinates (e.g. lat, lon) of the input file
+    coords = {}
+    for vname, var in fin.variables.items():
+        if vname != varname and len(var.dimensions) > 0:
+            if set(var.dimensions) <= set((ydim, xdim)):
+                atts = {att: var.getncattr(att) for att in var.ncattrs()}
+                coords[vname] = (var.dimensions, var[:], atts)
+
+    return EHFWriter(
+        outfile,
+        dates,
+        tas.shape[1:],
+        method=method,
+        dims=(ydim, xdim),
+        coords=coords,
+        daily=daily,
+        pct_units=tas.units if "units" in tas.ncattrs() else "",
+        time_units=units,
+        calendar=calendar,
+        **kwargs
+    )
+
+
+def init_tile_worker(
+    dates, kwargs, infile=None, varname=None, shared=None, thres_file=None
+):
+
+    """Function to prepare a process (or the main one) to calculate tiles
+    dates, kwargs: dates and arguments passed to compute_EHF
+    infile, varname: netCDF file and variable the tiles are read from
+    shared: (name, shape, dtype, mask name) of the shared memory block the tiles are read from
+    thres_file: [OPTIONAL] file that contains previously calculated percentiles
+
+    Input data is never sent to the workers: each of them opens the netCDF files or attaches
+    to the shared memory and reads only the tiles it calculates.
+    """
+    tile_worker.clear()
+    tile_worker["dates"] = dates
+    tile_worker["kwargs"] = kwargs
+
+    if infile is not None:
+        tile_worker["fin"] = nc.Dataset(infile, "r")
+        tile_worker["tas"] = tile_worker["fin"].variables[varname]
+        tile_worker["tas_mask"] = None
+    else:
+        name, shape, dtype, mask_name = shared
+        tile_worker["shm"] = shared_memory.SharedMemory(name=name)
+        tile_worker["tas"] = np.ndarray(shape, dtype, buffer=tile_worker["shm"].buf)
+        if mask_name is not None:
+            tile_worker["shm_mask"] = shared_memory.SharedMemory(name=mask_name)
+            tile_worker["tas_mask"] = np.ndarray(
+                shape, bool, buffer=tile_worker["shm_mask"].buf
+            )
+        else:
+            tile_worker["tas_mask"] = None
+
+    if thres_file is not None:
+        tile_worker["pct_file"] = nc.Dataset(thres_file, "r")
+        if kwargs.get("method", "NF13") == "PA13":
+            tile_worker["pct"] = tile_worker["pct_file"].variables["PRCTILE90"]
+        else:
+            tile_worker["pct"] = tile_worker["pct_file"].variables["PRCTILE95"]
+
+
+def close_tile_worker():
+
+    """Function to release the files and shared memory opened by init_tile_worker"""
+    for key in ("fin", "pct_file", "shm", "shm_mask"):
+        if key in tile_worker:
+            tile_worker[key].close()
+    tile_worker.clear()
+
+
+def compute_EHF_tile(tlat, tlon, mask=None, pct=None):
+
+    """Function to calculate compute_EHF over one tile in a process prepared with init_tile_worker
+    tlat, tlon: slices of the tile
+    mask, pct: [OPTIONAL] mask and thresholds of the tile
+    ---
+    output: same as compute_EHF, with the data of HWT instead of the masked array
+    """
+    tave = tile_worker["tas"][:, tlat, tlon]
+    if tile_worker["tas_mask"] is not None:
+        tave = np.ma.masked_array(tave, tile_worker["tas_mask"][:, tlat, tlon])
+    elif not np.ma.is_masked(tave):
+        # netCDF4 returns masked arrays even if there are no missing values
+        tave = np.ma.getdata(tave)
+
+    kwargs = dict(tile_worker["kwargs"])
+    if "pct" in tile_worker:
+        pct = tile_worker["pct"][..., tlat, tlon].astype("float")
+    if pct is not None:
+        kwargs["pct"] = pct
+    if mask is not None:
+        kwargs["mask"] = mask
+
+    result = list(compute_EHF(tave, tile_worker["dates"], **kwargs))
+    result[5] = np.ma.getdata(result[5])
+    return result
+
+
+def run_tiles(tiles, n_workers, initargs, mask=None, pct=None):
+
+    """Function to calculate compute_EHF over a list of tiles, in parallel if n_workers > 1
+    tiles: list of (lat slice, lon slice)
+    n_workers: number of processes
+    initargs: arguments passed to init_tile_worker
+    mask, pct: [OPTIONAL] mask and thresholds of the whole domain
+    ---
+    output: generator of (tile, compute_EHF output of the tile)
+    """
+    tasks = []
+    for tlat, tlon in tiles:
+        mask_tile = None if mask is None else mask[tlat, tlon]
+        pct_tile = None if pct is None else pct[..., tlat, tlon]
+        tasks.append((tlat, tlon, mask_tile, pct_tile))
+
+    if n_workers == 1:
+        init_tile_worker(*initargs)
+        try:
+            for task in tasks:
+                yield task[:2], compute_EHF_tile(*task)
+        finally:
+            close_tile_worker()
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers, initializer=init_tile_worker, initargs=initargs
+        ) as executor:
+            futures = [executor.submit(compute_EHF_tile, *task) for task in tasks]
+            for task, future in zip(tasks, futures):
+                yield task[:2], future.result()
+
+
+def compute_EHF_tiles(
+    infile,
+    outfile,
+    varname="tas",
+    tile_size=100,
+    daily=False,
+    mask=None,
+    thres_file=None,
+    n_workers=1,
+    output_options=None,
+    **kwargs
+):
+
+    """Function to calculate EHF heatwaves tile by tile from a netCDF file
+    infile: netCDF file with daily mean temperature (time,lat,lon)
+    outfile: netCDF file where the heatwave metrics are written
+    varname: name of the temperature variable in infile
+    tile_size: number of gridpoints in each direction of the tiles. Either an integer or (ny,nx)
+    daily: if True, the daily EHF index and spells are also written out
+    mask: [OPTIONAL] (lat,lon) array with mask where EHF wont be calculated (see compute_EHF)
+    thres_file: [OPTIONAL] file that contains previously calculated percentiles (see compute_EHF)
+    n_workers: number of processes that calculate tiles in parallel. Each of them reads its own tiles
+               from infile, results are written by the main process
+    output_options: [OPTIONAL] dictionary of arguments of write_EHFoutput.EHFWriter (compression, complevel,
+                    layout, chunk_bytes, pack...). Default: zlib compression, balanced chunks
+    kwargs: any other argument of compute_EHF (bsyear, beyear, method, EHFaccl...)
+    ---
+    output: None, results are written in outfile
+    """
+    method = kwargs.get("method", "NF13")
+
+    fin = nc.Dataset(infile, "r")
+    tas = fin.variables[varname]
+    dates, units, calendar = read_dates(fin, tas.dimensions[0])
+
+    # Leap days are removed from the EHF index in PA13 method (see EHFWriter)
+    fout = create_output(
+        outfile,
+        fin,
+        varname,
+        dates,
+        units,
+        calendar,
+        method,
+        daily,
+        **(output_options or {})
+    )
+
+    tiles = get_tiles(tas.shape[1], tas.shape[2], tile_size)
+    initargs = (dates, kwargs, infile, varname, None, thres_file)
+
+    for (tlat, tlon), result in run_tiles(tiles, n_workers, initargs, mask=mask):
+        fout.write_tile(tlat, tlon, result)
+
+    fout.close()
+    fin.close()
+
+
+def compute_EHF_parallel(
+    tave, dates, n_workers=None, tile_size=100, mask=None, thres_file=None, **kwargs
+):
+
+    """Function to calculate compute_EHF in parallel over spatial tiles of an array in memory
+    tave, dates: same as compute_EHF
+    n_workers: number of processes. Default: number of CPUs
+    tile_size: number of gridpoints in each direction of the tiles. Either an integer or (ny,nx)
+    mask, thres_file: same as compute_EHF
+    kwargs: any other argument of compute_EHF (bsyear, beyear, method, EHFaccl, pct...)
+    ---
+    output: same as compute_EHF
+
+    tave is copied once into shared memory, which all workers read their tiles from,
+    so the input is not pickled for each tile. Results are the same as compute_EHF.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    pct = kwargs.pop("pct", None)
+    nlat, nlon = tave.shape[1:]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(tave.nbytes, 1))
+    shm_mask = None
+    try:
+        np.ndarray(tave.shape, tave.dtype, buffer=shm.buf)[:] = np.ma.getdata(tave)
+        if isinstance(tave, np.ma.core.MaskedArray):
+            shm_mask = shared_memory.SharedMemory(create=True, size=tave.size)
+            np.ndarray(tave.shape, bool, buffer=shm_mask.buf)[:] = np.ma.getmaskarray(
+                tave
+            )
+
+        shared = (
+            shm.name,
+            tave.shape,
+            tave.dtype,
+            None if shm_mask is None else shm_mask.name,
+        )
+        initargs = (dates, kwargs, None, None, shared, thres_file)
+        tiles = get_tiles(nlat, nlon, tile_size)
+
+        output = None
+        for (tlat, tlon), result in run_tiles(
+            tiles, n_workers, initargs, mask=mask, pct=pct
+        ):
+            if output is None:
+                output = [
+                    np.zeros(var.shape[:-2] + (nlat, nlon), dtype=var.dtype)
+                    for var in result
+                ]
+            for ivar, var_tile in enumerate(result):
+                # Spells of other tiles may need a wider type (see dtype in compute_EHF)
+                if not np.can_cast(var_tile.dtype, output[ivar].dtype):
+                    output[ivar] = output[ivar].astype(
+                        np.promote_types(output[ivar].dtype, var_tile.dtype)
+                    )
+                output[ivar][..., tlat, tlon] = np.ma.getdata(var_tile)
+
+    finally:
+        shm.close()
+        shm.unlink()
+        if shm_mask is not None:
+            shm_mask.close()
+            shm_mask.unlink()
+
+    output[5] = np.ma.masked_equal(output[5], 0.0)
+    return tuple(output)
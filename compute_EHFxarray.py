@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+""" compute_EHFxarray.py
+
+xarray front end of compute_EHF that works on lazy (dask) DataArrays.
+
+compute_EHF is applied to each spatial chunk of the temperature DataArray with
+xr.apply_ufunc(..., dask="parallelized"). Chunks keep the whole time dimension,
+because all steps need the complete series of each gridpoint, so large files can be
+processed out of memory on a dask cluster. The yearly metrics are returned as an
+xr.Dataset with the attributes of HWvariables_info.VariablesInfo.
+"""
+
+import numpy as np
+import xarray as xr
+from constants import const
+import HWvariables_info as hwv
+from compute_EHFheatwaves import compute_EHF, metric_names
+from calendars import get_ymd
+
+
+def compute_EHF_block(tave, mask=None, pct=None, dates=None, kwargs=None):
+
+    """Function to calculate the yearly metrics of one block passed by xr.apply_ufunc
+    tave: (lat,lon,time) block, time is the last (core) dimension
+    mask: [OPTIONAL] (lat,lon) block of the mask
+    pct: [OPTIONAL] (lat,lon) or (lat,lon,doy) block of the thresholds
+    dates, kwargs: dates and other arguments passed to compute_EHF
+    ---
+    output: tuple of (lat,lon,year) metrics in the order of metric_names, NaN where missing
+    """
+    kwargs = dict(kwargs)
+    if mask is not None:
+        kwargs["mask"] = mask
+    if pct is not None:
+        kwargs["pct"] = np.moveaxis(pct, -1, 0) if pct.ndim == 3 else pct
+
+    (
+        HWA,
+        HWM,
+        HWF,
+        HWN,
+        HWD,
+        HWT,
+        pct,
+        EHF,
+        HWMt,
+        HWAt,
+        spell,
+        HWL,
+    ) = compute_EHF(np.moveaxis(tave, -1, 0), dates, **kwargs)
+
+    metrics = dict(
+        HWA=HWA,
+        HWM=HWM,
+        HWF=HWF,
+        HWN=HWN,
+        HWD=HWD,
+        HWT=HWT,
+        HWL=HWL,
+        HWAt=HWAt,
+        HWMt=HWMt,
+    )
+    output = []
+    for vname in metric_names:
+        var = np.ma.filled(np.ma.masked_equal(metrics[vname], const.missingval), np.nan)
+        output.append(np.moveaxis(var.astype(float), 0, -1))
+    return tuple(output)
+
+
+def compute_EHF_xr(da, mask=None, pct=None, chunks=None, time_dim="time", **kwargs):
+
+    """Function to calculate EHF heatwave metrics from a (lazy) xarray DataArray
+    da: DataArray with daily mean temperature (time,lat,lon), optionally chunked with dask
+    mask: [OPTIONAL] (lat,lon) DataArray with mask where EHF wont be calculated (see compute_EHF)
+    pct: [OPTIONAL] DataArray with previously calculated thresholds, (lat,lon) for NF13 or (doy,lat,lon) for PA13
+    chunks: [OPTIONAL] dictionary with the chunk sizes of the spatial dimensions. Default: keep the chunks of da
+    time_dim: name of the time dimension
+    kwargs: any other argument of compute_EHF (bsyear, beyear, method, EHFaccl...)
+    ---
+    output: xr.Dataset with HWA, HWM, HWF, HWN, HWD, HWT, HWL, HWAt and HWMt (year,lat,lon)
+
+    The computation is lazy if da is chunked; call .compute() or .to_netcdf() on the output.
+    """
+    if "thres_file" in kwargs:
+        raise ValueError(
+            "thres_file is not supported by compute_EHF_xr: read the thresholds and pass them as pct"
+        )
+
+    # Time must be in a single chunk, all steps need the whole series of each gridpoint
+    rechunk = {time_dim: -1}
+    if chunks is not None:
+        rechunk.update(chunks)
+    da = da.chunk(rechunk)
+
+    dates = da.indexes[time_dim]
+    years = get_ymd(dates)[0]
+    year = np.arange(np.min(years), np.max(years) + 1)
+
+    args = [da]
+    input_core_dims = [[time_dim]]
+    block_kwargs = dict(dates=dates, kwargs=kwargs)
+
+    def func(tave, *extra):
+        extra = list(extra)
+        block_mask = extra.pop(0) if mask is not None else None
+        block_pct = extra.pop(0) if pct is not None else None
+        return compute_EHF_block(tave, block_mask, block_pct, **block_kwargs)
+
+    if mask is not None:
+        args.append(mask)
+        input_core_dims.append([])
+    if pct is not None:
+        args.append(pct)
+        input_core_dims.append([dim for dim in pct.dims if dim not in da.dims])
+
+    output = xr.apply_ufunc(
+        func,
+        *args,
+        input_core_dims=input_core_dims,
+        output_core_dims=[["year"]] * len(metric_names),
+        dask="parallelized",
+        output_dtypes=[float] * len(metric_names),
+        dask_gufunc_kwargs={"output_sizes": {"year": len(year)}},
+    )
+
+    varinfo = hwv.VariablesInfo()
+    fout = xr.Dataset(coords={"year": year})
+    for vname, var in zip(metric_names, output):
+        var = var.transpose("year", ...)
+        var.attrs = {
+            "long_name": varinfo.get_varatt(vname, "Longname"),
+            "units": varinfo.get_varatt(vname, "units"),
+            "description": varinfo.get_varatt(vname, "description"),
+        }
+        var.encoding["_FillValue"] = const.missingval
+        fout[vname] = var
+
+    return fout
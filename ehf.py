@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+""" ehf.py
+
+Command line driver of compute_EHF for batches of models or members.
+
+usage: python ehf.py run --input 'tas_ACCESS_*.nc' 'tas_CNRM_*.nc' --base 1961 1990 --method PA13
+                         [--varname tas] [--EHFaccl] [--season yearly] [--month-starty 1] [--nwindow 15]
+                         [--thres-file FILE] [--thres-cache DIR] [--mask-file FILE] [--mask-var mask]
+                         [--daily] [--dtype float32] [--complevel 4] [--outdir .] [--names ACCESS CNRM]
+                         [--tile-size 100] [--workers 2]
+
+Each --input pattern is one model or member. All its files are opened together as a single
+lazy dataset with xr.open_mfdataset, so a member split in several files is read only once.
+Temperature is read and processed in spatial tiles of --tile-size gridpoints (see compute_EHFtiles),
+and the results of each tile are written as soon as they are calculated, so only one tile of input
+and output is in memory at a time.
+Members are processed concurrently by a pool of --workers processes, and each of them writes
+its own output files:
+    <outdir>/EHF_metrics_<name>.nc: yearly metrics and thresholds (can be used as thres_file)
+    <outdir>/EHF_index_<name>.nc: daily EHF index and spells (only with --daily)
+Output files are written by write_EHFoutput.EHFWriter: variables take their attributes from
+HWvariables_info.VariablesInfo and are compressed (zlib, --complevel) and chunked so that maps and
+time series are read with about the same number of chunks. The time coordinate keeps the units
+and calendar of the input.
+"""
+
+import argparse
+import concurrent.futures
+import glob as glob
+import multiprocessing
+import os
+import sys
+
+import xarray as xr
+from compute_EHFheatwaves import compute_EHF
+from compute_EHFtiles import get_tiles
+from threshold_cache import ThresholdCache
+from write_EHFoutput import EHFWriter
+
+
+def get_member_name(pattern):
+
+    """Function to get the name of a member from its input pattern (e.g. tas_ACCESS_*.nc -> tas_ACCESS)"""
+    name = os.path.splitext(os.path.basename(pattern))[0]
+    for char in "*?[]":
+        name = name.replace(char, "")
+    return name.strip("_-.") or "member"
+
+
+def open_member(pattern, varname="tas"):
+
+    """Function to open all the files of a member as a single lazy dataset
+    pattern: glob pattern (or file name) of the input files
+    varname: name of the temperature variable
+    ---
+    output: xr.Dataset
+    """
+    files = sorted(glob.glob(pattern))
+    if len(files) == 0:
+        raise ValueError("No input files match %s" % (pattern))
+    return xr.open_mfdataset(
+        files, combine="by_coords", data_vars=[varname], chunks={}
+    )
+
+
+def get_coords(fin, varname):
+
+    """Function to get the spatial coordinates (e.g. lat, lon) of the input dataset
+    fin: input dataset
+    varname: name of the temperature variable
+    ---
+    output: dictionary name: (dims, values, attrs), as taken by EHFWriter
+    """
+    ydim, xdim = fin[varname].dims[1:]
+    coords = {}
+    for vname, var in fin.variables.items():
+        if vname != varname and len(var.dims) > 0 and set(var.dims) <= set((ydim, xdim)):
+            coords[vname] = (var.dims, var.values, dict(var.attrs))
+    return coords
+
+
+def run_member(pattern, name, options):
+
+    """Function to calculate and write the EHF heatwaves of one member
+    pattern: glob pattern of the input files
+    name: name of the member, used in the output file names
+    options: dictionary with the command line options
+    ---
+    output: list of files written
+    """
+    varname = options["varname"]
+    method = options["method"]
+
+    fin = open_member(pattern, varname)
+    tdim = fin[varname].dims[0]
+    dates = fin.indexes[tdim]
+
+    mask = None
+    if options["mask_file"] is not None:
+        with xr.open_dataset(options["mask_file"]) as fmask:
+            mask = fmask[options["mask_var"]].values
+
+    # Thresholds are read once and passed to each tile
+    pct = None
+    if options["thres_file"] is not None:
+        pct_name = "PRCTILE90" if method == "PA13" else "PRCTILE95"
+        with xr.open_dataset(options["thres_file"], mask_and_scale=False) as fpct:
+            pct = fpct[pct_name].values.astype("float")
+
+    thres_cache = None
+    if options["thres_cache"] is not None:
+        thres_cache = ThresholdCache(options["thres_cache"])
+
+    kwargs = dict(
+        bsyear=options["base"][0],
+        beyear=options["base"][1],
+        month_starty=options["month_starty"],
+        method=method,
+        nwindow=options["nwindow"],
+        EHFaccl=options["EHFaccl"],
+        season=options["season"],
+        thres_cache=thres_cache,
+        dtype=options["dtype"],
+        pct_chunk_size=options["pct_chunk_size"],
+    )
+
+    # Each tile is written as soon as it is calculated (see write_EHFoutput.EHFWriter)
+    ydim, xdim = fin[varname].dims[1:]
+    writer_kwargs = dict(
+        method=method,
+        dims=(ydim, xdim),
+        coords=get_coords(fin, varname),
+        compression="zlib",
+        complevel=options["complevel"],
+        pct_units=fin[varname].attrs.get("units", ""),
+        time_units=fin[tdim].encoding.get("units"),
+        calendar=fin[tdim].encoding.get("calendar"),
+    )
+    nlat, nlon = fin[varname].shape[1:]
+    written = [os.path.join(options["outdir"], "EHF_metrics_%s.nc" % (name))]
+    writers = [
+        EHFWriter(written[0], dates, (nlat, nlon), daily=False, **writer_kwargs)
+    ]
+    if options["daily"]:
+        written.append(os.path.join(options["outdir"], "EHF_index_%s.nc" % (name)))
+        writers.append(
+            EHFWriter(written[1], dates, (nlat, nlon), metrics=False, **writer_kwargs)
+        )
+
+    for tlat, tlon in get_tiles(nlat, nlon, options["tile_size"]):
+        tave = fin[varname][:, tlat, tlon].values
+        if mask is not None:
+            kwargs["mask"] = mask[tlat, tlon]
+        if pct is not None:
+            kwargs["pct"] = pct[..., tlat, tlon]
+        result_tile = compute_EHF(tave, dates, **kwargs)
+        for writer in writers:
+            writer.write_tile(tlat, tlon, result_tile)
+
+    for writer in writers:
+        writer.close()
+    fin.close()
+    return written
+
+
+def run(args):
+
+    """Function to run the members given in the command line, concurrently if args.workers > 1"""
+    if args.names is None:
+        names = [get_member_name(pattern) for pattern in args.input]
+    else:
+        names = args.names
+    if len(names) != len(args.input) or len(set(names)) != len(names):
+        raise ValueError("Each input needs a different name (see --names)")
+
+    options = dict(vars(args))
+    os.makedirs(args.outdir, exist_ok=True)
+
+    if args.workers == 1:
+        for pattern, name in zip(args.input, names):
+            for outfile in run_member(pattern, name, options):
+                print("Written %s" % (outfile))
+    else:
+        # Workers are spawned, forking after xarray/dask started their threads may deadlock
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(run_member, pattern, name, options)
+                for pattern, name in zip(args.input, names)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                for outfile in future.result():
+                    print("Written %s" % (outfile))
+
+
+def get_parser():
+    """get the parser of the command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="ehf", description="Excess Heat Factor (EHF) heatwaves"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prun = subparsers.add_parser(
+        "run", help="calculate heatwave metrics of a list of models or members"
+    )
+    prun.add_argument(
+        "--input",
+        nargs="+",
+        required=True,
+        help="glob pattern of the input files of each member",
+    )
+    prun.add_argument("--names", nargs="+", help="name of each member in output files")
+    prun.add_argument("--varname", default="tas", help="daily mean temperature variable")
+    prun.add_argument(
+        "--base",
+        nargs=2,
+        type=int,
+        required=True,
+        metavar=("BSYEAR", "BEYEAR"),
+        help="first and last year of the base period",
+    )
+    prun.add_argument("--method", default="NF13", choices=["NF13", "PA13"])
+    prun.add_argument("--nwindow", type=int, default=15)
+    prun.add_argument("--EHFaccl", action="store_true", help="include acclimatisation")
+    prun.add_argument(
+        "--season", default="yearly", choices=["yearly", "summer_sh", "summer_nh"]
+    )
+    prun.add_argument("--month-starty", type=int, default=1)
+    prun.add_argument("--thres-file", help="file with previously calculated thresholds")
+    prun.add_argument("--thres-cache", help="directory of the threshold cache")
+    prun.add_argument("--mask-file", help="file with the mask (1 where EHF is calculated)")
+    prun.add_argument("--mask-var", default="mask")
+    prun.add_argument("--daily", action="store_true", help="write daily EHF and spells")
+    prun.add_argument("--dtype", help="floating type of daily arrays (e.g. float32)")
+    prun.add_argument(
+        "--pct-chunk-size", type=int, help="gridpoints per chunk of PA13 percentiles"
+    )
+    prun.add_argument("--complevel", type=int, default=4)
+    prun.add_argument("--outdir", default=".")
+    prun.add_argument(
+        "--tile-size", type=int, default=100, help="gridpoints in each direction of tiles"
+    )
+    prun.add_argument("--workers", type=int, default=1, help="members run concurrently")
+    return parser
+
+
+def main(argv=None):
+
+    args = get_parser().parse_args(argv)
+    if args.command == "run":
+        run(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+""" read_EHFinput.py
+
+Memory-mapped input of temperature cubes for compute_EHF.
+
+open_tave returns the (time,lat,lon) temperature of a file as a read-only np.memmap (or
+a view of one), so no data is read until it is used and the operating system only keeps
+in memory the pages that are being accessed. Together with the index-based selection of
+leap days and base period in compute_EHF, a large input does not need to be copied in
+memory before the calculation starts.
+
+Supported files are uncompressed netCDF3 (classic, 64-bit offset and CDF-5), .npy and raw
+binary files. Compressed (netCDF4/HDF5) files cannot be mapped: use compute_EHF_tiles,
+which reads them in spatial tiles.
+"""
+
+import struct
+
+import netCDF4 as nc
+import numpy as np
+from compute_EHFtiles import read_dates
+
+
+# netCDF3 types (big-endian)
+nc3_types = {
+    1: ">i1",
+    2: "S1",
+    3: ">i2",
+    4: ">i4",
+    5: ">f4",
+    6: ">f8",
+    7: ">u1",
+    8: ">u2",
+    9: ">u4",
+    10: ">i8",
+    11: ">u8",
+}
+
+
+def open_tave(filename, varname="tas", dates=None, shape=None, dtype=None):
+
+    """Function to memory-map a temperature cube
+    filename: netCDF3, .npy or raw binary file
+    varname: variable read from netCDF files
+    dates: [OPTIONAL] dates of each time step. Required for .npy and raw files, read from netCDF files
+    shape: (time,lat,lon) of raw files
+    dtype: type of the values of raw files (e.g. '<f4')
+    ---
+    output: tave, dates. tave is a read-only memory-mapped (time,lat,lon) array
+
+    Values are returned as they are stored: packed (scale_factor/add_offset) variables are not
+    supported and missing values are not masked.
+    """
+    filename = str(filename)
+    if filename.endswith(".npy"):
+        tave = np.load(filename, mmap_mode="r")
+    elif nc_format(filename) is not None:
+        tave = open_nc3_variable(filename, varname)
+        if dates is None:
+            fin = nc.Dataset(filename, "r")
+            dates = read_dates(fin)[0]
+            fin.close()
+    else:
+        if shape is None or dtype is None:
+            raise ValueError("shape and dtype are required to map raw file %s" % filename)
+        tave = np.memmap(filename, dtype=dtype, mode="r", shape=tuple(shape))
+
+    if dates is None:
+        raise ValueError("dates are required for file %s" % filename)
+    if len(dates) != tave.shape[0]:
+        raise ValueError(
+            "%s has %s time steps, but %s dates were given"
+            % (filename, tave.shape[0], len(dates))
+        )
+    return tave, dates
+
+
+def nc_format(filename):
+    """get the netCDF3 version of a file (1, 2 or 5), None if it is not a netCDF3 file.
+    Compressed (netCDF4/HDF5) files raise a ValueError, since they cannot be mapped"""
+    with open(filename, "rb") as fin:
+        magic = fin.read(4)
+    if magic[:3] == b"CDF" and magic[3] in (1, 2, 5):
+        return magic[3]
+    if magic == b"\x89HDF":
+        raise ValueError(
+            "%s is a netCDF4/HDF5 file and cannot be memory-mapped: "
+            "use compute_EHF_tiles or convert it to netCDF3" % filename
+        )
+    return None
+
+
+class NC3Header(object):
+
+    """Reader of the header of a netCDF3 file (see the netCDF classic format specification)"""
+
+    def __init__(self, fin, version):
+        self.fin = fin
+        self.size_fmt = ">q" if version == 5 else ">i"
+        self.offset_fmt = ">i" if version == 1 else ">q"
+
+    def read(self, fmt):
+        data = self.fin.read(struct.calcsize(fmt))
+        return struct.unpack(fmt, data)[0]
+
+    def read_size(self):
+        return self.read(self.size_fmt)
+
+    def read_name(self):
+        nchars = self.read_size()
+        name = self.fin.read(nchars).decode("utf-8")
+        self.fin.read(-nchars % 4)
+        return name
+
+    def read_list(self, read_item):
+        """read a list of dimensions, attributes or variables (ABSENT lists are empty)"""
+        self.read(">i")
+        return [read_item() for k in range(self.read_size())]
+
+    def read_dim(self):
+        return self.read_name(), self.read_size()
+
+    def read_att(self):
+        name = self.read_name()
+        nctype = np.dtype(nc3_types[self.read(">i")])
+        nbytes = self.read_size() * nctype.itemsize
+        self.fin.read(nbytes + (-nbytes % 4))
+        return name
+
+    def read_var(self):
+        name = self.read_name()
+        dimids = [self.read_size() for k in range(self.read_size())]
+        atts = self.read_list(self.read_att)
+        nctype = self.read(">i")
+        vsize = self.read_size()
+        begin = self.read(self.offset_fmt)
+        return dict(
+            name=name,
+            dimids=dimids,
+            atts=atts,
+            dtype=np.dtype(nc3_types[nctype]),
+            vsize=vsize,
+            begin=begin,
+        )
+
+
+def open_nc3_variable(filename, varname):
+
+    """Function to memory-map a variable of a netCDF3 file
+    filename: netCDF3 file
+    varname: name of the variable
+    ---
+    output: read-only array of the variable, a view of np.memmap of the whole file
+
+    Record variables are interleaved in the file, so the time axis of a record variable is
+    mapped with a stride of the record size when there are several record variables.
+    """
+    version = nc_format(filename)
+    with open(filename, "rb") as fin:
+        fin.read(4)
+        header = NC3Header(fin, version)
+        numrecs = header.read_size()
+        dims = header.read_list(header.read_dim)
+        header.read_list(header.read_att)
+        variables = header.read_list(header.read_var)
+
+    var = [var for var in variables if var["name"] == varname]
+    if len(var) == 0:
+        raise ValueError("Variable %s not found in %s" % (varname, filename))
+    var = var[0]
+    if "scale_factor" in var["atts"] or "add_offset" in var["atts"]:
+        raise ValueError("Packed variable %s cannot be memory-mapped" % varname)
+
+    shape = [dims[dimid][1] for dimid in var["dimids"]]
+    strides = list(np.cumprod([var["dtype"].itemsize] + shape[:0:-1])[::-1])
+
+    is_record = len(shape) > 0 and shape[0] == 0
+    if is_record:
+        if numrecs < 0:
+            raise ValueError("%s is being written (streaming numrecs)" % filename)
+        shape[0] = numrecs
+        records = [var for var in variables if len(var["dimids"]) > 0]
+        records = [var for var in records if dims[var["dimids"][0]][1] == 0]
+        # Records of a single record variable are not padded
+        if len(records) > 1:
+            strides[0] = sum(var["vsize"] for var in records)
+
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    return np.ndarray(
+        tuple(shape),
+        dtype=var["dtype"],
+        buffer=data,
+        offset=var["begin"],
+        strides=tuple(strides),
+    )
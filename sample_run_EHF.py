@@ -12,21 +12,13 @@
 
 
 import xarray as xr
-from constants import const
-import HWvariables_info as hwv
 from compute_EHFheatwaves import compute_EHF
-import datetime as dt
+from write_EHFoutput import write_EHF
 import pandas as pd
-import numpy as np
-from cftime import DatetimeNoLeap
 
 
 version = "PA13"
 
-syear = 1989
-eyear = 2008
-nyears = eyear - syear + 1
-
 fin = xr.open_dataset("./test.nc")
 
 tave = fin.tas.values
@@ -45,160 +37,30 @@ HWA, HWM, HWF, HWN, HWD, HWT, pctcalc, EHFindex, HWMt, HWAt, spell, HWL = comput
 )
 
 
-dyear = [dt.datetime(syear + x, 6, 1, 0) for x in range(0, nyears)]
-fout = xr.Dataset(
-    {
-        "HWA": (
-            ["year", "y", "x"],
-            HWA,
-            (
-                {
-                    "units": "K2",
-                    "long_name": "Peak of the hottest heatwave per year",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "HWM": (
-            ["year", "y", "x"],
-            HWM,
-            (
-                {
-                    "units": "K2",
-                    "long_name": "Average magnitude of the yearly heatwave",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "HWF": (
-            ["year", "y", "x"],
-            HWF,
-            (
-                {
-                    "units": "days",
-                    "long_name": "Number of heatwave days",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "HWD": (
-            ["year", "y", "x"],
-            HWD,
-            (
-                {
-                    "units": "days",
-                    "long_name": "Duration of yearly longest heatwave",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "HWT": (
-            ["year", "y", "x"],
-            HWT,
-            (
-                {
-                    "units": "day",
-                    "long_name": "First heat wave day of the year",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "HWL": (
-            ["year", "y", "x"],
-            HWL,
-            (
-                {
-                    "units": "days",
-                    "long_name": "Mean duration of heat waves",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "HWAt": (
-            ["year", "y", "x"],
-            HWAt,
-            (
-                {
-                    "units": "K",
-                    "long_name": "Temperature at the peak of the hottest heatwave per year",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "HWMt": (
-            ["year", "y", "x"],
-            HWMt,
-            (
-                {
-                    "units": "K",
-                    "long_name": "Average temperature for all year heatwaves",
-                    "_FillValue": const.missingval,
-                    "missing_value": const.missingval,
-                }
-            ),
-        ),
-        "lat": (["y", "x"], fin.lat.values.squeeze()),
-        "lon": (["y", "x"], fin.lon.values.squeeze()),
-    },
-    coords={"year": dyear},
-)
-
-fout.to_netcdf("./testout_metrics.nc", mode="w")
-
-
-if version == "PA13":
-    dates = [item for item in dates if not (item.month == 2 and item.day == 29)]
-    dates = [DatetimeNoLeap(x.year, x.month, x.day) for x in dates]
-
-    with xr.set_options(enable_cftimeindex=True):
-        fout_day = xr.Dataset(
-            {
-                "EHF": (
-                    ["time", "y", "x"],
-                    EHFindex,
-                    (
-                        {
-                            "units": "K2",
-                            "long_name": "Excessive Heat Factor Index",
-                            "_FillValue": const.missingval,
-                            "missing_value": const.missingval,
-                        }
-                    ),
-                ),
-                "lat": (["y", "x"], fin.lat.values.squeeze()),
-                "lon": (["y", "x"], fin.lon.values.squeeze()),
-            },
-            coords={"time": dates},
-        )
-
-        fout_day.to_netcdf("./testout_index.nc", mode="w")
-else:
+coords = {
+    "lat": (["y", "x"], fin.lat.values.squeeze()),
+    "lon": (["y", "x"], fin.lon.values.squeeze()),
+}
+result = (HWA, HWM, HWF, HWN, HWD, HWT, pctcalc, EHFindex, HWMt, HWAt, spell, HWL)
 
-    fout_day = xr.Dataset(
-        {
-            "EHF": (
-                ["time", "y", "x"],
-                EHFindex,
-                (
-                    {
-                        "units": "K2",
-                        "long_name": "Excessive Heat Factor Index",
-                        "_FillValue": const.missingval,
-                        "missing_value": const.missingval,
-                    }
-                ),
-            ),
-            "lat": (["y", "x"], fin.lat.values.squeeze()),
-            "lon": (["y", "x"], fin.lon.values.squeeze()),
-        },
-        coords={"time": dates},
-    )
-
-    fout_day.to_netcdf("./testout_index.nc", mode="w")
+# Yearly metrics and thresholds, and daily EHF index and spells (compressed, see write_EHFoutput.py).
+# Years are integers and PA13 dates keep the input calendar without leap days (see README.md)
+write_EHF(
+    "./testout_metrics.nc",
+    result,
+    dates,
+    method=version,
+    dims=("y", "x"),
+    coords=coords,
+    daily=False,
+    pct_units=fin.tas.attrs.get("units", ""),
+)
+write_EHF(
+    "./testout_index.nc",
+    result,
+    dates,
+    method=version,
+    dims=("y", "x"),
+    coords=coords,
+    metrics=False,
+)
@@ -4,7 +4,17 @@ import numpy as np
 import pandas as pd
 import datetime as dt
 from constants import const
-from compute_EHFheatwaves import compute_EHF
+from compute_EHFheatwaves import (
+    compute_EHF,
+    calc_spell,
+    calc_spell_all,
+    calc_spell_segments,
+    calc_spell_stats,
+    calc_rolling_mean,
+    calc_percentile_doy,
+    calc_percentile,
+    StageProfile,
+)
 
 
 def test_EHF():
@@ -141,4 +151,995 @@ def test_HWMt():
             EHFaccl=True,
             method="PA13",
         )
-        assert (HWMt == fout_metrics.HWMt.fillna(const.missingval)).all()
\ No newline at end of file
+        assert (HWMt == fout_metrics.HWMt.fillna(const.missingval)).all()
+
+
+def test_EHF_lowmem():
+
+    # float32 internals change EHF by about 1e-6 relative (float32 resolution at ~300 K),
+    # so intensities are compared with rtol=1e-4 and atol=1e-3 K against the float64
+    # reference outputs, while heatwave counts and lengths must be the same.
+    rng = np.random.default_rng(22)
+    dates = pd.date_range("1989-01-01", "1998-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 4, 5))
+
+    kwargs = dict(bsyear=1989, beyear=1994, EHFaccl=True, method="PA13")
+    reference = compute_EHF(tave, dates, **kwargs)
+    (
+        HWA,
+        HWM,
+        HWF,
+        HWN,
+        HWD,
+        HWT,
+        pctcalc,
+        EHFindex,
+        HWMt,
+        HWAt,
+        spell,
+        HWL,
+    ) = compute_EHF(tave, dates, dtype=np.float32, **kwargs)
+
+    assert EHFindex.dtype == np.float32
+    assert spell.dtype.itemsize <= 2
+
+    for var, ref in ((HWA, 0), (HWM, 1), (HWAt, 9), (HWMt, 8)):
+        np.testing.assert_allclose(var, reference[ref], rtol=1e-4, atol=1e-3)
+    for var, ref in ((HWF, 2), (HWD, 4), (HWL, 11)):
+        assert (var == reference[ref]).all()
+
+
+def test_EHF_lowmem_memory():
+
+    import tracemalloc
+
+    rng = np.random.default_rng(12)
+    dates = pd.date_range("1990-01-01", "1999-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 20, 20)).astype(np.float32)
+
+    peaks = {}
+    for dtype in [None, np.float32]:
+        tracemalloc.start()
+        compute_EHF(
+            tave, dates, bsyear=1990, beyear=1994, method="PA13", EHFaccl=True, dtype=dtype
+        )
+        peaks[dtype] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # Percentiles included, the low memory mode needs about half the memory
+    assert peaks[np.float32] < 0.6 * peaks[None]
+
+
+def test_spell_all():
+
+    rng = np.random.default_rng(0)
+    exceed = (rng.random((400, 4, 5)) > 0.6).astype(int)
+    exceed[0, :, :] = 0
+    mask = np.ones((4, 5), int)
+    mask[0, 0] = 0
+
+    spell_all = calc_spell_all(exceed, mask)
+
+    for ilat in range(4):
+        for ilon in range(5):
+            if mask[ilat, ilon] == 1:
+                spell = calc_spell(exceed[:, ilat, ilon])
+            else:
+                spell = np.zeros(400, int)
+            assert (spell_all[:, ilat, ilon] == spell).all()
+
+    exceed_masked = np.ma.masked_array(exceed, exceed * 0)
+    exceed_masked[50:53, 1, 1] = np.ma.masked
+    spell_masked = calc_spell_all(exceed_masked)
+    assert (spell_masked[:, 1, 1] == calc_spell(exceed_masked[:, 1, 1].copy())).all()
+
+
+def test_spell_stats():
+
+    rng = np.random.default_rng(1)
+    exceed = (rng.random((1000, 3, 4)) > 0.2).astype(int)
+    var = rng.normal(0, 10, exceed.shape)
+
+    tstart, ilat, ilon, length = calc_spell_segments(exceed)
+    spell_mean, spell_max = calc_spell_stats(var, tstart, ilat, ilon, length)
+
+    for n in range(len(length)):
+        aux = var[tstart[n] : tstart[n] + length[n], ilat[n], ilon[n]]
+        assert spell_mean[n] == np.mean(aux)
+        assert spell_max[n] == np.max(aux)
+
+
+def test_yearly_metrics():
+
+    # Per-year loop over boolean masks of the daily arrays, as compute_EHF did before
+    # calc_yearly_metrics, applied to the daily EHF and spells returned by compute_EHF
+    rng = np.random.default_rng(16)
+    dates = pd.date_range("1990-01-01", "1997-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4))
+    tave[4 * 365 :] += 3
+
+    for method, season, month_starty in [
+        ("NF13", "yearly", 1),
+        ("PA13", "yearly", 7),
+        ("PA13", "summer_sh", 7),
+        ("NF13", "summer_nh", 1),
+    ]:
+        result = compute_EHF(
+            tave,
+            dates,
+            bsyear=1990,
+            beyear=1993,
+            method=method,
+            season=season,
+            month_starty=month_starty,
+            EHFaccl=True,
+        )
+        EHF, spell_all = np.ma.getdata(result[7]), result[10]
+
+        keep = ~((dates.month == 2) & (dates.day == 29)) | (method == "NF13")
+        tave_3days = calc_rolling_mean(tave[keep], 3)
+        new_years = np.where(
+            dates.month[keep] < month_starty, dates.year[keep] - 1, dates.year[keep]
+        )
+        syear = dates.year.min()
+        nyears = dates.year.max() - syear + 1
+
+        heatwave = [np.ones(tave_3days.shape) * const.missingval for k in range(4)]
+        for t0, ilat, ilon in zip(*np.nonzero(spell_all)):
+            days = slice(t0, t0 + spell_all[t0, ilat, ilon])
+            heatwave[0][t0, ilat, ilon] = np.mean(EHF[days, ilat, ilon])
+            heatwave[1][t0, ilat, ilon] = np.max(EHF[days, ilat, ilon])
+            heatwave[2][t0, ilat, ilon] = np.mean(tave_3days[days, ilat, ilon])
+            heatwave[3][t0, ilat, ilon] = np.max(tave_3days[days, ilat, ilon])
+        EHF_avg, EHF_peak, TMP3D_ave, TMP3D_peak = [
+            np.ma.masked_equal(var, const.missingval) for var in heatwave
+        ]
+
+        metrics = dict(
+            (vname, np.ones((nyears, 3, 4)) * const.missingval)
+            for vname in ["HWA", "HWM", "HWF", "HWN", "HWD", "HWT", "HWMt", "HWAt", "HWL"]
+        )
+        for yr in range(nyears):
+            year = new_years == yr + syear
+            metrics["HWA"][yr] = np.ma.max(EHF_peak[year], axis=0)
+            metrics["HWM"][yr] = np.ma.mean(EHF_avg[year], axis=0)
+            metrics["HWF"][yr] = (
+                np.sum(spell_all[year], axis=0) * 100.0 / float(np.sum(year))
+            )
+            metrics["HWN"][yr] = np.sum(spell_all[year] != 0, axis=0)
+            metrics["HWD"][yr] = np.max(spell_all[year], axis=0, initial=0)
+            with np.errstate(invalid="ignore"):
+                metrics["HWL"][yr] = np.sum(spell_all[year], axis=0) / metrics["HWN"][yr]
+            metrics["HWT"][yr] = np.argmax(spell_all[year] != 0, axis=0)
+            metrics["HWAt"][yr] = np.ma.max(TMP3D_peak[year], axis=0) - const.tkelvin
+            metrics["HWMt"][yr] = np.ma.mean(TMP3D_ave[year], axis=0) - const.tkelvin
+        for vname in ["HWMt", "HWM", "HWA", "HWAt"]:
+            metrics[vname][metrics[vname] == 0] = const.missingval
+        metrics["HWL"][metrics["HWN"] == 0] = const.missingval
+
+        assert (metrics["HWN"] > 0).any() and (metrics["HWN"] == 0).any()
+        names = ["HWA", "HWM", "HWF", "HWN", "HWD", "HWT", "HWMt", "HWAt", "HWL"]
+        for vname, ivar in zip(names, (0, 1, 2, 3, 4, 5, 8, 9, 11)):
+            assert (np.ma.getdata(result[ivar]) == metrics[vname]).all(), vname
+
+
+def test_rolling_mean():
+
+    rng = np.random.default_rng(2)
+    tave = rng.normal(290, 5, (500, 3, 4)).astype(np.float32)
+
+    tave_30days = np.zeros(tave.shape, dtype=float)
+    for t in range(32, tave.shape[0]):
+        tave_30days[t, :, :] = np.mean(tave[t - 32 : t - 2, :, :], axis=0)
+
+    assert (calc_rolling_mean(tave, 30, nlag=3) == tave_30days).all()
+    assert np.allclose(
+        calc_rolling_mean(tave, 30, nlag=3, dtype=np.float64, cumsum=True),
+        tave_30days,
+        atol=1e-3,
+    )
+
+    # A single gridpoint is summed pairwise by np.mean
+    tave = tave[:, :1, :1]
+    tave_30days = np.zeros(tave.shape, dtype=float)
+    for t in range(32, tave.shape[0]):
+        tave_30days[t, :, :] = np.mean(tave[t - 32 : t - 2, :, :], axis=0)
+
+    assert (calc_rolling_mean(tave, 30, nlag=3) == tave_30days).all()
+
+
+def test_percentile_doy():
+
+    rng = np.random.default_rng(3)
+    nyears = 4
+    tave = rng.normal(290, 5, (365 * nyears, 3, 4))
+
+    windowrange = np.zeros((365,), dtype=bool)
+    windowrange[:8] = True
+    windowrange[-7:] = True
+    windowrange = np.tile(windowrange, nyears)
+    pct = np.zeros((365, 3, 4))
+    for d in range(365):
+        pct[d, :, :] = np.percentile(tave[windowrange == True, :, :], 90, axis=0)
+        windowrange = np.roll(windowrange, 1)
+
+    assert (calc_percentile_doy(tave, nyears, 90) == pct).all()
+    assert (calc_percentile_doy(tave, nyears, 90, chunk_size=5) == pct).all()
+
+    # 360_day calendars have 360 calendar days
+    tave = tave[: 360 * nyears]
+    windowrange = np.zeros((360,), dtype=bool)
+    windowrange[:8] = True
+    windowrange[-7:] = True
+    windowrange = np.tile(windowrange, nyears)
+    pct = np.zeros((360, 3, 4))
+    for d in range(360):
+        pct[d, :, :] = np.percentile(tave[windowrange == True, :, :], 90, axis=0)
+        windowrange = np.roll(windowrange, 1)
+    assert (calc_percentile_doy(tave, nyears, 90) == pct).all()
+
+
+
+def test_percentile_memory():
+
+    import tracemalloc
+    import compute_EHFheatwaves
+
+    rng = np.random.default_rng(11)
+    nyears = 10
+    tave = rng.normal(290, 5, (365 * nyears, 40, 40))
+    pct = calc_percentile_doy(tave, nyears, 90, chunk_size=40 * 40)
+
+    # Peak memory is bounded by the budget of each chunk, not by the size of the domain
+    budget = compute_EHFheatwaves.percentile_chunk_bytes
+    compute_EHFheatwaves.percentile_chunk_bytes = 8 * 2**20
+    try:
+        tracemalloc.start()
+        pct_default = calc_percentile(tave, nyears, method="PA13")
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        compute_EHFheatwaves.percentile_chunk_bytes = budget
+
+    assert (pct_default == pct).all()
+    assert peak < 2 * 8 * 2**20 + pct.nbytes
+
+def test_percentile_masked():
+
+    rng = np.random.default_rng(4)
+    nyears = 3
+    tave = rng.normal(290, 5, (365 * nyears, 3, 4))
+    tave = np.ma.masked_array(tave, rng.random(tave.shape) < 0.2)
+    tave[:, 0, 0] = np.ma.masked
+
+    pct = calc_percentile(tave, nyears, method="NF13")
+    assert pct[0, 0] == const.missingval
+    assert pct[1, 2] == np.nanpercentile(tave[:, 1, 2].compressed(), 95)
+
+    pct = calc_percentile(tave, nyears, method="PA13")
+    assert (pct[:, 0, 0] == const.missingval).all()
+    aux = tave[:, 1, 2].reshape((nyears, 365))
+    aux = np.ma.concatenate((aux[:, -7:], aux[:, :8]), axis=1)
+    assert pct[0, 1, 2] == np.percentile(aux.compressed(), 90)
+
+
+def write_test_input(filename, nlat=3, nlon=5):
+
+    rng = np.random.default_rng(5)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    doy = dates.dayofyear.values
+    tave = 288 + 10 * np.sin(2 * np.pi * (doy - 100) / 365.25)
+    tave = tave[:, None, None] + rng.normal(0, 3, (len(dates), nlat, nlon))
+
+    fin = xr.Dataset(
+        {
+            "tas": (["time", "y", "x"], tave.astype(np.float32), {"units": "K"}),
+            "lat": (["y", "x"], np.repeat(np.arange(nlat)[:, None], nlon, axis=1)),
+        },
+        coords={"time": dates},
+    )
+    fin.to_netcdf(filename)
+    return fin.tas.values, dates
+
+
+def test_EHF_tiles(tmp_path):
+
+    from compute_EHFtiles import compute_EHF_tiles
+
+    tave, dates = write_test_input(tmp_path / "tas.nc")
+
+    for method in ["NF13", "PA13"]:
+        compute_EHF_tiles(
+            tmp_path / "tas.nc",
+            tmp_path / "out.nc",
+            tile_size=(2, 3),
+            daily=True,
+            bsyear=1990,
+            beyear=1993,
+            EHFaccl=True,
+            method=method,
+        )
+        HWA, HWM, HWF, HWN, HWD, HWT, pct, EHF, HWMt, HWAt, spell, HWL = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1993, EHFaccl=True, method=method
+        )
+        fout = xr.open_dataset(tmp_path / "out.nc", mask_and_scale=False)
+        assert (fout.HWA.values == HWA).all()
+        assert (fout.HWMt.values == HWMt).all()
+        assert (fout.HWT.values == np.ma.filled(HWT, const.missingval)).all()
+        assert (fout.EHF.values == EHF).all()
+        assert (fout.spell.values == spell).all()
+        assert fout.EHF.encoding["zlib"]
+        fout.close()
+
+    # Output options are passed to EHFWriter, the time coordinate keeps the input units
+    compute_EHF_tiles(
+        tmp_path / "tas.nc",
+        tmp_path / "packed.nc",
+        tile_size=(2, 3),
+        daily=True,
+        bsyear=1990,
+        beyear=1993,
+        output_options=dict(pack=True),
+    )
+    fout = xr.open_dataset(tmp_path / "packed.nc")
+    assert fout.EHF.encoding["dtype"] == np.int16
+    assert fout.time.encoding["units"] == "days since 1990-01-01 00:00:00"
+    assert (fout.time.values == dates.values).all()
+    assert (fout.lat.values == np.arange(3)[:, None]).all()
+    fout.close()
+
+
+def test_EHF_parallel():
+
+    from compute_EHFtiles import compute_EHF_parallel
+
+    rng = np.random.default_rng(6)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 5, 4))
+
+    for method in ["NF13", "PA13"]:
+        serial = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1993, EHFaccl=True, method=method
+        )
+        parallel = compute_EHF_parallel(
+            tave,
+            dates,
+            n_workers=2,
+            tile_size=2,
+            bsyear=1990,
+            beyear=1993,
+            EHFaccl=True,
+            method=method,
+        )
+        for var_serial, var_parallel in zip(serial, parallel):
+            assert (np.ma.getdata(var_serial) == np.ma.getdata(var_parallel)).all()
+            assert (
+                np.ma.getmaskarray(var_serial) == np.ma.getmaskarray(var_parallel)
+            ).all()
+
+
+def test_tiles():
+
+    from compute_EHFtiles import get_tiles
+
+    from compute_EHFtiles import compute_EHF_parallel
+
+    for nlat, nlon, tile_size in [
+        (3, 3, 1),
+        (5, 5, 2),
+        (1, 5, 1),
+        (5, 1, 2),
+        (7, 4, 3),
+        (3, 1, (1, 3)),
+        (6, 1, (1, 5)),
+        (1, 3, (3, 1)),
+    ]:
+        tiles = get_tiles(nlat, nlon, tile_size)
+        sizes = [(slat.stop - slat.start) * (slon.stop - slon.start) for slat, slon in tiles]
+        assert sum(sizes) == nlat * nlon
+        assert min(sizes) > 1
+    assert get_tiles(1, 1, 1) == [(slice(0, 1), slice(0, 1))]
+
+    # Single gridpoint tiles would not give exactly the same results as the whole domain
+    rng = np.random.default_rng(21)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    for nlat, nlon, tile_size in [(3, 1, (1, 3)), (6, 1, (1, 5))]:
+        tave = rng.normal(290, 5, (len(dates), nlat, nlon))
+        serial = compute_EHF(tave, dates, bsyear=1990, beyear=1993, EHFaccl=True)
+        parallel = compute_EHF_parallel(
+            tave,
+            dates,
+            n_workers=2,
+            tile_size=tile_size,
+            bsyear=1990,
+            beyear=1993,
+            EHFaccl=True,
+        )
+        for var_serial, var_parallel in zip(serial, parallel):
+            assert (np.ma.getdata(var_serial) == np.ma.getdata(var_parallel)).all()
+
+
+def test_EHF_ensemble(tmp_path, monkeypatch):
+
+    import compute_EHFensemble
+    import compute_EHFheatwaves
+    from calendars import get_ymd
+    from compute_EHFensemble import compute_EHF_ensemble
+    from compute_EHFheatwaves import calc_percentile
+
+    rng = np.random.default_rng(13)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (3, len(dates), 3, 4))
+    files = []
+    for k in range(3):
+        files.append(tmp_path / ("member%s.nc" % (k)))
+        xr.Dataset(
+            {"tas": (("time", "y", "x"), tave[k])}, coords={"time": dates}
+        ).to_netcdf(files[-1])
+
+    for method in ["NF13", "PA13"]:
+        members = compute_EHF_ensemble(
+            tave, dates, 1990, 1993, pooled=False, batch_size=2, daily=True, method=method
+        )
+        for k in range(3):
+            reference = compute_EHF(tave[k], dates, bsyear=1990, beyear=1993, method=method)
+            for var_member, var_reference in zip(members, reference):
+                assert (
+                    np.ma.getdata(var_member[k]) == np.ma.getdata(var_reference)
+                ).all()
+
+        # Pooled thresholds treat the base period of each member as further years
+        pooled = compute_EHF_ensemble(files, None, 1990, 1993, batch_size=2, method=method)
+        keep = ~((dates.month == 2) & (dates.day == 29)) | (method == "NF13")
+        base = tave[:, keep & (dates.year <= 1993)].reshape((-1, 3, 4))
+        pct = calc_percentile(base, 12, method=method)
+        assert (pooled[6] == pct).all()
+        assert pooled[7] is None
+        for k in range(3):
+            reference = compute_EHF(tave[k], dates, pct=pct, method=method)
+            assert (pooled[0][k] == reference[0]).all()
+            assert (pooled[3][k] == reference[3]).all()
+
+    # Dates are converted once for all the batches
+    calls = []
+
+    def count_ymd(dates):
+        calls.append(len(dates))
+        return get_ymd(dates)
+
+    monkeypatch.setattr(compute_EHFensemble, "get_ymd", count_ymd)
+    monkeypatch.setattr(compute_EHFheatwaves, "get_ymd", count_ymd)
+    compute_EHF_ensemble(tave, dates, 1990, 1993, pooled=False, batch_size=1)
+    assert len(calls) == 1
+
+
+def test_EHF_catalog(tmp_path):
+
+    from compute_EHFcatalog import compute_EHF_catalog, calc_catalog_metrics, write_catalog
+
+    rng = np.random.default_rng(14)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4))
+
+    for method, month_starty in [("NF13", 1), ("PA13", 7)]:
+        reference = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1993, method=method, month_starty=month_starty
+        )
+        catalog, years, pct = compute_EHF_catalog(
+            tave, dates, bsyear=1990, beyear=1993, method=method, month_starty=month_starty
+        )
+        assert (pct == reference[6]).all()
+
+        spell_all = reference[10]
+        index = (catalog["start"], catalog["ilat"], catalog["ilon"])
+        assert (spell_all[index] == catalog["length"]).all()
+        assert len(catalog) == (spell_all > 0).sum()
+
+        metrics = calc_catalog_metrics(catalog, years, tave.shape[1:])
+        references = [reference[i] for i in (0, 1, 2, 3, 4, 5, 8, 9, 11)]
+        for var, var_reference in zip(metrics, references):
+            assert (np.ma.getdata(var) == np.ma.getdata(var_reference)).all()
+
+    write_catalog(tmp_path / "catalog.nc", catalog, years)
+    fin = xr.open_dataset(tmp_path / "catalog.nc")
+    assert fin.event_count.sum() == len(catalog)
+    assert (fin.length.values == catalog["length"]).all()
+    fin.close()
+
+    # Interleaved gridpoints (A, B, A) are sorted before they are written
+    rows = [np.nonzero((catalog["ilat"] == 0) & (catalog["ilon"] == k))[0] for k in (0, 1)]
+    interleaved = catalog[np.concatenate((rows[0][:1], rows[1], rows[0][1:]))]
+    write_catalog(tmp_path / "interleaved.nc", interleaved)
+    fin = xr.open_dataset(tmp_path / "interleaved.nc")
+    assert (fin.event_count.values == [len(rows[0]), len(rows[1])]).all()
+    assert (fin.start.values == catalog["start"][np.concatenate(rows)]).all()
+    fin.close()
+
+
+def test_EHF_compress():
+
+    rng = np.random.default_rng(15)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 4, 5))
+    mask = (rng.random((4, 5)) < 0.4).astype(int)
+    land = mask == 1
+
+    for method in ["NF13", "PA13"]:
+        reference = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1993, mask=mask, EHFaccl=True, method=method
+        )
+        compressed = compute_EHF(
+            tave,
+            dates,
+            bsyear=1990,
+            beyear=1993,
+            mask=mask,
+            EHFaccl=True,
+            method=method,
+            compress=True,
+        )
+        for ivar, (var, var_reference) in enumerate(zip(compressed, reference)):
+            if ivar in (6, 7):
+                assert (var[..., land] == var_reference[..., land]).all()
+                assert (var[..., ~land] == const.missingval).all()
+            else:
+                assert (np.ma.getdata(var) == np.ma.getdata(var_reference)).all()
+
+
+def test_threshold_builder(tmp_path):
+
+    from compute_EHFheatwaves import calc_percentile
+    from threshold_builder import ThresholdBuilder
+
+    rng = np.random.default_rng(18)
+    dates = pd.date_range("1990-01-01", "1997-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4))
+    mask = np.zeros(tave.shape, bool)
+    mask[10:400, 1, 2] = True
+    mask[:, 0, 0] = True
+
+    for method in ["NF13", "PA13"]:
+        for var in (tave, np.ma.masked_array(tave, mask)):
+            base = (dates.year >= 1991) & (dates.year <= 1996)
+            if method == "PA13":
+                base &= ~((dates.month == 2) & (dates.day == 29))
+            reference = calc_percentile(var[base], 6, method=method)
+
+            with ThresholdBuilder(1991, 1996, method, tmpdir=tmp_path) as builder:
+                for year in range(1990, 1998):
+                    index = np.nonzero(dates.year == year)[0]
+                    builder.add(var[index], dates[index])
+                pct = builder.get_pct()
+            assert (pct == reference).all()
+    assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_EHF_sweep():
+
+    from compute_EHFsweep import compute_EHF_sweep
+
+    rng = np.random.default_rng(17)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4))
+    configs = [
+        dict(method="NF13"),
+        dict(method="NF13", EHFaccl=True, nwindow=7),
+        dict(method="PA13", EHFaccl=True, season="summer_sh", month_starty=7),
+        dict(method="PA13"),
+    ]
+
+    fout = compute_EHF_sweep(tave, dates, configs, 1990, 1993)
+    assert list(fout.method.values) == ["NF13", "NF13", "PA13", "PA13"]
+    for k, config in enumerate(configs):
+        reference = compute_EHF(tave, dates, bsyear=1990, beyear=1993, **config)
+        for vname, ivar in (("HWA", 0), ("HWN", 3), ("HWT", 5), ("HWMt", 8)):
+            var = np.ma.filled(
+                np.ma.masked_equal(reference[ivar], const.missingval), np.nan
+            )
+            assert np.array_equal(fout[vname].values[k], var, equal_nan=True)
+
+
+def test_EHF_numba():
+
+    pytest.importorskip("numba")
+    from compute_EHFnumba import compute_EHF_numba
+
+    rng = np.random.default_rng(16)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+
+    for shape in [(4, 20), (1, 1)]:
+        tave = rng.normal(290, 5, (len(dates),) + shape)
+        mask = (rng.random(shape) < 0.8).astype(int)
+        for method, EHFaccl, season, month_starty in [
+            ("NF13", False, "yearly", 1),
+            ("PA13", True, "summer_sh", 7),
+        ]:
+            kwargs = dict(
+                bsyear=1990,
+                beyear=1993,
+                mask=mask,
+                method=method,
+                EHFaccl=EHFaccl,
+                season=season,
+                month_starty=month_starty,
+            )
+            reference = compute_EHF(tave, dates, **kwargs)
+            compiled = compute_EHF_numba(tave, dates, **kwargs)
+            for var, var_reference in zip(compiled, reference):
+                assert (np.ma.getdata(var) == np.ma.getdata(var_reference)).all()
+                assert (
+                    np.ma.getmaskarray(var) == np.ma.getmaskarray(var_reference)
+                ).all()
+
+            metrics = compute_EHF_numba(tave, dates, daily=False, **kwargs)
+            assert metrics[7] is None and metrics[10] is None
+            assert (metrics[3] == reference[3]).all()
+
+
+def test_EHF_writer(tmp_path):
+
+    from compute_EHFtiles import get_tiles
+    from write_EHFoutput import EHFWriter, write_EHF
+
+    rng = np.random.default_rng(19)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 5, 4))
+
+    for method in ["NF13", "PA13"]:
+        result = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1993, EHFaccl=True, method=method
+        )
+        HWA, HWM, HWF, HWN, HWD, HWT, pct, EHF, HWMt, HWAt, spell, HWL = result
+
+        with EHFWriter(tmp_path / "out.nc", dates, (5, 4), method=method) as writer:
+            for tlat, tlon in get_tiles(5, 4, 2):
+                writer.write_tile(tlat, tlon, [var[..., tlat, tlon] for var in result])
+        fout = xr.open_dataset(tmp_path / "out.nc", mask_and_scale=False)
+        assert (fout.HWA.values == HWA).all()
+        assert (fout.HWT.values == np.ma.filled(HWT, const.missingval)).all()
+        assert (fout.EHF.values == EHF).all()
+        assert (fout.spell.values == spell).all()
+        assert fout.EHF.encoding["zlib"]
+        fout.close()
+
+        write_EHF(tmp_path / "packed.nc", result, dates, method=method, pack=True)
+        fout = xr.open_dataset(tmp_path / "packed.nc")
+        assert fout.EHF.encoding["dtype"] == np.int16
+        assert np.abs(fout.EHF.values - EHF).max() <= 0.01 + 1e-9
+        assert (fout.HWN.values == HWN).all()
+        assert (fout.spell.values == spell).all()
+        fout.close()
+
+
+def test_EHF_stations():
+
+    from compute_EHFstations import compute_EHF_stations
+
+    rng = np.random.default_rng(20)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 5))
+    tave[400:410, 1] = np.nan
+    tave[: 3 * 365, 2] = np.nan
+    tave[2000:, 3] = np.nan
+
+    for method in ["NF13", "PA13"]:
+        table, pct = compute_EHF_stations(
+            tave, dates, 1990, 1993, batch_size=2, EHFaccl=True, method=method
+        )
+        HWA, HWM, HWF, HWN, HWD, HWT, pct_ref, EHF, HWMt, HWAt, spell, HWL = compute_EHF(
+            np.ma.masked_invalid(tave[:, None, :]),
+            dates,
+            bsyear=1990,
+            beyear=1993,
+            mask=np.array([[1, 1, 0, 1, 1]]),
+            EHFaccl=True,
+            method=method,
+        )
+        # compute_EHF leaves masked days out of the rolling means, so only the years
+        # without missing days are the same
+        assert table.shape == (5 * 6, 10)
+        HWN_table = table["HWN"].values.reshape(5, 6).T
+        assert (HWN_table[:, [0, 4]] == HWN[:, 0, [0, 4]]).all()
+        assert (HWN_table[[0, 2, 3, 4, 5], 1] == HWN[[0, 2, 3, 4, 5], 0, 1]).all()
+        assert np.isnan(HWN_table[:, 2]).all() and np.isnan(pct[..., 2]).all()
+        assert np.isnan(HWN_table[-1, 3]) and (HWN_table[:-1, 3] == HWN[:-1, 0, 3]).all()
+        assert table.loc[(1, 1991), "valid"] == 355 / 365
+
+    # A missing day in the middle of a heatwave splits it instead of being bridged
+    tave = np.repeat(rng.normal(290, 0.5, (len(dates), 1)), 2, axis=1)
+    tave[1000:1012] += 10
+    tave[1006, 1] = np.nan
+    table, pct = compute_EHF_stations(tave, dates, 1990, 1993)
+    assert table.loc[(1, 1992), "HWN"] == table.loc[(0, 1992), "HWN"] + 1
+    assert table.loc[(1, 1992), "HWD"] < table.loc[(0, 1992), "HWD"]
+
+
+def test_EHF_xr():
+
+    pytest.importorskip("dask")
+    from compute_EHFxarray import compute_EHF_xr
+
+    rng = np.random.default_rng(7)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 4, 6))
+    da = xr.DataArray(tave, dims=("time", "y", "x"), coords={"time": dates})
+
+    fout = compute_EHF_xr(
+        da.chunk({"y": 2, "x": 3}), bsyear=1990, beyear=1993, method="PA13"
+    )
+    HWA, HWM, HWF, HWN, HWD, HWT, pct, EHF, HWMt, HWAt, spell, HWL = compute_EHF(
+        tave, dates, bsyear=1990, beyear=1993, method="PA13"
+    )
+    assert (fout.HWA.fillna(const.missingval).values == HWA).all()
+    assert (fout.HWN.values == HWN).all()
+    assert (fout.HWT.fillna(0).values == np.ma.getdata(HWT)).all()
+    assert fout.HWA.attrs["long_name"] == "Peak of the hottest heatwave per year"
+
+
+def test_threshold_cache(tmp_path):
+
+    from threshold_cache import ThresholdCache
+
+    rng = np.random.default_rng(8)
+    dates = pd.date_range("1990-01-01", "1993-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4))
+    cache = ThresholdCache(tmp_path)
+
+    for method in ["NF13", "PA13"]:
+        reference = compute_EHF(tave, dates, bsyear=1990, beyear=1992, method=method)
+        first = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1992, method=method, thres_cache=cache
+        )
+        cached = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1992, method=method, thres_cache=cache
+        )
+        assert (first[6] == reference[6]).all()
+        assert (cached[6] == reference[6]).all()
+        assert (cached[0] == reference[0]).all()
+
+    assert len(list(tmp_path.glob("*.nc"))) == 2
+    compute_EHF(
+        tave, dates, bsyear=1990, beyear=1991, method="NF13", thres_cache=cache
+    )
+    assert len(list(tmp_path.glob("*.nc"))) == 3
+
+    cache.max_size = cache.get_size() - 1
+    cache.evict()
+    assert len(list(tmp_path.glob("*.nc"))) == 2
+
+    cache.invalidate()
+    assert cache.get_size() == 0
+
+
+def test_open_tave(tmp_path):
+
+    import netCDF4 as nc
+    from read_EHFinput import open_tave
+
+    rng = np.random.default_rng(11)
+    dates = pd.date_range("1990-01-01", "1995-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4)).astype(np.float32)
+
+    # A second record variable interleaves the records of tas in the file
+    fout = nc.Dataset(tmp_path / "tas.nc", "w", format="NETCDF3_64BIT_OFFSET")
+    fout.createDimension("time", None)
+    fout.createDimension("bnds", 2)
+    fout.createDimension("y", 3)
+    fout.createDimension("x", 4)
+    time = fout.createVariable("time", "f8", ("time",))
+    time.units = "days since 1990-01-01"
+    time_bnds = fout.createVariable("time_bnds", "f8", ("time", "bnds"))
+    tas = fout.createVariable("tas", "f4", ("time", "y", "x"))
+    time[:] = np.arange(len(dates))
+    time_bnds[:] = 0
+    tas[:] = tave
+    fout.close()
+    np.save(tmp_path / "tas.npy", tave)
+
+    tave_nc, dates_nc = open_tave(tmp_path / "tas.nc")
+    tave_npy, dates_npy = open_tave(tmp_path / "tas.npy", dates=dates)
+    assert (tave_nc == tave).all()
+    assert (tave_npy == tave).all()
+    assert (pd.DatetimeIndex(dates_nc) == dates).all()
+
+    for method in ["NF13", "PA13"]:
+        reference = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1993, EHFaccl=True, method=method
+        )
+        mapped = compute_EHF(
+            tave_nc, dates, bsyear=1990, beyear=1993, EHFaccl=True, method=method
+        )
+        for var_reference, var_mapped in zip(reference, mapped):
+            assert (np.ma.getdata(var_reference) == np.ma.getdata(var_mapped)).all()
+
+    # In the low memory mode, the big-endian netCDF3 values are converted chunk by chunk
+    import tracemalloc
+
+    assert tave_nc.dtype.byteorder == ">"
+    peaks = {}
+    for name, var in [("npy", tave_npy), ("nc", tave_nc)]:
+        tracemalloc.start()
+        lowmem = compute_EHF(
+            var,
+            dates,
+            bsyear=1990,
+            beyear=1993,
+            EHFaccl=True,
+            method="PA13",
+            dtype=np.float32,
+        )
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if name == "npy":
+            reference = lowmem
+        for var_reference, var_lowmem in zip(reference, lowmem):
+            assert (np.ma.getdata(var_reference) == np.ma.getdata(var_lowmem)).all()
+    assert peaks["nc"] < peaks["npy"] + 0.5 * tave.nbytes
+
+
+def test_EHF_stream(tmp_path):
+
+    from compute_EHFstream import EHFStream
+
+    rng = np.random.default_rng(9)
+    dates = pd.date_range("1990-01-01", "1994-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4))
+    names = ["HWA", "HWM", "HWF", "HWN", "HWD", "HWT", "HWMt", "HWAt", "HWL"]
+
+    for method in ["NF13", "PA13"]:
+        reference = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1992, method=method, EHFaccl=True
+        )
+        stream = EHFStream(reference[6], method=method, EHFaccl=True)
+        EHF = []
+        spell = np.zeros((0, 3, 4), dtype=int)
+        for k, (start, end) in enumerate([(0, 400), (400, 1000), (1000, len(dates))]):
+            if k == 2:
+                stream.save(tmp_path / "state.npz")
+                stream = EHFStream.load(tmp_path / "state.npz")
+            out = stream.update(tave[start:end], dates[start:end])
+            ilat, ilon = np.nonzero(out["spell_prev_start"] >= 0)
+            spell[out["spell_prev_start"][ilat, ilon], ilat, ilon] = out[
+                "spell_prev_length"
+            ][ilat, ilon]
+            spell = np.concatenate((spell, out["spell"]))
+            EHF.append(out["EHF"])
+
+        assert (np.concatenate(EHF) == reference[7]).all()
+        assert (spell == reference[10]).all()
+        full = dict(zip(names, [reference[i] for i in (0, 1, 2, 3, 4, 5, 8, 9, 11)]))
+        for vname, var in zip(names, stream.get_metrics()):
+            assert (np.ma.getdata(var) == np.ma.getdata(full[vname])).all()
+
+    # A single gridpoint, where numpy sums the heatwaves of each year pairwise. The last
+    # years are warmer, so they have enough heatwaves for the order of the sum to matter
+    tave = np.random.default_rng(0).normal(290, 5, (len(dates), 1, 1))
+    tave[3 * 365 :] += 4
+    reference = compute_EHF(tave, dates, bsyear=1990, beyear=1992, EHFaccl=True)
+    stream = EHFStream(reference[6], EHFaccl=True)
+    stream.update(tave[:1000], dates[:1000])
+    stream.save(tmp_path / "state.npz")
+    stream = EHFStream.load(tmp_path / "state.npz")
+    stream.update(tave[1000:], dates[1000:])
+    full = dict(zip(names, [reference[i] for i in (0, 1, 2, 3, 4, 5, 8, 9, 11)]))
+    for vname, var in zip(names, stream.get_metrics()):
+        assert (np.ma.getdata(var) == np.ma.getdata(full[vname])).all()
+
+
+def test_calendars():
+
+    import cftime
+    from calendars import get_ymd, get_calendar
+    from compute_EHFstream import EHFStream
+
+    dates = pd.date_range("1990-01-01", "1993-12-31", freq="D")
+    for dates_in in [dates, dates.values, list(dates.to_pydatetime())]:
+        years, months, days = get_ymd(dates_in)
+        assert (years == dates.year).all()
+        assert (months == dates.month).all()
+        assert (days == dates.day).all()
+
+    rng = np.random.default_rng(12)
+    for calendar, ndays_year, ndoy in [
+        ("noleap", 365, 365),
+        ("all_leap", 366, 365),
+        ("360_day", 360, 360),
+    ]:
+        dates = cftime.num2date(
+            np.arange(4 * ndays_year), "days since 1990-01-01", calendar=calendar
+        )
+        assert get_calendar(dates) == calendar
+        years, months, days = get_ymd(dates)
+        assert (years == [date.year for date in dates]).all()
+        assert (days == [date.day for date in dates]).all()
+
+        tave = rng.normal(290, 5, (len(dates), 3, 4))
+        result = compute_EHF(
+            tave, dates, bsyear=1990, beyear=1992, method="PA13", EHFaccl=True
+        )
+        assert result[6].shape == (ndoy, 3, 4)
+        assert result[7].shape == (4 * ndoy, 3, 4)
+
+        stream = EHFStream(result[6], method="PA13", EHFaccl=True)
+        out = stream.update(tave, dates)
+        assert (out["EHF"] == result[7]).all()
+
+
+def test_stage_profile():
+
+    rng = np.random.default_rng(10)
+    dates = pd.date_range("1990-01-01", "1993-12-31", freq="D")
+    tave = rng.normal(290, 5, (len(dates), 3, 4))
+
+    calls = []
+    profile = StageProfile(memory=True, callback=lambda name, info: calls.append(name))
+    reference = compute_EHF(tave, dates, bsyear=1990, beyear=1992, method="PA13")
+    profiled = compute_EHF(
+        tave, dates, bsyear=1990, beyear=1992, method="PA13", profile=profile
+    )
+
+    for var, var_profiled in zip(reference, profiled):
+        assert (np.ma.getdata(var) == np.ma.getdata(var_profiled)).all()
+    assert list(profile.stages) == calls
+    assert calls == [
+        "dates",
+        "percentile PA13",
+        "rolling means",
+        "EHF",
+        "spell detection",
+        "spell stats",
+        "yearly metrics",
+    ]
+    for info in profile.stages.values():
+        assert info["time"] >= 0 and info["calls"] == 1
+        assert "peak" in info and "nbytes" in info
+
+
+def test_cli_run(tmp_path):
+
+    import ehf
+
+    tave, dates = write_test_input(tmp_path / "tas.nc")
+    fin = xr.open_dataset(tmp_path / "tas.nc")
+    fin.sel(time=slice("1990", "1992")).to_netcdf(tmp_path / "tas_A_1990.nc")
+    fin.sel(time=slice("1993", "1995")).to_netcdf(tmp_path / "tas_A_1993.nc")
+    fin.to_netcdf(tmp_path / "tas_B.nc")
+    fin.close()
+
+    ehf.main(
+        [
+            "run",
+            "--input",
+            str(tmp_path / "tas_A_*.nc"),
+            str(tmp_path / "tas_B.nc"),
+            "--base",
+            "1990",
+            "1993",
+            "--method",
+            "PA13",
+            "--EHFaccl",
+            "--daily",
+            "--outdir",
+            str(tmp_path / "out"),
+            "--tile-size",
+            "2",
+            "--workers",
+            "2",
+        ]
+    )
+
+    HWA, HWM, HWF, HWN, HWD, HWT, pct, EHF, HWMt, HWAt, spell, HWL = compute_EHF(
+        tave, dates, bsyear=1990, beyear=1993, EHFaccl=True, method="PA13"
+    )
+    for name in ["tas_A", "tas_B"]:
+        fout = xr.open_dataset(tmp_path / "out" / ("EHF_metrics_%s.nc" % name))
+        assert (fout.HWA.fillna(const.missingval).values == HWA).all()
+        assert (fout.HWL.fillna(const.missingval).values == HWL).all()
+        assert (fout.PRCTILE90.values == pct).all()
+        assert fout.HWA.encoding["zlib"]
+        fout.close()
+        fout = xr.open_dataset(tmp_path / "out" / ("EHF_index_%s.nc" % name))
+        assert (fout.EHF.values == EHF).all()
+        assert (fout.spell.values == spell).all()
+        assert len(fout.time) == len(EHF)
+        fout.close()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+""" threshold_builder.py
+
+Streaming calculation of the percentile thresholds of a base period, one year at a time.
+
+calc_percentile needs the whole base period of temperature in memory. ThresholdBuilder
+receives it in blocks of days (e.g. one year, or one file, at a time) and gives the same
+thresholds as calc_percentile, exactly:
+
+- NF13: the 95th percentile of each gridpoint only depends on the largest 5% of its
+  values, so only the largest values that can still be above the percentile are kept
+  (a bounded buffer updated with a partial sort, np.partition, at each block), about 5%
+  of the base period plus one day.
+- PA13: the 15-day windows of consecutive calendar days overlap, so the largest values
+  of all windows would take more memory than the base period itself. The days are
+  written to a temporary memory-mapped file instead, and thresholds are calculated from
+  it by calc_percentile_doy a chunk of gridpoints at a time, so memory is bounded by the
+  chunk size (see percentile_chunk_bytes) and not by the length of the base period.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import xarray as xr
+from constants import const
+from calendars import get_ymd, get_calendar, calc_leap_days, calendars_360
+from compute_EHFheatwaves import (
+    calc_percentile_doy,
+    interpolate_percentile,
+    masked_to_nan,
+)
+
+
+class ThresholdBuilder(object):
+
+    """Streaming calculation of the thresholds of a base period, with the same results as calc_percentile
+    bsyear, beyear: first and last year of the base period
+    method: NF13 or PA13
+    nwindow: number of days in the window used to calculate percentiles in PA13 method
+    tmpdir: [OPTIONAL] directory of the temporary file of PA13 method. Default: system temporary directory
+    chunk_size: [OPTIONAL] number of gridpoints processed at once in PA13 method (see calc_percentile_doy)
+
+    Days are added with add(tave, dates), in chronological order in PA13 method, and days outside the
+    base period (and leap days in PA13) are left out. get_pct() returns the thresholds once all of them
+    have been added. Masked values are left out, as in calc_percentile.
+    """
+
+    def __init__(
+        self, bsyear, beyear, method="NF13", nwindow=15, tmpdir=None, chunk_size=None
+    ):
+        if method not in ("NF13", "PA13"):
+            raise ValueError("Method not supported: Choose between NF13 or PA13")
+        self.bsyear = bsyear
+        self.beyear = beyear
+        self.nyears = beyear - bsyear + 1
+        self.method = method
+        self.nwindow = nwindow
+        self.tmpdir = tmpdir
+        self.chunk_size = chunk_size
+        self.masked = False
+
+        # NF13: largest values and number of valid values of each gridpoint
+        self.tail = None
+        self.nvalid = None
+        # PA13: base period days in a temporary file
+        self.filename = None
+        self.days = None
+        self.ndays = 0
+
+    def get_tail_size(self, ndays):
+        """get the number of largest values needed for the NF13 percentile of ndays values"""
+        return ndays - int(np.floor(0.95 * (ndays - 1)))
+
+    def add(self, tave, dates):
+        """add a block of days of the base period
+        tave: (time,lat,lon) array (e.g. one year)
+        dates: dates of each day
+        """
+        years, months, days = get_ymd(dates)
+        keep = (years >= self.bsyear) & (years <= self.beyear)
+        if self.method == "PA13":
+            keep &= ~calc_leap_days(months, days, get_calendar(dates))
+        tave = tave[np.nonzero(keep)[0]]
+
+        if isinstance(tave, np.ma.core.MaskedArray):
+            tave = masked_to_nan(tave)
+            self.masked = True
+        else:
+            tave = np.asarray(tave)
+
+        if self.method == "NF13":
+            self.add_tail(tave)
+        else:
+            ndoy = 360 if get_calendar(dates) in calendars_360 else 365
+            self.add_days(tave, ndoy)
+
+    def add_tail(self, tave):
+        """keep the largest values of tave and of the previous blocks (NF13)"""
+        if self.tail is None:
+            # 366 days per year is the longest base period of any calendar
+            self.ntail = self.get_tail_size(self.nyears * 366)
+            self.tail = np.zeros((0,) + tave.shape[1:], dtype=tave.dtype)
+            self.nvalid = np.zeros(tave.shape[1:], dtype=int)
+
+        # Missing values are kept as -inf, below any valid value
+        missing = np.isnan(tave)
+        self.nvalid += np.sum(~missing, axis=0)
+        values = np.concatenate((self.tail, np.where(missing, -np.inf, tave)))
+        nvalues = values.shape[0]
+        if nvalues > self.ntail:
+            values = np.partition(values, nvalues - self.ntail, axis=0)
+            values = values[nvalues - self.ntail :]
+        self.tail = values
+
+    def add_days(self, tave, ndoy):
+        """write the days of tave to the temporary file (PA13)"""
+        if self.days is None:
+            fd, self.filename = tempfile.mkstemp(suffix=".npy", dir=self.tmpdir)
+            os.close(fd)
+            self.days = np.lib.format.open_memmap(
+                self.filename,
+                mode="w+",
+                dtype=tave.dtype,
+                shape=(self.nyears * ndoy,) + tave.shape[1:],
+            )
+        if self.ndays + tave.shape[0] > self.days.shape[0]:
+            raise ValueError(
+                "More days than in the base period %s-%s" % (self.bsyear, self.beyear)
+            )
+        self.days[self.ndays : self.ndays + tave.shape[0]] = tave
+        self.ndays += tave.shape[0]
+
+    def get_pct(self):
+        """get the thresholds of the days added, (lat,lon) for NF13 or (ndoy,lat,lon) for PA13"""
+        if self.method == "NF13":
+            if self.tail is None:
+                raise ValueError("No days of the base period were added")
+            values = np.sort(np.moveaxis(self.tail, 0, -1), axis=-1)
+            with np.errstate(invalid="ignore"):
+                pct = interpolate_percentile(
+                    values, 95, self.nvalid, offset=self.nvalid - values.shape[-1]
+                )
+        else:
+            if self.days is None or self.ndays != self.days.shape[0]:
+                raise ValueError(
+                    "The base period %s-%s is not complete" % (self.bsyear, self.beyear)
+                )
+            self.days.flush()
+            pct = calc_percentile_doy(
+                self.days,
+                self.nyears,
+                90,
+                nwindow=self.nwindow,
+                chunk_size=self.chunk_size,
+                skipna=self.masked,
+            )
+
+        if self.masked and self.method == "NF13":
+            pct = pct.astype(float)
+            pct[np.isnan(pct)] = const.missingval
+        return pct
+
+    def close(self):
+        """remove the temporary file"""
+        if self.days is not None:
+            del self.days
+            self.days = None
+            os.remove(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def calc_percentile_files(
+    files, bsyear, beyear, varname="tas", method="NF13", nwindow=15, tmpdir=None
+):
+
+    """Function to calculate the thresholds of a base period stored in several files, reading one year at a time
+    files: list of netCDF files (e.g. one per year or decade), in chronological order
+    bsyear, beyear: first and last year of the base period
+    varname: name of the temperature variable
+    method, nwindow: same as calc_percentile
+    tmpdir: [OPTIONAL] directory of the temporary file of PA13 method
+    ---
+    output: pct, same as calc_percentile
+    """
+    with ThresholdBuilder(bsyear, beyear, method, nwindow, tmpdir) as builder:
+        for filename in files:
+            with xr.open_dataset(filename) as fin:
+                var = fin[varname]
+                dates = fin.indexes[var.dims[0]]
+                years = get_ymd(dates)[0]
+                for year in np.unique(years):
+                    if year < bsyear or year > beyear:
+                        continue
+                    index = np.nonzero(years == year)[0]
+                    builder.add(var[index].values, dates[index])
+        return builder.get_pct()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+""" threshold_cache.py
+
+Persistent cache of the percentile thresholds calculated by calc_percentile.
+
+Thresholds are the most expensive step of compute_EHF and they are the same for all
+the runs (e.g. scenarios) that share a base period. Each entry is stored as a netCDF
+file with the same layout as thres_file (PRCTILE95 for NF13, PRCTILE90 for PA13) and
+it is identified by a hash of the base period data together with bsyear, beyear,
+method and nwindow. When the total size of the cache exceeds max_size, the least
+recently used entries are removed.
+"""
+
+import hashlib
+import os
+import glob as glob
+
+import netCDF4 as nc
+import numpy as np
+
+
+class ThresholdCache(object):
+
+    """Cache of percentile thresholds in a directory
+    cache_dir: directory where the thresholds are stored. Default: ~/.cache/EHF
+    max_size: [OPTIONAL] maximum size of the cache in bytes. Default: no limit
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "EHF")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, tave, bsyear, beyear, method, nwindow, tindex=None):
+        """get the key of the thresholds calculated from the base period tave
+
+        tindex: [OPTIONAL] days of tave in the base period. They are hashed one year at a time,
+                which gives the same key as tave[tindex] without copying tave whole
+        """
+        if tindex is None:
+            tindex = np.arange(tave.shape[0])
+        digest = hashlib.sha256()
+        digest.update(
+            ("%s-%s-%s-%s" % (bsyear, beyear, method, nwindow)).encode("utf-8")
+        )
+        # Values are hashed in native byte order, so a big-endian file and its native copy share the key
+        dtype = tave.dtype.newbyteorder("=")
+        shape = (len(tindex),) + tave.shape[1:]
+        digest.update(("%s-%s" % (shape, dtype)).encode("utf-8"))
+        for bstart in range(0, len(tindex), 365):
+            block = tave[tindex[bstart : bstart + 365]]
+            digest.update(
+                np.ascontiguousarray(np.ma.getdata(block), dtype=dtype).view(np.uint8)
+            )
+        if isinstance(tave, np.ma.core.MaskedArray):
+            for bstart in range(0, len(tindex), 365):
+                block = tave[tindex[bstart : bstart + 365]]
+                digest.update(
+                    np.ascontiguousarray(np.ma.getmaskarray(block)).view(np.uint8)
+                )
+        return digest.hexdigest()
+
+    def get_file(self, key):
+        """get the netCDF file of an entry"""
+        return os.path.join(self.cache_dir, "%s.nc" % (key))
+
+    def get(self, key):
+        """get the thresholds of an entry, None if it is not in the cache"""
+        filename = self.get_file(key)
+        if not os.path.exists(filename):
+            return None
+
+        pct_file = nc.Dataset(filename, "r")
+        pct_file.set_auto_mask(False)
+        if "PRCTILE90" in pct_file.variables:
+            pct = pct_file.variables["PRCTILE90"][:].astype("float")
+        else:
+            pct = pct_file.variables["PRCTILE95"][:].astype("float")
+        pct_file.close()
+
+        # Access time is used to evict the least recently used entries
+        os.utime(filename)
+        return pct
+
+    def put(self, key, pct, bsyear, beyear, method, nwindow):
+        """store the thresholds of an entry and evict old entries if the cache is too large"""
+        filename = self.get_file(key)
+        tmpfile = filename + ".tmp"
+
+        pct_file = nc.Dataset(tmpfile, "w")
+        pct_file.setncatts(
+            dict(bsyear=bsyear, beyear=beyear, method=method, nwindow=nwindow)
+        )
+        pct_file.createDimension("y", pct.shape[-2])
+        pct_file.createDimension("x", pct.shape[-1])
+        if method == "PA13":
+            pct_file.createDimension("doy", pct.shape[0])
+            var = pct_file.createVariable("PRCTILE90", "f8", ("doy", "y", "x"))
+        else:
+            var = pct_file.createVariable("PRCTILE95", "f8", ("y", "x"))
+        var[:] = pct
+        pct_file.close()
+
+        # Entries are renamed once complete, so that a failed write never leaves a corrupt entry
+        os.replace(tmpfile, filename)
+        self.evict()
+
+    def invalidate(self, key=None):
+        """remove an entry from the cache, or all entries if no key is given"""
+        if key is None:
+            filenames = glob.glob(os.path.join(self.cache_dir, "*.nc"))
+        else:
+            filenames = [self.get_file(key)]
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def get_size(self):
+        """get the total size of the cache in bytes"""
+        return sum(
+            os.path.getsize(filename)
+            for filename in glob.glob(os.path.join(self.cache_dir, "*.nc"))
+        )
+
+    def evict(self):
+        """remove the least recently used entries until the cache is smaller than max_size"""
+        if self.max_size is None:
+            return
+
+        filenames = sorted(
+            glob.glob(os.path.join(self.cache_dir, "*.nc")), key=os.path.getmtime
+        )
+        size = sum(os.path.getsize(filename) for filename in filenames)
+        for filename in filenames:
+            if size <= self.max_size:
+                break
+            size -= os.path.getsize(filename)
+            os.remove(filename)
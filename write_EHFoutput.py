@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+""" write_EHFoutput.py
+
+Compressed and chunked output of the yearly metrics, thresholds, EHF index and spells.
+
+EHFWriter creates all output variables first and then writes the results of compute_EHF
+tile by tile (write_tile), so the output is never built whole in memory (e.g. from the
+tiles of compute_EHFtiles.run_tiles). write_EHF writes the results of a single call.
+
+- Compression: variables are compressed with zlib or zstd (shuffle filter on). The daily
+  EHF index is mostly zeros outside heatwaves and is the largest output.
+- Chunking: chunks of about chunk_bytes, either one map per chunk (layout="map"), the whole
+  time series of a block of gridpoints (layout="series") or the same number of chunks along
+  every dimension (layout="balanced"), so reading a map and reading the time series of a
+  gridpoint take about the same number of chunks. Tiles aligned with the spatial chunks
+  (see the chunks attribute) are written without reading chunks back.
+- Packing: with pack=True, EHF and the yearly metrics are stored as int16 with scale_factor
+  and add_offset (see pack_info) and spells as int16. Thresholds are never packed, so the
+  output can still be used as thres_file with the same results.
+
+Files ending in .zarr are written as Zarr stores (requires zarr), with the compressor
+of zarr by default, and any other file as netCDF4.
+"""
+
+import datetime as dt
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import xarray as xr
+from constants import const
+import HWvariables_info as hwv
+from calendars import get_ymd, get_calendar, calendars_360
+from compute_EHFheatwaves import calc_dates, metric_names
+
+
+# scale_factor and add_offset of the variables packed as int16 (pack=True). EHF is never
+# negative, so it takes the whole int16 range from 0 to 1310.68. Temperatures take an
+# offset of 273.15 so both degC and K values fit (-54 to 600)
+pack_info = dict(
+    EHF=(0.02, 655.34),
+    HWA=(0.02, 655.34),
+    HWM=(0.02, 655.34),
+    HWF=(0.01, 0.0),
+    HWN=(1.0, 0.0),
+    HWD=(1.0, 0.0),
+    HWT=(1.0, 0.0),
+    HWL=(0.01, 0.0),
+    HWAt=(0.01, 273.15),
+    HWMt=(0.01, 273.15),
+)
+
+# Fill value of int16 packed variables, so valid values are within +-32767
+pack_fill = -32768
+
+
+def get_chunks(shape, layout="balanced", itemsize=8, chunk_bytes=2 ** 20):
+
+    """Function to get the chunk sizes of a (time,lat,lon) or (lat,lon) variable
+    shape: shape of the variable
+    layout: map (one time step per chunk), series (whole time series per chunk), balanced (the same number
+            of chunks along every dimension) or a tuple with the chunk sizes
+    itemsize: bytes of each value
+    chunk_bytes: approximate size of each chunk in bytes
+    ---
+    output: tuple with the chunk sizes
+    """
+    if not isinstance(layout, str):
+        return tuple(min(int(size), n) for size, n in zip(layout, shape))
+    if layout not in ("map", "series", "balanced"):
+        raise ValueError("Layout not supported: Choose between map, series or balanced")
+
+    nvalues = max(chunk_bytes // itemsize, 1)
+    if layout == "balanced" or len(shape) < 3:
+        # All dimensions are reduced by the same factor
+        factor = min((nvalues / float(np.prod(shape))) ** (1.0 / len(shape)), 1.0)
+        return tuple(max(min(int(round(n * factor)), n), 1) for n in shape)
+
+    ntime = 1 if layout == "map" else shape[0]
+    factor = min((nvalues / float(ntime * shape[1] * shape[2])) ** 0.5, 1.0)
+    return (ntime,) + tuple(max(min(int(round(n * factor)), n), 1) for n in shape[1:])
+
+
+def calc_time_values(dates, units, calendar):
+
+    """Function to convert dates to numbers in the given units and calendar
+    dates: datetime64 array, pandas DatetimeIndex, list of datetime or cftime dates
+    ---
+    output: float array
+    """
+    values = np.asarray(dates)
+    if np.issubdtype(values.dtype, np.datetime64) or (
+        len(values) > 0 and isinstance(values[0], dt.date)
+    ):
+        values = pd.DatetimeIndex(values).to_pydatetime()
+    return np.asarray(nc.date2num(list(values), units, calendar=calendar), dtype=float)
+
+
+class EHFWriter(object):
+
+    """Writer of the results of compute_EHF, tile by tile, to a compressed netCDF4 file or Zarr store
+    filename: output file. Zarr store if it ends in .zarr, netCDF4 otherwise
+    dates: dates of each day of the input temperature (see calendars.py)
+    shape: (lat,lon) shape of the whole grid
+    method: NF13 or PA13 (leap days are removed from the daily variables and thresholds are PRCTILE90)
+    dims: names of the spatial dimensions
+    coords: [OPTIONAL] dictionary of spatial coordinates, name: (dims, values) or (dims, values, attrs).
+            A _FillValue in attrs is used as the fill value of the coordinate
+    metrics: if True, the yearly metrics and thresholds are written
+    daily: if True, the daily EHF index and spells are written
+    compression: zlib, zstd or None (netCDF4 only, Zarr stores use the compressor of zarr)
+    complevel: compression level (netCDF4 only)
+    layout: chunk layout of the (time,lat,lon) variables: map, series, balanced or chunk sizes (see get_chunks)
+    chunk_bytes: approximate size of each chunk in bytes
+    pack: if True, variables in pack_info are stored as int16 with scale_factor and add_offset and spells as
+          int16. A dictionary name: (scale_factor, add_offset) packs those variables instead
+    dtype: floating type of the variables that are not packed
+    pct_units: units of the thresholds (those of the temperature)
+    time_units: [OPTIONAL] units of the time coordinate (e.g. those of the input). Default: days since
+                the first of January of the first year
+    calendar: [OPTIONAL] calendar of the time coordinate. Default: calendar of dates
+
+    Values that do not fit int16 once packed raise a ValueError instead of wrapping around.
+    """
+
+    def __init__(
+        self,
+        filename,
+        dates,
+        shape,
+        method="NF13",
+        dims=("lat", "lon"),
+        coords=None,
+        metrics=True,
+        daily=True,
+        compression="zlib",
+        complevel=4,
+        layout="balanced",
+        chunk_bytes=2 ** 20,
+        pack=False,
+        dtype="f8",
+        pct_units="",
+        time_units=None,
+        calendar=None,
+    ):
+        self.filename = str(filename)
+        self.zarr = self.filename.rstrip("/").endswith(".zarr")
+        self.dims = tuple(dims)
+        self.shape = tuple(shape)
+        self.fout = None
+        self.daily = daily
+        self.metrics = metrics
+        if pack is True:
+            pack = pack_info
+        self.pack = dict(pack) if pack else {}
+
+        years = get_ymd(dates)[0]
+        syear = np.min(years)
+        nyears = np.max(years) - syear + 1
+        if calendar is None:
+            calendar = get_calendar(dates)
+        tindex = calc_dates(dates, method)[4]
+        if tindex is not None:
+            dates = np.asarray(dates)[tindex]
+        units = time_units or "days since %04d-01-01 00:00:00" % syear
+
+        self.coords = {}
+        if metrics:
+            self.coords["year"] = (
+                ("year",),
+                np.arange(syear, syear + nyears, dtype="i4"),
+                {"units": "year"},
+            )
+        if daily:
+            self.coords["time"] = (
+                ("time",),
+                calc_time_values(dates, units, calendar),
+                {"units": units, "calendar": calendar},
+            )
+        for name, coord in (coords or {}).items():
+            self.coords[name] = (tuple(coord[0]), np.asarray(coord[1])) + tuple(
+                coord[2:]
+            )
+
+        # name: (dims, shape, dtype, attributes) of each output variable
+        varinfo = hwv.VariablesInfo()
+        self.variables = {}
+        if metrics:
+            for vname in metric_names:
+                self.add_variable(
+                    vname, "year", (nyears,) + self.shape, varinfo, vname, dtype
+                )
+            if method == "PA13":
+                ndoy = 360 if calendar in calendars_360 else 365
+                self.pct_name = "PRCTILE90"
+                self.add_variable(
+                    self.pct_name, "doy", (ndoy,) + self.shape, None, None, dtype
+                )
+                self.variables[self.pct_name][3]["long_name"] = "Percentile 90th"
+            else:
+                self.pct_name = "PRCTILE95"
+                self.add_variable(self.pct_name, None, self.shape, None, None, dtype)
+                self.variables[self.pct_name][3]["long_name"] = varinfo.get_varatt(
+                    "pct", "Longname"
+                )
+            self.variables[self.pct_name][3]["units"] = pct_units
+        if daily:
+            ntime = len(self.coords["time"][1])
+            shape_daily = (ntime,) + tuple(shape)
+            self.add_variable("EHF", "time", shape_daily, varinfo, "EHFindex", dtype)
+            self.add_variable(
+                "spell", "time", shape_daily, varinfo, "spell", "i2" if self.pack else "i4"
+            )
+
+        self.chunks = {}
+        for vname, (vdims, vshape, vtype, atts) in self.variables.items():
+            itemsize = np.dtype("i2" if vname in self.pack else vtype).itemsize
+            vlayout = layout if vdims[0] in ("time", "year") else "balanced"
+            self.chunks[vname] = get_chunks(vshape, vlayout, itemsize, chunk_bytes)
+
+        if self.zarr:
+            self.create_zarr()
+        else:
+            self.create_nc(compression, complevel)
+
+    def add_variable(self, vname, tdim, shape, varinfo, vinfo, vtype):
+        """add an output variable, with the attributes of vinfo in VariablesInfo"""
+        atts = {}
+        if varinfo is not None:
+            atts["long_name"] = varinfo.get_varatt(vinfo, "Longname")
+            atts["units"] = varinfo.get_varatt(vinfo, "units")
+            atts["description"] = varinfo.get_varatt(vinfo, "description")
+        vdims = self.dims if tdim is None else (tdim,) + self.dims
+        self.variables[vname] = (vdims, shape, vtype, atts)
+
+    def get_fill_value(self, vname):
+        """get the fill value of a variable, None for spells"""
+        if vname in self.pack:
+            return pack_fill
+        if vname == "spell":
+            return None
+        return const.missingval
+
+    def create_nc(self, compression, complevel):
+        """create the netCDF4 file with all variables"""
+        fout = nc.Dataset(self.filename, "w")
+        for vname, (vdims, vshape, vtype, atts) in self.variables.items():
+            for dim, size in zip(vdims, vshape):
+                if dim not in fout.dimensions:
+                    fout.createDimension(dim, size)
+
+        for name, coord in self.coords.items():
+            atts = dict(coord[2]) if len(coord) > 2 else {}
+            vout = fout.createVariable(
+                name, coord[1].dtype, coord[0], fill_value=atts.pop("_FillValue", None)
+            )
+            vout.setncatts(atts)
+            vout[:] = coord[1]
+
+        for vname, (vdims, vshape, vtype, atts) in self.variables.items():
+            vout = fout.createVariable(
+                vname,
+                "i2" if vname in self.pack else vtype,
+                vdims,
+                compression=compression,
+                complevel=complevel,
+                shuffle=compression is not None,
+                chunksizes=self.chunks[vname],
+                fill_value=self.get_fill_value(vname),
+            )
+            vout.setncatts(atts)
+            if vname in self.pack:
+                vout.scale_factor, vout.add_offset = self.pack[vname]
+        self.fout = fout
+
+    def create_zarr(self):
+        """create the Zarr store with all variables, without writing their values"""
+        import dask.array as da
+
+        # Fill values of the coordinates go in their encoding
+        fout = xr.Dataset()
+        encoding = {}
+        for name, coord in self.coords.items():
+            atts = dict(coord[2]) if len(coord) > 2 else {}
+            if "_FillValue" in atts:
+                encoding[name] = dict(_FillValue=atts.pop("_FillValue"))
+            fout.coords[name] = (coord[0], coord[1], atts)
+        for vname, (vdims, vshape, vtype, atts) in self.variables.items():
+            chunks = self.chunks[vname]
+            if vname == "spell":
+                var = da.zeros(vshape, chunks=chunks, dtype=vtype)
+                fout[vname] = (vdims, var, atts)
+                encoding[vname] = dict(chunks=chunks)
+                continue
+            var = da.zeros(vshape, chunks=chunks, dtype=float)
+            fout[vname] = (vdims, var, atts)
+            encoding[vname] = dict(chunks=chunks, _FillValue=self.get_fill_value(vname))
+            if vname in self.pack:
+                scale_factor, add_offset = self.pack[vname]
+                encoding[vname].update(
+                    dtype="i2", scale_factor=scale_factor, add_offset=add_offset
+                )
+            else:
+                encoding[vname]["dtype"] = vtype
+        fout.to_zarr(self.filename, mode="w", compute=False, encoding=encoding)
+
+    def get_tile_variables(self, result):
+        """get the variables to write from the output of compute_EHF, missing values masked"""
+        HWA, HWM, HWF, HWN, HWD, HWT, pct, EHF, HWMt, HWAt, spell, HWL = result
+        output = {}
+        if self.metrics:
+            metrics = dict(
+                HWA=HWA,
+                HWM=HWM,
+                HWF=HWF,
+                HWN=HWN,
+                HWD=HWD,
+                HWT=np.ma.masked_equal(np.ma.getdata(HWT), 0.0),
+                HWL=HWL,
+                HWAt=HWAt,
+                HWMt=HWMt,
+            )
+            for vname in metric_names:
+                output[vname] = np.ma.masked_equal(metrics[vname], const.missingval)
+            output[self.pct_name] = np.ma.masked_equal(pct, const.missingval)
+        if self.daily:
+            output["EHF"] = np.ma.masked_equal(EHF, const.missingval)
+            output["spell"] = np.ma.getdata(spell)
+
+        for vname, var in output.items():
+            if vname in self.pack or (vname == "spell" and self.pack):
+                scale_factor, add_offset = self.pack.get(vname, (1.0, 0.0))
+                values = np.ma.compressed(np.ma.asarray(var))
+                packed = np.round((values - add_offset) / scale_factor)
+                if values.size > 0 and np.max(np.abs(packed)) > 32767:
+                    raise ValueError(
+                        "Values of %s do not fit int16 (scale_factor %s, add_offset %s)"
+                        % (vname, scale_factor, add_offset)
+                    )
+        return output
+
+    def write_tile(self, tlat, tlon, result):
+        """write the output of compute_EHF of one tile
+        tlat, tlon: slices of the tile
+        result: output of compute_EHF over the tile
+        """
+        output = self.get_tile_variables(result)
+        if not self.zarr:
+            for vname, var in output.items():
+                vout = self.fout.variables[vname]
+                if vname in self.pack:
+                    # Packed here, so masked values are not cast to int16 by netCDF4
+                    vout.set_auto_scale(False)
+                    var = (var - vout.add_offset) / vout.scale_factor
+                    var = np.ma.filled(np.round(var), pack_fill).astype("i2")
+                vout[..., tlat, tlon] = var
+            return
+
+        fout = xr.Dataset()
+        for vname, var in output.items():
+            if vname != "spell":
+                var = np.ma.filled(var.astype(float), np.nan)
+            fout[vname] = (self.variables[vname][0], var)
+        region = {}
+        for dim, size in fout.sizes.items():
+            region[dim] = slice(0, size)
+        region[self.dims[0]] = slice(*tlat.indices(self.shape[0])[:2])
+        region[self.dims[1]] = slice(*tlon.indices(self.shape[1])[:2])
+        fout.to_zarr(self.filename, mode="r+", region=region)
+
+    def write(self, result):
+        """write the output of compute_EHF over the whole grid"""
+        self.write_tile(slice(0, self.shape[0]), slice(0, self.shape[1]), result)
+
+    def close(self):
+        """close the output file"""
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_EHF(filename, result, dates, **kwargs):
+
+    """Function to write the output of compute_EHF over the whole grid
+    filename: output file. Zarr store if it ends in .zarr, netCDF4 otherwise
+    result: output of compute_EHF
+    dates: dates of each day of the input temperature
+    kwargs: any other argument of EHFWriter (method, dims, coords, daily, compression, layout, pack...)
+    ---
+    output: None
+    """
+    with EHFWriter(filename, dates, result[0].shape[1:], **kwargs) as writer:
+        writer.write(result)